@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # Copyright (C) 2010 Timo Juhani Lindfors <timo.lindfors@iki.fi>
 
 # Permission is hereby granted, free of charge, to any person obtaining a copy
@@ -23,7 +23,6 @@ import ubx
 import struct
 import calendar
 import os
-import gobject
 import logging
 import sys
 import socket
@@ -31,6 +30,9 @@ import time
 import datetime
 import calendar
 
+from ubloxFile import UbloxFile
+import ubloxParallel
+import ubloxTimeIndex
 from stream import fixTypeDict, fusionModeDict, timeValidDict, timeValidSymbolDict
 
 timestamp = 0
@@ -53,6 +55,8 @@ dataRateStartTime = None
 intervalDataProcessed = 0
 dataSize = None
 dataProcessed = 0
+# Seconds between progress lines when writing .npz chunks
+PROGRESS_INTERVAL = 1.0
 
 
 def callback(ty, packet):
@@ -98,9 +102,7 @@ def callback(ty, packet):
             displayString += ' | R: {}, P: {}, Hdg {:.1f}'.format(rollString, pitchString, heading)
             displayString += ' | Fix: {}, # Sats: {}, CNO: {}, HDOP: {}, Fusion: {}'.format(fix, numSatsString, cnoString, hdopString, fusionMode) 
             displayString += ' | {:.1f} MPH'.format(speedMph)
-            displayString += ' | Processed {:.0f}/{:.0f} KB ({:.3f} %)'.format(dataProcessed/1000., dataSize/1000., float(dataProcessed)/dataSize * 100)
-            if dataRate is not None:
-                displayString += ', Rate: {:.1f} KB/s'.format(dataRate/1000.)
+            displayString += ' | ' + progressString()
             print(displayString)
 
     elif ty == 'NAV-ATT':
@@ -132,14 +134,20 @@ def callback(ty, packet):
     # else:
     #     print("{}: {}".format(ty, packet))
 
-def rawCallback(data):
+def progressString():
+    string = 'Processed {:.0f}/{:.0f} KB ({:.3f} %)'.format(dataProcessed/1000., dataSize/1000., float(dataProcessed)/max(dataSize, 1) * 100)
+    if dataRate is not None:
+        string += ', Rate: {:.1f} KB/s'.format(dataRate/1000.)
+    return string
+
+def updateProgress(numBytes):
     global dataProcessed, dataRate, intervalDataProcessed, dataRateStartTime
 
     if dataRateStartTime is None:
         dataRateStartTime = time.time()
     else:
-        dataProcessed += len(data)
-        intervalDataProcessed += len(data)
+        dataProcessed += numBytes
+        intervalDataProcessed += numBytes
         curTime = time.time()
         elapsed = curTime - dataRateStartTime
         if elapsed > 1:
@@ -152,21 +160,76 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('file', help='UBX file to parse')
     parser.add_argument('--output', '-o', default=None)
+    parser.add_argument('--format', choices=['pickle', 'npz'], default='pickle', help='Output a pickle of message dictionaries, or a directory of columnar .npz chunks')
+    parser.add_argument('--chunkSize', type=int, default=100000, help='Number of messages of each type per .npz chunk')
+    parser.add_argument('--processes', '-p', type=int, default=None, help='Parse with this many processes (pickle output only)')
+    parser.add_argument('--start', type=float, default=None, help='Only parse from this ITOW in seconds')
+    parser.add_argument('--end', type=float, default=None, help='Only parse up to this ITOW in seconds')
+    parser.add_argument('--week', type=int, default=None, help='GPS week of --start and --end')
     args = parser.parse_args()
+    if args.start is not None and args.end is not None and args.end <= args.start:
+        parser.error('--end must be after --start')
     
     logging.basicConfig(level=logging.WARNING)
 
     if args.output is None:
         head, ext = os.path.splitext(args.file)
-        args.output = head + '.pickle'
+        args.output = head + ('.pickle' if args.format == 'pickle' else '.columns')
         
     display = True
-    output = {}
-    t = ubx.Parser(callback, device=False, rawCallback=rawCallback)
-    binFile = args.file
-    data = open(binFile,'rb').read()
-    dataSize = len(data)
-    t.parse(data, useRawCallback=True)
+    if args.format == 'pickle':
+        output = {}
+        store = None
+    else:
+        from ubloxStore import StoreWriter
+        store = StoreWriter(args.output, chunkSize=args.chunkSize)
+    window = args.start is not None or args.end is not None
+    if args.processes is not None and args.processes > 1 and store is None and not window:
+        dataSize = ubloxParallel.fileSize(args.file)
+        previousOffset = 0
+        for offset, ty, packet in ubloxParallel.parseFile(args.file, processes=args.processes):
+            updateProgress(offset - previousOffset)
+            previousOffset = offset
+            callback(ty, packet)
+    else:
+        startItow = int(args.start * 1000) if args.start is not None else None
+        endItow = int(args.end * 1000) if args.end is not None else None
+        # Without a week, only the blocks of the window of a compressed file
+        # need to be read
+        with UbloxFile(args.file, startItow=startItow if args.week is None else None,
+                       endItow=endItow if args.week is None else None) as f:
+            first, last = 0, len(f)
+            if window:
+                # Find the frames of the window with the time index
+                first, last = ubloxTimeIndex.frameRange(f, ubloxTimeIndex.loadTimeIndex(f), startItow, endItow, args.week)
+            previousOffset = f.offsets[first] if first < len(f) else f.dataSize
+            dataSize = (f.offsets[last] if last < len(f) else f.dataSize) - previousOffset
+            nextProgress = time.time()
+            for i in range(first, last):
+                # Account for the data up to the end of this frame
+                offset = f.offsets[i] + f.lengths[i] + 8
+                updateProgress(offset - previousOffset)
+                previousOffset = offset
+                if f.lengths[i] == 0:
+                    continue
+                if store is not None:
+                    # Columns are unpacked from the payloads, so nothing is
+                    # decoded and progress comes from the index
+                    store.add(f.classes[i], f.ids[i], f.lengths[i], f.read(f.offsets[i]+6, f.lengths[i]))
+                    if display and time.time() >= nextProgress:
+                        print(progressString())
+                        nextProgress = time.time() + PROGRESS_INTERVAL
+                    continue
+                try:
+                    ty, packet = f.decode(i)
+                except ValueError:
+                    continue
+                callback(ty, packet)
+
+    if store is not None:
+        store.close()
+        print('Wrote {}'.format(args.output))
+        sys.exit(0)
 
     for key in sorted(output.keys()):
         print('{}: {}'.format(key, len(output[key])))
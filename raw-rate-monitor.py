@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # Copyright (C) 2010 Timo Juhani Lindfors <timo.lindfors@iki.fi>
 
 # Permission is hereby granted, free of charge, to any person obtaining a copy
@@ -22,7 +22,6 @@
 # Monitor the rate at which RAW messages are sent
 
 import ubx
-import gobject
 import sys
 import time
 
@@ -37,5 +36,9 @@ def callback(ty, *args):
         prev_t = t
 
 if __name__ == "__main__":
-    t = ubx.Parser(callback)
-    gobject.MainLoop().run()
+    device = sys.argv[1] if len(sys.argv) > 1 else "/dev/ttyO5"
+    try:
+        for ty, packet in ubx.iterMessages(device, ['RXM-RAW']):
+            callback(ty, packet)
+    except KeyboardInterrupt:
+        pass
@@ -23,7 +23,6 @@ import ubx
 import struct
 import calendar
 import os
-import gobject
 import logging
 import sys
 import socket
@@ -31,6 +30,10 @@ import time
 import datetime
 import calendar
 from gpsTimestamps import gpsWeekAndTow
+from ubloxFile import UbloxFile
+from ubloxLogger import UbloxLogger
+import ubloxCompressed
+from ubloxEpoch import EpochAssembler
 
 fixTypeDict = {0: 'NO', 1: 'DR', 2: '2D', 3: '3D', 4: '3D+DR', 5: 'Time'}
 fusionModeDict = {0: 'INIT', 1: 'ON', 2: 'Suspended', 3: 'Disabled'}
@@ -51,21 +54,7 @@ timeValidSymbolDict = {0: 'X',
                        6: '',
                        7: ''}
 
-timestamp = 0
-lat = 0
-lon = 0
-alt = 0
-speed = 0
-attTime = None
-roll = None
-pitch = None
-heading = None
-hdop = None
-numSats = None
-avgCNO = None
-fix = 'No'
 fusionMode = 'Unknown'
-msSinceStartup = None
 output = None
 display = True
 outputFile = None
@@ -73,87 +62,66 @@ dataRate = None
 dataRateStartTime = None
 dataCaptured = 0
 
-def callback(ty, packet):
-    global timestamp, lat, lon, alt, speed, attTime, roll, pitch, heading, hdop, numSats, avgCNO, fix, fusionMode, output, display, dataRate, msSinceStartup
+def missingString(epoch):
+    # Message types missing from an epoch, e.g. 'NAV-DOP' -> 'DOP'
+    return ','.join(ty[4:] for ty in assembler.types if epoch[ty] is None)
 
+def epochCallback(epoch):
+    # Print one line per navigation epoch, with the data of that epoch only
+    if not display:
+        return
     curTimestamp = time.time()
+    pvt = epoch['NAV-PVT']
+    att = epoch['NAV-ATT']
+    dop = epoch['NAV-DOP']
+    status = epoch['NAV-STATUS']
+    svInfo = epoch['NAV-SVINFO']
+
+    displayString = '[{:.3f}'.format(epoch.itow/1e3)
+    if pvt is not None:
+        dt = datetime.datetime(pvt.Year, pvt.Month, pvt.Day, pvt.Hour, pvt.Min, pvt.Sec) + datetime.timedelta(microseconds=int(pvt.Nano / 1000.))
+        timestamp = calendar.timegm(dt.timetuple()) + dt.microsecond * 1e-6
+        timeString = timeValidSymbolDict[pvt.Valid & 0x7] + dt.strftime('%H:%M:%S') + '.{:03.0f}Z'.format(dt.microsecond/1000.)
+        displayString += ' | {} {:.3f} ({:.3f})'.format(timeString, timestamp, curTimestamp - timestamp)
+    if status is not None:
+        displayString += ' | {:.3f}'.format(status.MSSS/1e3)
+    displayString += ']'
+    if pvt is not None:
+        displayString += ' Pos: {:.6f}, {:.6f}, {:.3f}'.format(pvt.LAT/1e7, pvt.LON/1e7, pvt.HEIGHT/1e3)
+    if att is not None:
+        displayString += ' | R: {:.3f}, P: {:.3f}, Hdg {:.1f}'.format(att.Roll/1e5, att.Pitch/1e5, att.Heading/1e5)
+    fix = fixTypeDict[status.GPSfix] if status is not None else '--'
+    displayString += ' | Fix: {}'.format(fix)
+    if svInfo is not None:
+        cno = [satInfo.CNO for satInfo in svInfo.blocks if satInfo.Flags & 1]
+        displayString += ', # Sats: {:2}, CNO: {:.1f}'.format(len(cno), float(sum(cno)) / len(cno) if cno else 0)
+    if dop is not None:
+        displayString += ', HDOP: {:.1f}'.format(dop.HDOP/100.)
+    displayString += ', Fusion: {}'.format(fusionMode)
+    if pvt is not None:
+        displayString += ' | {:.1f} MPH'.format(pvt.GSpeed/1e3 / 0.44704)
+    if not epoch.complete:
+        displayString += ' | Missing: {}'.format(missingString(epoch))
+    if dataRate is not None:
+        displayString += ' | Data rate: {:.1f} Kbps'.format(dataRate/1000)
+    print(displayString)
+
+assembler = EpochAssembler(epochCallback)
+
+def callback(ty, packet):
+    global fusionMode
 
     if args.raw:
         print('{}: {}'.format(ty, packet))
 
     if ty == 'HNR-PVT':
-        epoch = packet[0]['ITOW']/1e3
-        
-        year = packet[0]['Year']
-        month = packet[0]['Month']
-        day = packet[0]['Day']
-        hour = packet[0]['Hour']
-        minute = packet[0]['Min']
-        second = packet[0]['Sec']
-        nano = packet[0]['Nano']
-        dt = datetime.datetime(year, month, day, hour, minute, second) + datetime.timedelta(microseconds=int(nano / 1000.))
-        timestamp = calendar.timegm(dt.timetuple()) + dt.microsecond * 1e-6
-        timeValid = packet[0]['Valid'] & 0x7
-        timeValidSymbol = timeValidSymbolDict[timeValid]
-        # timeValidSymbol = str(timeValid)
-        offset = curTimestamp - timestamp
-
-        lat = packet[0]['LAT']/1e7
-        lon = packet[0]['LON']/1e7
-        alt = packet[0]['HEIGHT']/1e3
-        heading = packet[0]['HeadVeh']/1e5
-        speed = packet[0]['Speed']/1e3
-        fix = fixTypeDict[packet[0]['GPSFix']]
-    
-        speedMph = speed / 0.44704
-        if display:
-            timeString = timeValidSymbol + dt.strftime('%H:%M:%S') + '.{:03.0f}Z'.format(dt.microsecond/1000.)
-            numSatsString = '--' if numSats is None else '{:2}'.format(numSats)
-            attTimeString = '--' if attTime is None else '{:.3f}'.format(attTime)
-            rollString = '--' if roll is None else '{:.3f}'.format(roll)
-            pitchString = '--' if pitch is None else '{:.3f}'.format(pitch)
-            hdopString = '--' if hdop is None else '{:.1f}'.format(hdop)
-            cnoString = '--' if avgCNO is None else '{:.1f}'.format(avgCNO)
-            msssString = '--' if msSinceStartup is None else '{:.3f}'.format(msSinceStartup/1e3)
-            displayString = '[{} {:.3f} ({:.3f}) | {:.3f} | {}] Pos: {:.6f}, {:.6f}, {:.3f}'.format(timeString, timestamp, offset, epoch, msssString, lat, lon, alt)
-            displayString += ' | Att Time: {}, R: {}, P: {}, Hdg {:.1f}'.format(attTimeString, rollString, pitchString, heading)
-            displayString += ' | Fix: {}, # Sats: {}, CNO: {}, HDOP: {}, Fusion: {}'.format(fix, numSatsString, cnoString, hdopString, fusionMode) 
-            displayString += ' | {:.1f} MPH'.format(speedMph)
-            if dataRate is not None:
-                displayString += ' | Data rate: {:.1f} Kbps'.format(dataRate/1000)
-            print(displayString)
-
-    elif ty == 'NAV-ATT':
-        attTime = packet[0]['ITOW']/1e3
-        roll = packet[0]['Roll']/1e5
-        pitch = packet[0]['Pitch']/1e5
-        # heading = packet[0]['Heading']/1e5
-    elif ty == 'NAV-DOP':
-        hdop = packet[0]['HDOP']/100.
-    elif ty == 'NAV-STATUS':
-        # print('NAV-STATUS time: {:.3f}'.format(packet[0]['ITOW']/1e3))
-        fix = fixTypeDict[packet[0]['GPSfix']]
-        msSinceStartup = packet[0]['MSSS']
-    elif ty == 'NAV-SVINFO':
-        cno = []
-        for satInfo in packet[1:]:
-            if satInfo['Flags'] & 1:
-                cno.append(satInfo['CNO'])
-        numSats = len(cno)
-        if len(cno):
-            avgCNO = float(sum(cno)) / len(cno)
-        else:
-            avgCNO = 0
+        # HNR-PVT keeps the time moving between NAV epochs, so that
+        # incomplete epochs are printed without waiting for the next one
+        assembler.advance(packet.ITOW)
     elif ty == 'ESF-STATUS':
-        fusionMode = fusionModeDict[packet[0]['FusionMode']]
-        # print("{}: {}".format(ty, packet))
+        fusionMode = fusionModeDict[packet.FusionMode]
     else:
-        return
-
-    # if ty.startswith('$'):
-    #     print packet
-    # else:
-    #     print("{}: {}".format(ty, packet))
+        assembler.add(ty, packet)
 
 def rawCallback(data):
     global outputFile, dataRate, dataRateStartTime, dataCaptured
@@ -179,25 +147,37 @@ if __name__ == "__main__":
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--device', '-d', default=None)
     group.add_argument('--file', '-f', default=None)
-    parser.add_argument('--output', '-o', default=None)
+    parser.add_argument('--output', '-o', default=None, help='File to save the raw data to')
+    parser.add_argument('--outputDir', default=None, help='Directory to save the raw data to, in files named ublox_YYYYMMDDTHHMMSSZ.ubx')
+    parser.add_argument('--rotateSize', type=float, default=None, help='Start a new output file after this many MB')
+    parser.add_argument('--rotateTime', type=float, default=None, help='Start a new output file after this many seconds')
+    parser.add_argument('--frameAligned', action='store_true', help='Only start new output files at the beginning of a UBX frame')
+    parser.add_argument('--compress', '-z', choices=sorted(ubloxCompressed.CODECS.keys()), default=None, help='Save the raw data compressed (.ubz)')
     parser.add_argument('--raw', action='store_true')
     args = parser.parse_args()
     
     logging.basicConfig(level=logging.WARNING)
 
-    if args.output is not None:
-        outputFile = open(args.output, 'wb')
+    if args.output is not None or args.outputDir is not None:
+        maxFileSize = int(args.rotateSize * 1e6) if args.rotateSize is not None else None
+        directory = args.outputDir if args.outputDir is not None else (os.path.dirname(args.output) or '.')
+        outputFile = UbloxLogger(directory, filename=args.output, maxFileSize=maxFileSize,
+                                 maxFileAge=args.rotateTime, frameAligned=args.frameAligned, codec=args.compress)
 
     if args.device:
-        t = ubx.Parser(callback, device=args.device, rawCallback=rawCallback)
+        # Serial devices and ptys, e.g. from ubloxReplay.py or ubloxEmulator.py
+        t = ubx.Parser(callback, device=False, rawCallback=rawCallback, lazy=True)
         try:
-            gobject.MainLoop().run()
+            for data in ubx.readChunks(args.device):
+                rawCallback(data)
+                t.parse(data)
         except KeyboardInterrupt:
-            gobject.MainLoop().quit()
-            if outputFile is not None:
-                outputFile.close()
+            pass
+        assembler.flush()
+        if outputFile is not None:
+            outputFile.close()
     else:
-        t = ubx.Parser(callback, device=False)
-        binFile = args.file
-        data = open(binFile,'r').read()
-        t.parse(data)
+        with UbloxFile(args.file) as f:
+            for ty, packet in f.messages(lazy=True):
+                callback(ty, packet)
+        assembler.flush()
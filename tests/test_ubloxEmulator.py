@@ -0,0 +1,72 @@
+# Round trips with the receiver emulator
+import asyncio
+import os
+import struct
+
+import pytest
+
+import ubloxAsync
+import ubloxProfile
+from ubloxEmulator import ReceiverEmulator
+from ubloxMessage import CLIDPAIR, PORTID
+
+PROFILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'default-profile.json')
+
+@pytest.fixture
+def emulator():
+    with ReceiverEmulator(115200) as emulator:
+        yield emulator
+
+def run(emulator, session):
+    # Run session(protocol) against the emulator and return its result
+    async def main():
+        protocol = await ubloxAsync.openDevice(emulator.device)
+        try:
+            return await session(protocol)
+        finally:
+            ubloxAsync.closeDevice(protocol)
+    return asyncio.run(main())
+
+def testPoll(emulator):
+    async def session(protocol):
+        return await protocol.poll('MON-VER'), await protocol.poll('CFG-PRT', 1, {'PortID': PORTID['UART1']})
+    version, port = run(emulator, session)
+    assert version[0]['SWVersion'].startswith(b'EMULATOR')
+    assert port[1]['PortID'] == PORTID['UART1']
+    assert port[1]['Baudrate'] == 115200
+    assert emulator.stats['polls'] == 2
+
+def testConfigAck(emulator):
+    msgClass, msgId = CLIDPAIR['NAV-PVT']
+    async def session(protocol):
+        ack = await protocol.sendConfig('CFG-MSG', 3, [{'msgClass': msgClass, 'msgId': msgId}, {'rate': 1}])
+        return ack, await protocol.poll('CFG-MSG', 2, {'msgClass': msgClass, 'msgId': msgId})
+    ack, rates = run(emulator, session)
+    assert ack[0]['ClsID'] == CLIDPAIR['CFG-MSG'][0] and ack[0]['MsgID'] == CLIDPAIR['CFG-MSG'][1]
+    # One rate block per port
+    assert [block['rate'] for block in rates[1:]] == [0, 1, 0, 0, 0, 0]
+    assert emulator.msgRates[(msgClass, msgId)][PORTID['UART1']] == 1
+
+def testConfigNack(emulator):
+    async def session(protocol):
+        await protocol.sendConfig('CFG-RATE', 6, {'Meas': 10, 'Nav': 1, 'Time': 1})
+    with pytest.raises(Exception, match='ACK-NACK'):
+        run(emulator, session)
+    assert emulator.stats['nacks'] == 1
+    assert struct.unpack('<HHH', emulator.config['CFG-RATE']) == (1000, 1, 1)
+
+@pytest.mark.parametrize('port', ['UART1', 'USB'])
+def testApplyProfile(emulator, port):
+    profile = ubloxProfile.loadProfile(PROFILE, port)
+    async def session(protocol):
+        changes = await ubloxProfile.applyProfile(protocol, profile)
+        return changes, await ubloxProfile.applyProfile(protocol, profile, dryRun=True)
+    changes, remaining = run(emulator, session)
+    assert len(changes) == len(profile['CFG-MSG']) + 1
+    assert remaining == []
+    # NMEA is switched off on the chosen port only
+    for name, number in [('UART1', PORTID['UART1']), ('USB', PORTID['USB'])]:
+        masks = struct.unpack_from('<HH', emulator.ports[number], 12)
+        assert masks == ((0x05, 0x01) if name == port else (0x07, 0x03))
+    for name in profile['CFG-MSG']:
+        assert emulator.msgRates[CLIDPAIR[name]][PORTID[port]] == 1
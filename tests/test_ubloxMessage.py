@@ -0,0 +1,137 @@
+# Encoder and checksum regressions
+import random
+import struct
+
+import pytest
+
+from ubloxMessage import UbloxMessage, MSGFMT, CLIDPAIR, SYNC1, SYNC2, CHECKSUM_WINDOW
+
+# Block counts of the variable length messages
+BLOCK_COUNTS = [0, 1, 5]
+
+def oldBuildMessage(clid, length, payload):
+    # The encoder before buildMessageInto, for valid lengths
+    stream = struct.pack("<BBBBH", SYNC1, SYNC2, CLIDPAIR[clid][0], CLIDPAIR[clid][1], length)
+    if length > 0:
+        try:
+            fmt_base = [length] + MSGFMT[(clid,length)]
+            fmt_rep = [0, "", []]
+            payload_base = payload
+        except KeyError:
+            format = MSGFMT[(clid, None)]
+            fmt_base = format[:3]
+            fmt_rep = format[3:]
+            payload_base = payload[0]
+            payload_rep = payload[1:]
+        stream = stream + struct.pack(fmt_base[1], *[payload_base[i] for i in fmt_base[2]])
+        if fmt_rep[0] != 0:
+            for i in range(0, (length - fmt_base[0])//fmt_rep[0]):
+                stream = stream + struct.pack(fmt_rep[1], *[payload_rep[i][j] for j in fmt_rep[2]])
+    stream = stream + struct.pack("<BB", *UbloxMessage.checksum( stream[2:] ))
+    return stream
+
+def checksumLoop(msg):
+    ck_a = 0
+    ck_b = 0
+    for i in bytearray(msg):
+        ck_a = (ck_a + i) % 256
+        ck_b = (ck_b + ck_a) % 256
+    return (ck_a, ck_b)
+
+def fieldValues(fmt, fields, rng):
+    # Values of every field, from random bytes so that they fit the format
+    values = struct.unpack(fmt, bytes(rng.getrandbits(8) for i in range(struct.calcsize(fmt))))
+    return dict(zip(fields, values))
+
+def encoderCases():
+    rng = random.Random(0)
+    cases = []
+    for (clid, length), fmt in sorted(MSGFMT.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+        if length is not None:
+            cases.append((clid, length, fieldValues(fmt[0], fmt[1], rng)))
+            continue
+        baseSize, baseFmt, baseFields, repSize, repFmt, repFields = fmt
+        for numBlocks in BLOCK_COUNTS:
+            if (clid, baseSize + repSize * numBlocks) in MSGFMT:
+                # That length is encoded as the fixed message, e.g. the
+                # CFG-MSG poll of the current rate, so try a longer one
+                numBlocks += BLOCK_COUNTS[-1] + 1
+            packet = [fieldValues(baseFmt, baseFields, rng)] + [fieldValues(repFmt, repFields, rng) for i in range(numBlocks)]
+            cases.append((clid, baseSize + repSize * numBlocks, packet))
+    return cases
+
+ENCODER_CASES = encoderCases()
+
+def testEncoderCasesCoverMsgfmt():
+    fixed = sum(1 for clid, length in MSGFMT if length is not None)
+    variable = sum(1 for clid, length in MSGFMT if length is None)
+    assert len(ENCODER_CASES) == fixed + variable * len(BLOCK_COUNTS) == 127
+
+@pytest.mark.parametrize('clid, length, payload', ENCODER_CASES, ids=['{}-{}'.format(c[0], c[1]) for c in ENCODER_CASES])
+def testBuildMessageMatchesOldEncoder(clid, length, payload):
+    assert UbloxMessage.buildMessage(clid, length, payload) == oldBuildMessage(clid, length, payload)
+
+@pytest.mark.parametrize('clid, length, payload', ENCODER_CASES[::10])
+def testBuildMessageIntoBuffer(clid, length, payload):
+    frame = oldBuildMessage(clid, length, payload)
+    buf = bytearray(b'\xff' * (len(frame) + 20))
+    assert UbloxMessage.buildMessageInto(buf, 10, clid, length, payload) == 10 + len(frame)
+    assert bytes(buf[10:10+len(frame)]) == frame
+    assert buf[:10] == buf[10+len(frame):] == b'\xff' * 10
+    # The buffer is not left exported
+    buf += b'\0'
+
+def testBuildPolls():
+    for clid in ['MON-VER', 'CFG-PRT', 'NAV-PVT']:
+        assert UbloxMessage.buildMessage(clid, 0, []) == oldBuildMessage(clid, 0, [])
+
+def testBuildMessageRejectsWrongLengths():
+    baseSize, baseFmt, baseFields, repSize, repFmt, repFields = MSGFMT[('ESF-MEAS', None)]
+    packet = [fieldValues(baseFmt, baseFields, random.Random(0))]
+    # Not a whole number of blocks, and fewer bytes than the base section
+    assert UbloxMessage.buildMessage('ESF-MEAS', baseSize + 1, packet) is None
+    assert UbloxMessage.buildMessage('ESF-MEAS', baseSize - repSize, packet) is None
+
+@pytest.mark.parametrize('size', [0, 1, 2, 7, 72, 255, 256, 257, 1000, 4096, 65535])
+def testChecksum(size):
+    rng = random.Random(size)
+    msg = bytes(rng.getrandbits(8) for i in range(size))
+    expected = checksumLoop(msg)
+    assert UbloxMessage.checksum(msg) == expected
+    assert UbloxMessage.checksum(bytearray(msg)) == expected
+    assert UbloxMessage.checksum(memoryview(msg)) == expected
+
+def randomFrames(rng, size, count):
+    # A buffer of random bytes with frames at random offsets, a third of
+    # them with a valid checksum. Returns the buffer, starts and lengths.
+    buf = bytearray(rng.getrandbits(8) for i in range(size))
+    starts = []
+    lengths = []
+    for i in range(count):
+        length = rng.choice([0, 1, 8, 100, 1000, 65535]) if i % 10 == 0 else rng.randrange(200)
+        start = rng.randrange(len(buf) - length - 8)
+        if i % 3 == 0:
+            buf[start+length+6:start+length+8] = bytes(checksumLoop(buf[start+2:start+length+6]))
+        starts.append(start)
+        lengths.append(length)
+    return bytes(buf), starts, lengths
+
+def testChecksumFrames():
+    buf, starts, lengths = randomFrames(random.Random(1), 4 * CHECKSUM_WINDOW + 70000, 2000)
+    expected = [checksumLoop(buf[s+2:s+l+6]) == tuple(buf[s+l+6:s+l+8]) for s, l in zip(starts, lengths)]
+    assert any(expected) and not all(expected)
+    assert list(UbloxMessage.checksumFrames(buf, starts, lengths)) == expected
+    # Unsorted starts are answered in the given order
+    order = list(range(len(starts)))
+    random.Random(2).shuffle(order)
+    valid = UbloxMessage.checksumFrames(buf, [starts[i] for i in order], [lengths[i] for i in order])
+    assert list(valid) == [expected[i] for i in order]
+
+def testChecksumFramesEmpty():
+    assert len(UbloxMessage.checksumFrames(b'', [], [])) == 0
+
+def testMessageNameBySize():
+    # Messages that share a class and id are told apart by their length
+    assert UbloxMessage.messageName(*CLIDPAIR['MGA-GPS-EPH'], 68) == 'MGA-GPS-EPH'
+    assert UbloxMessage.messageName(*CLIDPAIR['MGA-GPS-ALM'], 36) == 'MGA-GPS-ALM'
+    assert UbloxMessage.messageName(*CLIDPAIR['NAV-SVINFO'], 8 + 12 * 3) == 'NAV-SVINFO'
@@ -0,0 +1,90 @@
+# Parser regressions
+import struct
+
+import pytest
+
+import ubloxNmea
+from ubloxEmulator import syntheticMessage, epochValues
+from ubloxMessage import UbloxMessage, CLIDPAIR, MSGFMT
+from ubx import Parser
+
+TYPES = ['NAV-PVT', 'NAV-POSECEF', 'NAV-SVINFO', 'HNR-PVT', 'ESF-MEAS', 'RXM-RAW', 'MON-VER']
+
+def nmea(body):
+    return '${}*{:02X}\r\n'.format(body, ubloxNmea.checksum(body)).encode('latin-1')
+
+def corruptChecksum(frame):
+    return frame[:-1] + bytes([frame[-1] ^ 0xff])
+
+def corpus():
+    # Frames of a few epochs with NMEA sentences, garbage, a bad checksum and
+    # a stray sync in between. Returns the data and the expected frames.
+    data = b''
+    frames = []
+    for epoch in range(3):
+        values = epochValues(epoch * 1000.0)
+        for ty in TYPES:
+            frame = syntheticMessage(ty, values)
+            data += frame
+            frames.append(frame)
+        data += nmea('GPGGA,,,,,,0,00,99.99,,,,,,')
+        data += b'\x00\xb5garbage$GP'
+        data += corruptChecksum(syntheticMessage('NAV-PVT', values))
+    return data, frames
+
+def parseAll(chunks, lazy=False):
+    # (type, packet) of every message and the frames of the raw subscriber
+    messages = []
+    frames = []
+    parser = Parser(lambda ty, packet: messages.append((ty, packet)), device=False, lazy=lazy)
+    parser.subscribe(lambda ty, frame: frames.append(frame), raw=True)
+    for chunk in chunks:
+        parser.parse(chunk)
+    return messages, frames
+
+def testParseFrames():
+    data, expected = corpus()
+    messages, frames = parseAll([data])
+    assert frames == expected
+    assert [ty for ty, packet in messages if not ty.startswith('$')] == \
+        [UbloxMessage.messageName(*struct.unpack_from('<BBH', frame, 2)) for frame in expected]
+    assert [ty for ty, packet in messages if ty.startswith('$')] == ['$GPGGA'] * 3
+
+@pytest.mark.parametrize('chunkSize', [1, 2, 7, 64, 1000])
+def testParseChunks(chunkSize):
+    # Frames split across parse calls are found as if parsed in one go
+    data, expected = corpus()
+    whole = parseAll([data])
+    assert parseAll([data[i:i+chunkSize] for i in range(0, len(data), chunkSize)]) == whole
+
+def testSubscribeTypes():
+    data, expected = corpus()
+    parser = Parser(None, device=False)
+    received = {'pvt': [], 'nav': [], 'raw': []}
+    parser.subscribe(lambda ty, packet: received['pvt'].append(ty), 'NAV-PVT')
+    parser.subscribe(lambda ty, packet: received['nav'].append(ty), ['NAV'])
+    parser.subscribe(lambda ty, frame: received['raw'].append((ty, frame)), [CLIDPAIR['RXM-RAW']], raw=True)
+    parser.parse(data)
+    assert received['pvt'] == ['NAV-PVT'] * 3
+    assert received['nav'] == ['NAV-PVT', 'NAV-POSECEF', 'NAV-SVINFO'] * 3
+    assert received['raw'] == [('RXM-RAW', frame) for frame in expected if frame[2:4] == bytes(CLIDPAIR['RXM-RAW'])]
+
+def testSubscribeByLength():
+    # MGA-GPS-EPH and MGA-GPS-ALM share a class and id
+    eph = UbloxMessage.buildMessage('MGA-GPS-EPH', 68, dict((k, 0) for k in MSGFMT[('MGA-GPS-EPH', 68)][1]))
+    alm = UbloxMessage.buildMessage('MGA-GPS-ALM', 36, dict((k, 0) for k in MSGFMT[('MGA-GPS-ALM', 36)][1]))
+    parser = Parser(None, device=False)
+    received = []
+    parser.subscribe(lambda ty, frame: received.append((ty, frame)), 'MGA-GPS-EPH', raw=True)
+    parser.parse(eph + alm + eph)
+    assert received == [('MGA-GPS-EPH', eph)] * 2
+
+def testLazyMessages():
+    data, expected = corpus()
+    messages, frames = parseAll([data])
+    lazyMessages, lazyFrames = parseAll([data], lazy=True)
+    assert lazyFrames == frames
+    decoded = dict((ty, packet) for ty, packet in messages)
+    lazy = dict((ty, packet) for ty, packet in lazyMessages)
+    assert lazy['NAV-PVT'].ITOW == decoded['NAV-PVT'][0]['ITOW'] == 2000
+    assert lazy['HNR-PVT'].ITOW == decoded['HNR-PVT'][0]['ITOW']
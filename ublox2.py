@@ -4,6 +4,7 @@ from ubloxMessage import UbloxMessage, CLIDPAIR
 import serial
 import serial.threaded
 import time
+import threading
 import traceback
 import logging
 
@@ -15,6 +16,7 @@ class UbloxReader(serial.threaded.Protocol):
         self.start = 0
         self.pollResult = None
         self.pollTarget = None
+        self.pollEvent = threading.Event()
 
     def connection_made(self, transport):
         super(UbloxReader, self).connection_made(transport)
@@ -54,6 +56,7 @@ class UbloxReader(serial.threaded.Protocol):
         if (self.pollTarget is not None) and (msgFormat in self.pollTarget):
             self.pollResult = (msgFormat, msgData)
             self.pollTarget = None
+            self.pollEvent.set()
         else:
             logging.debug('Ignoring {}\n'.format(msgFormat))
 
@@ -61,17 +64,14 @@ class UbloxReader(serial.threaded.Protocol):
         retries = 0
         while retries < maxRetries:        
             self.pollResult = None
+            self.pollEvent.clear()
             self.pollTarget = [msgFormat]
 
             logging.info('Polling for {} (attempt {})'.format(msgFormat, retries+1))
             self.sendMessage(ser, msgFormat, length, data)
 
-            startTime = time.time()
-            while self.pollResult is None:
-                time.sleep(0.01)
-                if (time.time() - startTime) > timeout:
-                    logging.warn('Timeout waiting for response!')
-                    break
+            if not self.pollEvent.wait(timeout):
+                logging.warn('Timeout waiting for response!')
 
             if self.pollResult is not None:
                 return self.pollResult
@@ -84,17 +84,14 @@ class UbloxReader(serial.threaded.Protocol):
         retries = 0
         while retries < maxRetries:
             self.pollResult = None
+            self.pollEvent.clear()
             self.pollTarget = ['ACK-ACK', 'ACK-NACK']
 
             logging.info('Sending config message {} (attempt {})'.format(msgFormat, retries+1))
             self.sendMessage(ser, msgFormat, length, data)
 
-            startTime = time.time()
-            while self.pollResult is None:
-                time.sleep(0.01)
-                if (time.time() - startTime) > timeout:
-                    logging.warn('Timeout waiting for ACK')
-                    break
+            if not self.pollEvent.wait(timeout):
+                logging.warn('Timeout waiting for ACK')
 
             if self.pollResult is not None:
                 if self.checkAck(self.pollResult[0], self.pollResult[1], msgFormat):
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# Batch decoding of UBX logs into numpy structured arrays
+#
+# decodeBuffer() and decodeFile() return a dictionary keyed like MSGFMT, i.e.
+# by (message name, size), with size None for variable length messages.
+#
+# For fixed length messages, the value is a structured array with one record
+# per message and one field per MSGFMT field name.
+#
+# For variable length messages, the value is a tuple (header, blocks, offsets).
+# header has one record per message, blocks has one record per repeated
+# section of all the messages, and the repeated sections of message i are
+# blocks[offsets[i]:offsets[i+1]].
+
+import os
+import re
+import struct
+import logging
+
+import numpy as np
+
+from ubloxMessage import UbloxMessage, MSGFMT, MSGSTRUCT_INV, SYNC1, SYNC2
+
+# Size of the sections the buffer is scanned in. Frames may extend up to
+# MAX_FRAME_SIZE bytes past the end of a section.
+SCAN_CHUNK_SIZE = 1 << 22
+MAX_FRAME_SIZE = 0xffff + 8
+
+STRUCT_TO_DTYPE = {
+    'c': 'S1',
+    'b': 'i1',
+    'B': 'u1',
+    '?': '?',
+    'h': '<i2',
+    'H': '<u2',
+    'i': '<i4',
+    'I': '<u4',
+    'l': '<i4',
+    'L': '<u4',
+    'q': '<i8',
+    'Q': '<u8',
+    'f': '<f4',
+    'd': '<f8',
+}
+
+def structToDtype(fmt, fields):
+    # Convert a little endian struct format and its field names to a numpy
+    # dtype with the same layout
+    names = []
+    formats = []
+    offsets = []
+    offset = 0
+    fields = iter(fields)
+    for count, code in re.findall(r'(\d*)([xcbB?hHiIlLqQfds])', fmt):
+        count = int(count) if count else 1
+        if code == 'x':
+            offset += count
+        elif code == 's':
+            names.append(next(fields))
+            formats.append('S{}'.format(count))
+            offsets.append(offset)
+            offset += count
+        else:
+            dtype = np.dtype(STRUCT_TO_DTYPE[code])
+            for i in range(count):
+                names.append(next(fields))
+                formats.append(dtype)
+                offsets.append(offset)
+                offset += dtype.itemsize
+    assert offset == struct.calcsize(fmt), 'Cannot convert struct format {}'.format(fmt)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': offset})
+
+# MSGDTYPE - numpy dtypes for each entry of MSGFMT. For variable length
+# messages, the value is a tuple of the header and repeated section dtypes.
+MSGDTYPE = {}
+for (clid, le), fmt in MSGFMT.items():
+    if le is not None:
+        MSGDTYPE[(clid, le)] = structToDtype(fmt[0], fmt[1])
+    else:
+        MSGDTYPE[(clid, le)] = (structToDtype(fmt[1], fmt[2]), structToDtype(fmt[4], fmt[5]))
+
+def findFrames(buf):
+    # Locate all valid UBX frames in buf. Returns arrays of the offsets of the
+    # sync bytes, the message classes, ids and payload lengths, in file order.
+    # A frame is accepted with the same rules as ubx.Parser: the first sync
+    # with a valid checksum after the end of the previous frame.
+    a = np.frombuffer(buf, dtype=np.uint8)
+    starts = []
+    nextStart = 0
+    for chunkStart in range(0, len(a), SCAN_CHUNK_SIZE):
+        chunk = a[chunkStart:chunkStart + SCAN_CHUNK_SIZE + MAX_FRAME_SIZE]
+        numCandidates = min(SCAN_CHUNK_SIZE, len(chunk) - 7)
+        if numCandidates <= 0:
+            break
+        candidates = np.flatnonzero((chunk[:numCandidates] == SYNC1) & (chunk[1:numCandidates+1] == SYNC2))
+        lengths = chunk[candidates+4].astype(np.int64) | (chunk[candidates+5].astype(np.int64) << 8)
+        complete = candidates + lengths + 8 <= len(chunk)
+        candidates = candidates[complete]
+        lengths = lengths[complete]
+        valid = UbloxMessage.checksumFrames(chunk, candidates, lengths)
+        candidates = candidates[valid] + chunkStart
+        ends = candidates + lengths[valid] + 8
+
+        # Drop frames that start inside a previously accepted frame
+        for start, end in zip(candidates.tolist(), ends.tolist()):
+            if start >= nextStart:
+                starts.append(start)
+                nextStart = end
+
+    starts = np.array(starts, dtype=np.int64)
+    classes = a[starts+2]
+    ids = a[starts+3]
+    lengths = a[starts+4].astype(np.int64) | (a[starts+5].astype(np.int64) << 8)
+    return starts, classes, ids, lengths
+
+def gather(a, offsets, size, dtype, rowsPerStep=1 << 16):
+    # Copy size bytes at each of offsets into a structured array. This is done
+    # in steps to bound the size of the temporary index array.
+    output = np.zeros(len(offsets), dtype=dtype)
+    if size == 0:
+        return output
+    rows = output.view(np.uint8).reshape(len(offsets), size)
+    columns = np.arange(size)
+    for i in range(0, len(offsets), rowsPerStep):
+        rows[i:i+rowsPerStep] = a[offsets[i:i+rowsPerStep, np.newaxis] + columns]
+    return output
+
+def decodeBuffer(buf, types=None):
+    # Decode all known messages of buf. If types is given, only messages with
+    # these names are decoded.
+    a = np.frombuffer(buf, dtype=np.uint8)
+    starts, classes, ids, lengths = findFrames(buf)
+    codes = (classes.astype(np.int64) << 24) | (ids.astype(np.int64) << 16) | lengths
+
+    output = {}
+    for code in np.unique(codes):
+        cl, id, length = int(code >> 24), int((code >> 16) & 0xff), int(code & 0xffff)
+        if length == 0:
+            continue
+        payloads = starts[codes == code] + 6
+
+        msgStruct = MSGSTRUCT_INV.get((cl, id, length))
+        if msgStruct is not None:
+            clid = msgStruct[0]
+            if types is None or clid in types:
+                output[(clid, length)] = gather(a, payloads, length, MSGDTYPE[(clid, length)])
+            continue
+
+        msgStruct = MSGSTRUCT_INV.get((cl, id, None))
+        if msgStruct is None:
+            logging.info("Unknown message class 0x%x, id 0x%x, length %i" % (cl, id, length))
+            continue
+        clid, baseStruct, baseFields, repStruct, repFields = msgStruct
+        if types is not None and clid not in types:
+            continue
+        if length < baseStruct.size or (length - baseStruct.size) % repStruct.size != 0:
+            logging.error("Variable length message class 0x%x, id 0x%x has wrong length %i" % (cl, id, length))
+            continue
+        output.setdefault((clid, None), []).append((payloads, (length - baseStruct.size) // repStruct.size))
+
+    # Variable length messages of different lengths were grouped separately,
+    # so merge them back into file order
+    for key, groups in list(output.items()):
+        if key[1] is not None:
+            continue
+        baseDtype, repDtype = MSGDTYPE[key]
+        payloads = np.concatenate([p for p, n in groups])
+        counts = np.concatenate([np.full(len(p), n, dtype=np.int64) for p, n in groups])
+        order = np.argsort(payloads, kind='stable')
+        payloads = payloads[order]
+        counts = counts[order]
+
+        offsets = np.zeros(len(payloads) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        firstBlock = np.repeat(payloads + baseDtype.itemsize, counts)
+        blockIndex = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+        header = gather(a, payloads, baseDtype.itemsize, baseDtype)
+        blocks = gather(a, firstBlock + blockIndex * repDtype.itemsize, repDtype.itemsize, repDtype)
+        output[key] = (header, blocks, offsets)
+
+    return output
+
+def decodeFile(filename, types=None):
+    # The file is memory mapped, so only the decoded arrays are held in memory
+    if os.path.getsize(filename) == 0:
+        return {}
+    buf = np.memmap(filename, dtype=np.uint8, mode='r')
+    return decodeBuffer(buf, types)
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', help='UBX file to decode')
+    parser.add_argument('--types', '-t', nargs='+', default=None, help='Message types to decode, e.g. HNR-PVT')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    startTime = time.time()
+    output = decodeFile(args.file, args.types)
+    elapsed = time.time() - startTime
+
+    for key in sorted(output.keys(), key=str):
+        value = output[key]
+        if key[1] is None:
+            print('{}: {} ({} blocks)'.format(key[0], len(value[0]), len(value[1])))
+        else:
+            print('{}: {}'.format(key[0], len(value)))
+    print('Decoded in {:.3f} s'.format(elapsed))
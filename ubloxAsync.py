@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# asyncio transport for u-blox receivers
+#
+# UbloxProtocol is an asyncio.Protocol that frames and decodes the received
+# data with ubx.Parser and calls callback(ty, packet) for each message, like
+# ubx.Parser. poll() and sendConfig() are coroutines with the same behavior
+# as ublox.Ublox.poll and ublox.Ublox.sendConfig, except that several of them
+# can be in flight at once. Responses are matched to requests by message type,
+# by ClsID/MsgID for ACK-ACK and ACK-NACK, and by port or message for CFG-PRT
+# and CFG-MSG.
+#
+# openDevice() connects a protocol to a serial device and
+# loop.create_connection() to a TCP socket, so a single event loop can service
+# several receivers.
+
+import os
+import asyncio
+import logging
+import collections
+
+import ubx
+from ubloxMessage import UbloxMessage, CLIDPAIR
+
+# Maximum number of requests awaiting a response at the same time, so that
+# bulk configuration does not overflow the receiver's input buffer
+MAX_OUTSTANDING = 8
+
+def requestKey(messageType, length, payload):
+    # Key of the response to a poll. CFG-PRT and CFG-MSG polls for a given
+    # port or message are answered with that port or message.
+    if messageType == 'CFG-PRT' and length == 1:
+        return ('CFG-PRT', payload['PortID'])
+    if messageType == 'CFG-MSG' and length == 2:
+        return ('CFG-MSG', payload['msgClass'], payload['msgId'])
+    return (messageType,)
+
+def responseKeys(ty, packet):
+    # Keys of the requests a message may answer, most specific first
+    if ty in ('ACK-ACK', 'ACK-NACK'):
+        return [('ACK', packet[0]['ClsID'], packet[0]['MsgID'])]
+    if ty == 'CFG-PRT' and len(packet) > 1:
+        return [('CFG-PRT', packet[1]['PortID']), (ty,)]
+    if ty == 'CFG-MSG':
+        return [('CFG-MSG', packet[0]['msgClass'], packet[0]['msgId']), (ty,)]
+    return [(ty,)]
+
+class UbloxProtocol(asyncio.Protocol):
+    def __init__(self, callback=None, rawCallback=None, maxOutstanding=MAX_OUTSTANDING):
+        self.callback = callback
+        self.rawCallback = rawCallback
+        self.parser = ubx.Parser(self._handleMessage, device=False)
+        self.transport = None
+        self.writer = None
+        self.waiters = {}
+        self.maxOutstanding = maxOutstanding
+        self.outstanding = None
+        self.closed = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.outstanding = asyncio.Semaphore(self.maxOutstanding)
+        self.closed = asyncio.get_running_loop().create_future()
+        logging.debug('Connection made')
+
+    def connection_lost(self, exc):
+        logging.debug('Connection lost: {}'.format(exc))
+        for futures in self.waiters.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(exc if exc is not None else ConnectionError('Connection lost'))
+        self.waiters = {}
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    def data_received(self, data):
+        if self.rawCallback is not None:
+            self.rawCallback(data)
+        self.parser.parse(data)
+
+    def _handleMessage(self, ty, packet):
+        logging.debug("Received %s %r", ty, packet)
+        # Requests with the same key are answered in the order they were sent
+        for key in responseKeys(ty, packet):
+            futures = self.waiters.get(key)
+            if futures:
+                future = futures.popleft()
+                if not futures:
+                    del self.waiters[key]
+                future.set_result((ty, packet))
+                break
+        if self.callback is not None:
+            self.callback(ty, packet)
+
+    def wait(self, key):
+        # Future for the next message answering a request with this key
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(key, collections.deque()).append(future)
+        return future
+
+    def cancelWait(self, key, future):
+        futures = self.waiters.get(key)
+        if futures and future in futures:
+            futures.remove(future)
+            if not futures:
+                del self.waiters[key]
+
+    def sendraw(self, data):
+        (self.writer or self.transport).write(data)
+
+    def send(self, clid, length, payload):
+        logging.debug("Sending UBX packet of type %s: %s" % (clid, payload))
+        self.sendraw(UbloxMessage.buildMessage(clid, length, payload))
+
+    async def request(self, key, messageType, length, payload, maxRetries=5, timeout=0.1):
+        # Send a message and wait for the response with the given key,
+        # resending it on timeout. Returns (type, packet) or None.
+        async with self.outstanding:
+            for retries in range(maxRetries):
+                future = self.wait(key)
+                self.send(messageType, length, payload)
+                try:
+                    return await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    self.cancelWait(key, future)
+                    logging.info('{}: retries: {}'.format(messageType, retries + 1))
+        return None
+
+    async def poll(self, messageType, length=0, payload=[], maxRetries=5, timeout=0.1):
+        logging.info('Polling for {}...'.format(messageType))
+        response = await self.request(requestKey(messageType, length, payload), messageType, length, payload, maxRetries, timeout)
+        if response is None:
+            return None
+        return response[1]
+
+    async def sendConfig(self, messageType, length, payload, maxRetries=5, timeout=0.1):
+        logging.info('Sending {}...'.format(messageType))
+        clsId, msgId = CLIDPAIR[messageType]
+        response = await self.request(('ACK', clsId, msgId), messageType, length, payload, maxRetries, timeout)
+        if response is None:
+            return None
+
+        ty, packet = response
+        if ty == 'ACK-NACK':
+            raise Exception('ublox receiver responded with {}!'.format(ty))
+
+        logging.info('Config message acknowledged by ublox.')
+        return packet
+
+    async def pollMany(self, requests, **kwargs):
+        # Poll for several messages at once. requests is a list of
+        # (messageType, length, payload); returns the packets in order.
+        return await asyncio.gather(*[self.poll(*request, **kwargs) for request in requests])
+
+    async def sendConfigMany(self, messages, **kwargs):
+        # Send several config messages at once. messages is a list of
+        # (messageType, length, payload); returns the ACK packets in order.
+        return await asyncio.gather(*[self.sendConfig(*message, **kwargs) for message in messages])
+
+async def openDevice(device, baudRate=None, callback=None, rawCallback=None, protocolFactory=UbloxProtocol):
+    # Open a serial device without blocking and connect a protocol to it.
+    # Reads and writes go through separate pipe transports on the same tty.
+    loop = asyncio.get_running_loop()
+    fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    ubx.configureTty(fd, baudRate)
+    protocol = protocolFactory(callback, rawCallback)
+    await loop.connect_read_pipe(lambda: protocol, os.fdopen(fd, 'rb', buffering=0))
+    protocol.writer, _ = await loop.connect_write_pipe(asyncio.Protocol, os.fdopen(os.dup(fd), 'wb', buffering=0))
+    return protocol
+
+def closeDevice(protocol):
+    if protocol.writer is not None:
+        protocol.writer.close()
+    protocol.transport.close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', '-d', action='append', required=True, help='Serial device of a receiver. May be given several times.')
+    parser.add_argument('--baudRate', '-r', type=int, default=None)
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    async def monitor(device):
+        def callback(ty, packet):
+            print('{}: {}'.format(device, ty))
+
+        protocol = await openDevice(device, args.baudRate, callback=callback)
+        packet = await protocol.poll('MON-VER')
+        if packet is not None:
+            UbloxMessage.printMessage('MON-VER', packet, header='{}: '.format(device))
+        await protocol.closed
+
+    async def main():
+        await asyncio.gather(*[monitor(device) for device in args.device])
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
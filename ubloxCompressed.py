@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# Compressed, seekable UBX files (.ubz)
+#
+# The data is split into blocks of about blockSize bytes, each compressed on
+# its own. Blocks are cut before a UBX frame, so each block can be
+# decompressed and parsed without the others; only data with no UBX frame in
+# twice blockSize (e.g. NMEA only) is cut anywhere. The file is:
+#
+#   file header   FILE_HEADER (magic, codec name, block size)
+#   blocks        BLOCK_HEADER (magic, compressed size, size, first ITOW),
+#                 followed by the compressed data
+#   index         INDEX_ENTRY for each block
+#   footer        FOOTER (index offset, number of blocks, magic)
+#
+# The first ITOW of a block is that of the first NAV or HNR message in it
+# that carries one (NO_ITOW if there is none), which allows selecting blocks
+# by time of week. ITOWs going back by more than half a week are week
+# rollovers, as in ubloxTimeIndex. If the footer is missing, e.g. after a
+# power failure during a capture, the index is rebuilt from the block
+# headers.
+#
+# zlib is always available. zstd and lz4 are used if the zstandard and lz4
+# packages are installed.
+
+import os
+import zlib
+import struct
+import logging
+import bisect
+import collections
+
+from ubloxMessage import UbloxMessage, ITOW_MESSAGES, SYNC1, SYNC2
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+EXTENSION = '.ubz'
+FILE_MAGIC = b'UBXZ0001'
+BLOCK_MAGIC = b'UBZB'
+FOOTER_MAGIC = b'UBZINDEX'
+# Magic, codec name, block size
+FILE_HEADER = struct.Struct('<8s8sI')
+# Magic, compressed size, uncompressed size, first ITOW
+BLOCK_HEADER = struct.Struct('<4sIII')
+# Offset of the block header in the file, uncompressed offset, compressed
+# size, uncompressed size, first ITOW
+INDEX_ENTRY = struct.Struct('<QQIII')
+# Index offset, number of blocks, magic
+FOOTER = struct.Struct('<QQ8s')
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+NO_ITOW = 0xffffffff
+# Decompressed blocks kept in memory by CompressedFile
+DEFAULT_CACHE_BLOCKS = 4
+
+WEEK_MS = 7 * 24 * 3600 * 1000
+
+SYNC = bytes(bytearray([SYNC1, SYNC2]))
+
+def _codecs():
+    codecs = {'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress)}
+    if zstandard is not None:
+        codecs['zstd'] = (zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress)
+    if lz4 is not None:
+        codecs['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+    return codecs
+
+CODECS = _codecs()
+DEFAULT_CODEC = 'zstd' if 'zstd' in CODECS else 'zlib'
+
+def isCompressed(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(FILE_MAGIC)) == FILE_MAGIC
+
+def frameEnds(data, offset=0):
+    # Generator of (start, end, class, id) of the valid UBX frames in data,
+    # with the same rules as ubx.Parser
+    view = memoryview(data)
+    try:
+        while True:
+            start = data.find(SYNC, offset)
+            if start == -1 or start + 8 > len(data):
+                return
+            (cl, id, length) = struct.unpack_from('<BBH', data, start+2)
+            end = start + length + 8
+            if end <= len(data) and \
+                    UbloxMessage.checksum(view[start+2:end-2]) == struct.unpack_from('<BB', data, end-2):
+                yield start, end, cl, id
+                offset = end
+            else:
+                offset = start + 2
+    finally:
+        view.release()
+
+def firstItow(data):
+    # ITOW of the first NAV or HNR message that starts with one
+    for start, end, cl, id in frameEnds(data):
+        if (cl, id) in ITOW_MESSAGES and end - start >= 12:
+            return struct.unpack_from('<I', data, start+6)[0]
+    return NO_ITOW
+
+class CompressedWriter(object):
+    def __init__(self, file, codec=DEFAULT_CODEC, blockSize=DEFAULT_BLOCK_SIZE):
+        # file is a filename or a file object opened for binary writing
+        if codec not in CODECS:
+            raise ValueError('Codec {} is not available, use one of {}'.format(codec, ', '.join(sorted(CODECS))))
+        self.file = open(file, 'wb') if isinstance(file, str) else file
+        self.compress = CODECS[codec][0]
+        self.blockSize = blockSize
+        self.buffer = bytearray()
+        self.index = []
+        self.offset = FILE_HEADER.size
+        self.size = 0
+        self.compressedSize = 0
+        self.file.write(FILE_HEADER.pack(FILE_MAGIC, codec.encode(), blockSize))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.blockSize:
+            # Cut the block before the first frame past blockSize, so frames
+            # do not straddle blocks
+            cut = -1
+            for start, end, cl, id in frameEnds(self.buffer, self.blockSize):
+                cut = start
+                break
+            if cut == -1:
+                if len(self.buffer) < 2 * self.blockSize:
+                    break
+                cut = len(self.buffer)
+            self.writeBlock(bytes(self.buffer[:cut]))
+            del self.buffer[:cut]
+        return len(data)
+
+    def writeBlock(self, data):
+        compressed = self.compress(data)
+        itow = firstItow(data)
+        self.file.write(BLOCK_HEADER.pack(BLOCK_MAGIC, len(compressed), len(data), itow))
+        self.file.write(compressed)
+        self.index.append((self.offset, self.size, len(compressed), len(data), itow))
+        self.offset += BLOCK_HEADER.size + len(compressed)
+        self.size += len(data)
+        self.compressedSize += len(compressed)
+
+    def flush(self):
+        # Flush the blocks written so far. Buffered data is kept until a
+        # block can be cut before a frame, so this does not cut a block.
+        self.file.flush()
+
+    def finish(self):
+        # Write the remaining data and the index, without closing the file
+        if self.buffer:
+            self.writeBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+        for entry in self.index:
+            self.file.write(INDEX_ENTRY.pack(*entry))
+        self.file.write(FOOTER.pack(self.offset, len(self.index), FOOTER_MAGIC))
+        self.file.flush()
+
+    def close(self):
+        self.finish()
+        self.file.close()
+
+class CompressedFile(object):
+    def __init__(self, filename, cacheBlocks=DEFAULT_CACHE_BLOCKS):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        magic, codec, self.blockSize = FILE_HEADER.unpack(self.file.read(FILE_HEADER.size))
+        if magic != FILE_MAGIC:
+            raise ValueError('{} is not a compressed UBX file'.format(filename))
+        codec = codec.rstrip(b'\0').decode()
+        if codec not in CODECS:
+            raise ValueError('{} is compressed with {}, which is not available'.format(filename, codec))
+        self.decompress = CODECS[codec][1]
+        self.index = self.readIndex()
+        self.offsets = [entry[1] for entry in self.index]
+        self.size = self.index[-1][1] + self.index[-1][3] if self.index else 0
+        self.times = self.blockTimes()
+        # Block number -> decompressed data, least recently used first
+        self.cache = collections.OrderedDict()
+        self.cacheBlocks = cacheBlocks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def readIndex(self):
+        fileSize = os.fstat(self.file.fileno()).st_size
+        if fileSize >= FILE_HEADER.size + FOOTER.size:
+            self.file.seek(fileSize - FOOTER.size)
+            indexOffset, count, magic = FOOTER.unpack(self.file.read(FOOTER.size))
+            if magic == FOOTER_MAGIC and indexOffset + count * INDEX_ENTRY.size + FOOTER.size == fileSize:
+                self.file.seek(indexOffset)
+                data = self.file.read(count * INDEX_ENTRY.size)
+                return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(count)]
+
+        logging.info('{} has no index, reading block headers'.format(self.filename))
+        index = []
+        offset = FILE_HEADER.size
+        size = 0
+        while offset + BLOCK_HEADER.size <= fileSize:
+            self.file.seek(offset)
+            magic, compressedSize, blockSize, itow = BLOCK_HEADER.unpack(self.file.read(BLOCK_HEADER.size))
+            if magic != BLOCK_MAGIC or offset + BLOCK_HEADER.size + compressedSize > fileSize:
+                break
+            index.append((offset, size, compressedSize, blockSize, itow))
+            offset += BLOCK_HEADER.size + compressedSize
+            size += blockSize
+        return index
+
+    def blockTimes(self):
+        # Time of each block in ms from the start of the week of the first
+        # one, counting week rollovers. Blocks without an ITOW get the time
+        # of the previous block, and the times never decrease, so that they
+        # can be bisected.
+        times = []
+        week = 0
+        lastItow = None
+        t = -1
+        for entry in self.index:
+            itow = entry[4]
+            if itow != NO_ITOW and itow < WEEK_MS:
+                if lastItow is not None and itow < lastItow - WEEK_MS // 2:
+                    week += 1
+                lastItow = itow
+                t = max(t, week * WEEK_MS + itow)
+            times.append(t)
+        return times
+
+    def block(self, i):
+        # Decompressed data of block i. The last cacheBlocks blocks read are
+        # cached.
+        data = self.cache.get(i)
+        if data is not None:
+            self.cache.move_to_end(i)
+            return data
+        offset, start, compressedSize, size, itow = self.index[i]
+        self.file.seek(offset + BLOCK_HEADER.size)
+        data = self.decompress(self.file.read(compressedSize))
+        self.cache[i] = data
+        if len(self.cache) > self.cacheBlocks:
+            self.cache.popitem(last=False)
+        return data
+
+    def blockAt(self, offset):
+        # Block containing an uncompressed offset
+        return max(bisect.bisect_right(self.offsets, offset) - 1, 0)
+
+    def read(self, offset, size):
+        # Read uncompressed data, decompressing only the blocks it spans
+        output = bytearray()
+        i = self.blockAt(offset)
+        while size > 0 and i < len(self.index):
+            data = self.block(i)
+            begin = offset - self.index[i][1]
+            chunk = data[begin:begin+size]
+            output += chunk
+            offset += len(chunk)
+            size -= len(chunk)
+            i += 1
+        return bytes(output)
+
+    def blockTime(self, itow):
+        # Time of an ITOW on the scale of blockTimes: in the week of the first
+        # block with an ITOW, or the next one if it is earlier in the week
+        first = next((t for t in self.times if t >= 0), None)
+        if first is None:
+            return itow
+        return (first // WEEK_MS + (1 if itow < first % WEEK_MS else 0)) * WEEK_MS + itow
+
+    def blocksForTime(self, startItow=None, endItow=None):
+        # Blocks that may hold messages with startItow <= ITOW < endItow. The
+        # block before the first one starting at startItow is included, since
+        # an epoch may straddle blocks.
+        first = 0
+        last = len(self.index)
+        if startItow is not None:
+            first = max(bisect.bisect_left(self.times, self.blockTime(startItow)) - 1, 0)
+        if endItow is not None:
+            last = max(bisect.bisect_right(self.times, self.blockTime(endItow)), first)
+        return range(first, last)
+
+    def iterBlocks(self, blocks=None):
+        # Generator of (uncompressed offset, data) of blocks
+        for i in (range(len(self.index)) if blocks is None else blocks):
+            yield self.index[i][1], self.block(i)
+
+    def messages(self, types=None, startItow=None, endItow=None, lazy=False):
+        # Generator of (message type, packet), optionally only from the
+        # blocks covering a range of time of week
+        decode = UbloxMessage.decodeLazy if lazy else UbloxMessage.decode
+        remainder = b''
+        previous = None
+        for i in self.blocksForTime(startItow, endItow):
+            data = self.block(i)
+            if previous == i - 1:
+                data = remainder + data
+            previous = i
+            consumed = 0
+            for start, end, cl, id in frameEnds(data):
+                consumed = end
+                if end - start == 8:
+                    continue
+                try:
+                    ty, packet = decode(cl, id, end - start - 8, data[start+6:end-2])
+                except ValueError:
+                    continue
+                if types is None or ty in types:
+                    yield ty, packet
+            remainder = data[consumed:]
+
+def compressFile(input, output, codec=DEFAULT_CODEC, blockSize=DEFAULT_BLOCK_SIZE):
+    with open(input, 'rb') as f, CompressedWriter(output, codec, blockSize) as writer:
+        while True:
+            data = f.read(blockSize)
+            if not data:
+                break
+            writer.write(data)
+    return writer
+
+def decompressFile(input, output):
+    with CompressedFile(input) as f, open(output, 'wb') as out:
+        for offset, data in f.iterBlocks():
+            out.write(data)
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help='UBX file to compress, or .ubz file to decompress')
+    parser.add_argument('output', nargs='?', default=None)
+    parser.add_argument('--codec', '-c', choices=sorted(CODECS.keys()), default=DEFAULT_CODEC)
+    parser.add_argument('--blockSize', type=int, default=DEFAULT_BLOCK_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    startTime = time.time()
+    if isCompressed(args.input):
+        output = args.output or os.path.splitext(args.input)[0] + '.ubx'
+        decompressFile(args.input, output)
+        print('Decompressed {} to {} in {:.3f} s'.format(args.input, output, time.time() - startTime))
+    else:
+        output = args.output or os.path.splitext(args.input)[0] + EXTENSION
+        writer = compressFile(args.input, output, args.codec, args.blockSize)
+        print('Compressed {:.1f} MB to {:.1f} MB ({:.1f}x) in {:.3f} s'.format(writer.size / 1e6, writer.offset / 1e6,
+              writer.size / max(writer.offset, 1), time.time() - startTime))
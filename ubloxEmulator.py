@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+# Emulated u-blox receiver on a pseudo-terminal
+#
+# ReceiverEmulator opens a pty and behaves like a receiver connected to its
+# UART1 port. device is the path of the slave end, which can be used in place
+# of a serial port by ubx.Parser, ubloxAsync.openDevice and the scripts. The
+# emulator
+#
+# - answers polls of CFG messages with its configuration, and polls of the
+#   other messages of MSGFMT with synthetic content,
+# - ACKs config messages and keeps them, so that later polls return them.
+#   CFG-PRT, CFG-MSG, CFG-RATE and CFG-HNR take effect, other CFG messages
+#   are only stored. Malformed ones are NACKed. CFG-RST is not ACKed and
+#   pauses the output for RESET_TIME.
+# - outputs the messages enabled with CFG-MSG on UART1 every CFG-RATE
+#   navigation epoch, or every CFG-HNR epoch for HNR and high rate ESF
+#   messages,
+# - carries at most baudRate / 10 bytes per second in each direction,
+#   delays responses by latency seconds, and drops messages when its TX
+#   buffer is full, as a receiver does when too much output is enabled,
+# - only understands the host while the tty is set to its baud rate, which
+#   CFG-PRT changes for UART1 after the ACK, as on a receiver.
+#
+# Everything runs in one background thread. Counters are kept in stats.
+
+import os
+import pty
+import time
+import heapq
+import struct
+import select
+import logging
+import threading
+import collections
+
+import ubx
+from ubloxMessage import UbloxMessage, MSGFMT, CLIDPAIR, CLIDPAIR_INV, PORTID, SYNC1, SYNC2
+from ubloxTransmit import ttyBaudRate, BITS_PER_BYTE
+from ubloxTimeIndex import WEEK_MS, GPS_EPOCH
+
+DEFAULT_BAUD_RATE = 9600
+DEFAULT_TX_BUFFER_SIZE = 4096
+# Bytes a line can carry at once after being idle, and the least bytes moved
+# per wake-up while it is busy
+LINE_BURST = 64
+LINE_CHUNK = 16
+# Longest sleep of the thread, so that close() is noticed
+MAX_WAIT = 0.05
+# Epochs later than this many seconds are skipped instead of caught up
+MAX_LAG = 1.0
+RESET_TIME = 0.5
+LEAP_SECONDS = 18
+NUM_PORTS = 6
+UART1 = PORTID['UART1']
+
+CFG_CLASS = CLIDPAIR['CFG-MSG'][0]
+ACK_ACK = CLIDPAIR['ACK-ACK']
+ACK_NACK = CLIDPAIR['ACK-NACK']
+# Messages output every HNR epoch instead of every navigation epoch
+HNR_CLASS = CLIDPAIR['HNR-PVT'][0]
+HNR_RATE_TYPES = frozenset([CLIDPAIR['ESF-MEAS'], CLIDPAIR['ESF-RAW'], CLIDPAIR['ESF-INS']])
+
+# Length of the messages output by the emulator: the variable length format
+# if there is one, otherwise the longest fixed one (the shorter ones are
+# polls)
+def _outputLength(ty):
+    lengths = [length for (clid, length) in MSGFMT if clid == ty]
+    return None if None in lengths else max(lengths)
+
+OUTPUT_LENGTHS = dict((clid, _outputLength(clid)) for (clid, length) in MSGFMT)
+
+# Repeated sections of variable length messages, and the header fields that
+# count them
+NUM_BLOCKS = {'NAV-SVINFO': 12, 'RXM-RAW': 12, 'RXM-SVSI': 12, 'ESF-MEAS': 4, 'ESF-STATUS': 4, 'ESF-RAW': 4}
+COUNT_FIELDS = frozenset(['NCH', 'NSV', 'NumSv', 'NumVis', 'NumSens', 'CNT'])
+# Sensor data types of the ESF blocks: gyro z, accelerometer x, y and z
+ESF_DATA_TYPES = [5, 16, 17, 18]
+
+# Fixed solution reported in the synthetic messages
+FIX_VALUES = {'FixType': 3, 'GPSfix': 3, 'GPSFix': 3, 'Flags': 0x01, 'NumSV': 12, 'numSV': 12,
+              'LAT': 404433000, 'LON': -799436000, 'HEIGHT': 300000, 'HMSL': 330000, 'Hacc': 1500, 'Vacc': 2500,
+              'Pacc': 200, 'SAcc': 300, 'TAcc': 20, 'GDOP': 180, 'PDOP': 150, 'TDOP': 90, 'VDOP': 120,
+              'HDOP': 90, 'NDOP': 60, 'EDOP': 60, 'FusionMode': 1, 'LeapS': LEAP_SECONDS, 'Valid': 0x07}
+
+MON_VER = [{'SWVersion': b'EMULATOR 1.00', 'HWVersion': b'00080000'}, {'Extension': b'PROTVER=19.00'}]
+
+def frame(cl, id, payload=b''):
+    # UBX frame of a raw payload
+    header = struct.pack('<BBBBH', SYNC1, SYNC2, cl, id, len(payload))
+    body = header[2:] + bytes(payload)
+    return header[:2] + body + bytes(bytearray(UbloxMessage.checksum(body)))
+
+def _fill(fmt, fields, values):
+    # Dict of the fields of a section, zero except for those in values
+    packet = dict(zip(fields, struct.unpack(fmt, bytes(struct.calcsize(fmt)))))
+    for field in fields:
+        if field in values:
+            packet[field] = values[field]
+    return packet
+
+def epochValues(gpsTime):
+    # Field values of the synthetic messages at a GPS time in ms
+    week, itow = divmod(int(gpsTime), WEEK_MS)
+    utc = time.gmtime(GPS_EPOCH + gpsTime / 1000.0 - LEAP_SECONDS)
+    values = dict(FIX_VALUES)
+    values.update({'ITOW': itow, 'week': week, 'Week': week, 'Year': utc.tm_year, 'Month': utc.tm_mon,
+                   'Day': utc.tm_mday, 'Hour': utc.tm_hour, 'Min': utc.tm_min, 'Minute': utc.tm_min,
+                   'Sec': utc.tm_sec, 'Second': utc.tm_sec, 'Nano': int(gpsTime % 1000) * 1000000})
+    return values
+
+def blockValues(ty, i):
+    # Field values of repeated section i of a synthetic message
+    values = {'chn': i, 'SVID': i + 1, 'SV': i + 1, 'Flags': 0x0d, 'QI': 7, 'MesQI': 7, 'CNO': 30 + i,
+              'Elev': 10 + 6 * i, 'Azim': 30 * i}
+    if ty.startswith('ESF'):
+        dataType = ESF_DATA_TYPES[i % len(ESF_DATA_TYPES)]
+        values.update({'Data': dataType << 24, 'SensStatus1': dataType, 'Flags': 0})
+    return values
+
+def syntheticMessage(ty, values):
+    # Frame of a message type with the given header field values, or None
+    # if it has no format
+    if ty == 'MON-VER':
+        return UbloxMessage.buildMessage(ty, 70, MON_VER)
+    if ty not in OUTPUT_LENGTHS:
+        return None
+    length = OUTPUT_LENGTHS[ty]
+    if length is not None:
+        fmt, fields = MSGFMT[(ty, length)]
+        return UbloxMessage.buildMessage(ty, length, _fill(fmt, fields, values))
+
+    headerSize, headerFmt, headerFields, blockSize, blockFmt, blockFields = MSGFMT[(ty, None)]
+    numBlocks = NUM_BLOCKS.get(ty, 0)
+    header = _fill(headerFmt, headerFields, values)
+    for field in COUNT_FIELDS.intersection(headerFields):
+        header[field] = numBlocks
+    if ty == 'ESF-MEAS':
+        header['Flags'] = numBlocks << 11
+    packet = [header] + [_fill(blockFmt, blockFields, blockValues(ty, i)) for i in range(numBlocks)]
+    return UbloxMessage.buildMessage(ty, headerSize + blockSize * numBlocks, packet)
+
+def portBlock(port, baudRate):
+    # CFG-PRT payload of a port: 8N1 UARTs, UBX and NMEA output
+    mode = 0x08d0 if port in (PORTID['UART1'], PORTID['UART2']) else 0
+    return struct.pack('<BxHIIHHHxx', port, 0, mode, baudRate if mode else 0, 0x07, 0x03, 0)
+
+def defaultGnss():
+    # CFG-GNSS payload with GPS, SBAS, Galileo, QZSS and GLONASS enabled
+    blocks = [(0, 8, 16, 0x010001), (1, 1, 3, 0x010001), (2, 4, 8, 0x010001), (3, 8, 16, 0x010000),
+              (5, 0, 3, 0x050001), (6, 8, 14, 0x010001)]
+    return struct.pack('<BBBB', 0, 32, 32, len(blocks)) + \
+        b''.join(struct.pack('<BBBBI', gnssId, resTrkCh, maxTrkCh, 0, flags) for gnssId, resTrkCh, maxTrkCh, flags in blocks)
+
+class LineRate(object):
+    # Bytes a UART can carry, accumulated over time up to LINE_BURST
+    def __init__(self, baudRate):
+        self.setBaudRate(baudRate)
+
+    def setBaudRate(self, baudRate):
+        self.bytesPerSecond = float(baudRate) / BITS_PER_BYTE
+        self.credit = 0.0
+        self.last = time.monotonic()
+
+    def available(self, now):
+        self.credit = min(LINE_BURST, self.credit + (now - self.last) * self.bytesPerSecond)
+        self.last = now
+        return int(self.credit)
+
+    def spend(self, size):
+        self.credit -= size
+
+    def delay(self, size):
+        # Seconds until size bytes (at most LINE_BURST) can be carried
+        return max(0.0, (min(size, LINE_BURST) - self.credit) / self.bytesPerSecond)
+
+class ReceiverEmulator(object):
+    def __init__(self, baudRate=DEFAULT_BAUD_RATE, latency=0.0, rates=None, txBufferSize=DEFAULT_TX_BUFFER_SIZE,
+                 startTime=None, link=None):
+        # rates maps message names to their output rate on UART1, like
+        # CFG-MSG. startTime is the POSIX time of the first epoch, now by
+        # default. If link is given, a symlink to the device is created
+        # there.
+        self.baudRate = baudRate
+        self.latency = latency
+        self.txBufferSize = txBufferSize
+        self.stats = collections.Counter()
+
+        self.ports = dict((port, portBlock(port, baudRate)) for port in PORTID.values())
+        self.msgRates = {}
+        for ty, rate in (rates or {}).items():
+            self.setRate(ty, rate)
+        self.config = {'CFG-RATE': struct.pack('<HHH', 1000, 1, 1), 'CFG-HNR': struct.pack('<Bxxx', 1),
+                       'CFG-GNSS': defaultGnss()}
+
+        self.master, self.slave = pty.openpty()
+        ubx.configureTty(self.slave, baudRate)
+        os.set_blocking(self.master, False)
+        self.device = os.ttyname(self.slave)
+        self.link = link
+        if link is not None:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.device, link)
+
+        self.parser = ubx.Parser(None, device=False)
+        self.parser.subscribe(self._handleFrame, raw=True)
+        self.txBuffer = bytearray()
+        self.txBlocked = False
+        self.txQueued = 0
+        self.txWritten = 0
+        self.rxLine = LineRate(baudRate)
+        self.txLine = LineRate(baudRate)
+        self.pendingBaudRate = None
+        self.baudRateSwitch = 0
+        # Responses waiting for the latency, as (due, sequence, frame, new
+        # baud rate)
+        self.responses = []
+        self.sequence = 0
+
+        now = time.monotonic()
+        gpsNow = ((time.time() if startTime is None else startTime) - GPS_EPOCH + LEAP_SECONDS) * 1000.0
+        self.navTime = self.hnrTime = gpsNow - gpsNow % 1000 + 1000
+        self.navDue = self.hnrDue = now + (self.navTime - gpsNow) / 1000.0
+        self.navCount = self.hnrCount = 0
+
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='ReceiverEmulator')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+
+    def setRate(self, ty, rate, port=UART1):
+        # Output rate of a message on a port, like CFG-MSG
+        rates = bytearray(self.msgRates.get(CLIDPAIR[ty], bytes(NUM_PORTS)))
+        rates[port] = rate
+        self.msgRates[CLIDPAIR[ty]] = bytes(rates)
+
+    def navPeriod(self):
+        meas, nav, timeRef = struct.unpack('<HHH', self.config['CFG-RATE'])
+        return meas * nav
+
+    def hnrPeriod(self):
+        return 1000.0 / self.config['CFG-HNR'][0]
+
+    def outputEnabled(self):
+        # UBX output on UART1
+        return struct.unpack_from('<H', self.ports[UART1], 14)[0] & 0x01
+
+    def run(self):
+        while not self.closed:
+            now = time.monotonic()
+            self._outputEpochs(now)
+            self._releaseResponses(now)
+            self._transmit(now)
+
+            rxReady = self.rxLine.available(now) >= LINE_CHUNK
+            txWaiting = bool(self.txBuffer) and self.txBlocked
+            timeout = self._nextEvent(now, rxReady) - now
+            readable, writable, _ = select.select([self.master] if rxReady else [], [self.master] if txWaiting else [], [],
+                                                  min(max(timeout, 0), MAX_WAIT))
+            if writable:
+                self.txBlocked = False
+            if readable:
+                self._receive(time.monotonic())
+
+    def _nextEvent(self, now, rxReady):
+        # Monotonic time of the next thing to do
+        events = [self.navDue, self.hnrDue]
+        if self.responses:
+            events.append(self.responses[0][0])
+        if self.txBuffer and not self.txBlocked:
+            events.append(now + self.txLine.delay(min(len(self.txBuffer), LINE_CHUNK)))
+        if not rxReady:
+            events.append(now + self.rxLine.delay(LINE_CHUNK))
+        return min(events)
+
+    def hostBaudRate(self):
+        return ttyBaudRate(self.master)
+
+    def _receive(self, now):
+        try:
+            data = os.read(self.master, self.rxLine.available(now))
+        except (BlockingIOError, OSError):
+            return
+        self.rxLine.spend(len(data))
+        self.stats['rxBytes'] += len(data)
+        if self.hostBaudRate() != self.baudRate:
+            # Framing errors: nothing the host sends makes sense
+            self.stats['garbledBytes'] += len(data)
+            return
+        self.parser.parse(data)
+
+    def _transmit(self, now):
+        if not self.txBuffer or self.txBlocked:
+            return
+        size = min(self.txLine.available(now), len(self.txBuffer))
+        if size < min(LINE_CHUNK, len(self.txBuffer)):
+            return
+        chunk = bytes(self.txBuffer[:size])
+        if self.hostBaudRate() != self.baudRate:
+            chunk = bytes(bytearray(b ^ 0xff for b in bytearray(chunk)))
+        try:
+            written = os.write(self.master, chunk)
+        except BlockingIOError:
+            # The host is not reading
+            self.txBlocked = True
+            return
+        del self.txBuffer[:written]
+        self.txLine.spend(written)
+        self.txWritten += written
+        self.stats['txBytes'] += written
+        if self.pendingBaudRate is not None and self.txWritten >= self.baudRateSwitch:
+            logging.info('Switching to {} baud'.format(self.pendingBaudRate))
+            self.baudRate = self.pendingBaudRate
+            self.pendingBaudRate = None
+            self.rxLine.setBaudRate(self.baudRate)
+            self.txLine.setBaudRate(self.baudRate)
+
+    def _queue(self, data):
+        # Add a frame to the TX buffer, or drop it if it is full
+        if len(self.txBuffer) + len(data) > self.txBufferSize:
+            self.stats['txDropped'] += 1
+            return False
+        self.txBuffer += data
+        self.txQueued += len(data)
+        return True
+
+    def _respond(self, data, baudRate=None):
+        # Queue a response after the latency. A new baud rate takes effect
+        # once the response is sent.
+        self.sequence += 1
+        heapq.heappush(self.responses, (time.monotonic() + self.latency, self.sequence, data, baudRate))
+
+    def _releaseResponses(self, now):
+        while self.responses and self.responses[0][0] <= now:
+            due, sequence, data, baudRate = heapq.heappop(self.responses)
+            self._queue(data)
+            if baudRate is not None:
+                self.pendingBaudRate = baudRate
+                self.baudRateSwitch = self.txQueued
+
+    def _ack(self, cl, id, acknowledged=True, baudRate=None):
+        self.stats['acks' if acknowledged else 'nacks'] += 1
+        self._respond(frame(*(ACK_ACK if acknowledged else ACK_NACK), payload=struct.pack('<BB', cl, id)), baudRate)
+
+    def _outputEpochs(self, now):
+        if now >= self.navDue:
+            if now - self.navDue > MAX_LAG:
+                self.stats['skippedEpochs'] += 1
+                self.navDue = now
+            self._outputEpoch(self.navTime, self.navCount, False)
+            self.navTime += self.navPeriod()
+            self.navDue += self.navPeriod() / 1000.0
+            self.navCount += 1
+        if now >= self.hnrDue:
+            if now - self.hnrDue > MAX_LAG:
+                self.hnrDue = now
+            self._outputEpoch(self.hnrTime, self.hnrCount, True)
+            self.hnrTime += self.hnrPeriod()
+            self.hnrDue += self.hnrPeriod() / 1000.0
+            self.hnrCount += 1
+
+    def _outputEpoch(self, gpsTime, count, hnr):
+        # Output the messages of a navigation or HNR epoch that are due
+        if not self.outputEnabled():
+            return
+        values = None
+        for clid in sorted(self.msgRates):
+            rate = self.msgRates[clid][UART1]
+            if rate == 0 or count % rate or hnr != (clid[0] == HNR_CLASS or clid in HNR_RATE_TYPES):
+                continue
+            if values is None:
+                values = epochValues(gpsTime)
+            data = syntheticMessage(CLIDPAIR_INV.get(clid), values)
+            if data is None:
+                self.stats['unsupportedOutput'] += 1
+                continue
+            if self._queue(data):
+                self.stats['messages'] += 1
+        if not hnr:
+            self.stats['epochs'] += 1
+
+    def _handleFrame(self, ty, data):
+        cl, id, length = struct.unpack_from('<BBH', data, 2)
+        payload = data[6:6+length]
+        self.stats['rxFrames'] += 1
+        if cl == CFG_CLASS:
+            self._handleConfig(cl, id, ty, payload)
+        elif length == 0:
+            response = syntheticMessage(ty, epochValues(self.navTime)) if isinstance(ty, str) else None
+            if response is None:
+                self.stats['ignored'] += 1
+                return
+            self.stats['polls'] += 1
+            self._respond(response)
+        else:
+            self.stats['ignored'] += 1
+
+    def _handleConfig(self, cl, id, ty, payload):
+        length = len(payload)
+        if ty == 'CFG-PRT':
+            if length <= 1:
+                port = payload[0] if length else UART1
+                if port not in self.ports:
+                    return self._ack(cl, id, False)
+                self.stats['polls'] += 1
+                return self._respond(frame(cl, id, self.ports[port]))
+            if length != 20 or payload[0] not in self.ports:
+                return self._ack(cl, id, False)
+            port = payload[0]
+            self.ports[port] = bytes(payload)
+            baudRate = struct.unpack_from('<I', payload, 8)[0]
+            return self._ack(cl, id, True, baudRate if port == UART1 and baudRate != self.baudRate else None)
+
+        if ty == 'CFG-MSG':
+            if length not in (2, 3, 2 + NUM_PORTS):
+                return self._ack(cl, id, False)
+            key = (payload[0], payload[1])
+            rates = bytearray(self.msgRates.get(key, bytes(NUM_PORTS)))
+            if length == 2:
+                self.stats['polls'] += 1
+                return self._respond(frame(cl, id, bytes(payload[:2]) + bytes(rates)))
+            if length == 3:
+                rates[UART1] = payload[2]
+            else:
+                rates[:] = payload[2:]
+            self.msgRates[key] = bytes(rates)
+            return self._ack(cl, id)
+
+        if ty == 'CFG-RST':
+            # Not acknowledged; the receiver restarts
+            self.stats['resets'] += 1
+            del self.txBuffer[:]
+            self.navDue = self.hnrDue = time.monotonic() + RESET_TIME
+            return
+
+        if length == 0:
+            if ty in self.config:
+                data = self.config[ty]
+            elif isinstance(ty, str) and OUTPUT_LENGTHS.get(ty):
+                data = bytes(OUTPUT_LENGTHS[ty])
+            else:
+                return self._ack(cl, id, False)
+            self.stats['polls'] += 1
+            return self._respond(frame(cl, id, data))
+
+        if ty == 'CFG-RATE' and (length != 6 or struct.unpack_from('<H', payload)[0] < 25 or struct.unpack_from('<H', payload, 2)[0] == 0):
+            return self._ack(cl, id, False)
+        if ty == 'CFG-HNR' and (length != 4 or not 1 <= payload[0] <= 30):
+            return self._ack(cl, id, False)
+        self.config[ty] = bytes(payload)
+        # A faster rate applies from the next epoch
+        if ty == 'CFG-RATE':
+            self.navDue = min(self.navDue, time.monotonic() + self.navPeriod() / 1000.0)
+        if ty == 'CFG-HNR':
+            self.hnrDue = min(self.hnrDue, time.monotonic() + self.hnrPeriod() / 1000.0)
+        self._ack(cl, id)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--baudRate', '-r', type=int, default=DEFAULT_BAUD_RATE, help='Initial baud rate of UART1')
+    parser.add_argument('--latency', '-l', type=float, default=0.0, help='Response latency in ms')
+    parser.add_argument('--rate', action='append', default=[], metavar='TYPE=RATE', help='Output a message every RATE epochs, e.g. NAV-PVT=1. May be given several times.')
+    parser.add_argument('--link', default=None, help='Create a symlink to the device here, e.g. /tmp/ttyUBLOX')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    rates = dict((ty, int(rate)) for ty, rate in (r.split('=') for r in args.rate))
+    with ReceiverEmulator(args.baudRate, args.latency / 1000.0, rates, link=args.link) as emulator:
+        print('Emulating a receiver on {}{}'.format(emulator.device, ' ({})'.format(args.link) if args.link else ''))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        for name, count in sorted(emulator.stats.items()):
+            print('{}: {}'.format(name, count))
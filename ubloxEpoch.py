@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Assembly of navigation epochs from NAV messages
+#
+# The receiver sends the NAV messages of a navigation solution one after the
+# other, all with the ITOW of the solution. EpochAssembler buffers them by
+# ITOW and calls callback(epoch) once per epoch, in ITOW order, with the
+# packets of that epoch only.
+#
+# An epoch is emitted as soon as it has all the messages of types, or when
+# it can no longer be completed: a message maxWait ms or more newer has been
+# seen (advance() also moves time forward, e.g. from HNR-PVT), or more than
+# maxPending epochs are buffered. Epoch.mask has bit i set if the message
+# types[i] is present. Messages for epochs that were already emitted are
+# dropped and counted in lateMessages.
+
+import logging
+import collections
+
+EPOCH_TYPES = ['NAV-PVT', 'NAV-DOP', 'NAV-ATT', 'NAV-STATUS', 'NAV-SVINFO']
+DEFAULT_MAX_WAIT = 1000
+DEFAULT_MAX_PENDING = 8
+
+WEEK_MS = 7 * 24 * 3600 * 1000
+
+def itowDiff(a, b):
+    # a - b in ms, across a week rollover
+    return (a - b + WEEK_MS // 2) % WEEK_MS - WEEK_MS // 2
+
+class Epoch(object):
+    __slots__ = ('itow', 'mask', 'complete', 'packets')
+
+    def __init__(self, itow):
+        self.itow = itow
+        self.mask = 0
+        self.complete = False
+        self.packets = {}
+
+    def __getitem__(self, ty):
+        # Packet of a message type, or None if it is missing
+        return self.packets.get(ty)
+
+    def __repr__(self):
+        return 'Epoch({}, mask=0x{:02x}, {})'.format(self.itow, self.mask, sorted(self.packets))
+
+class EpochAssembler(object):
+    def __init__(self, callback, types=EPOCH_TYPES, maxWait=DEFAULT_MAX_WAIT, maxPending=DEFAULT_MAX_PENDING):
+        self.callback = callback
+        self.types = list(types)
+        self.bits = dict((ty, 1 << i) for i, ty in enumerate(self.types))
+        self.fullMask = (1 << len(self.types)) - 1
+        self.maxWait = maxWait
+        self.maxPending = maxPending
+        self.pending = collections.OrderedDict()
+        self.newest = None
+        self.lastEmitted = None
+        self.epochs = 0
+        self.completeEpochs = 0
+        self.lateMessages = 0
+
+    def add(self, ty, packet):
+        # Buffer a message. Messages of other types are ignored.
+        bit = self.bits.get(ty)
+        if bit is None:
+            return
+        # LazyMessage objects read ITOW without decoding the rest
+        itow = packet[0]['ITOW'] if isinstance(packet, list) else packet.ITOW
+        if self.lastEmitted is not None and itowDiff(itow, self.lastEmitted) <= 0:
+            self.lateMessages += 1
+            return
+
+        epoch = self.pending.get(itow)
+        if epoch is None:
+            epoch = Epoch(itow)
+            outOfOrder = self.pending and itowDiff(itow, next(reversed(self.pending))) < 0
+            self.pending[itow] = epoch
+            if outOfOrder:
+                # Keep the buffer sorted by ITOW
+                oldest = min(self.pending, key=lambda t: itowDiff(t, itow))
+                self.pending = collections.OrderedDict(sorted(self.pending.items(), key=lambda item: itowDiff(item[0], oldest)))
+        epoch.packets[ty] = packet
+        epoch.mask |= bit
+
+        if epoch.mask == self.fullMask:
+            self.emitUntil(itow)
+        self.advance(itow)
+
+    def advance(self, itow):
+        # Emit the epochs that are too old to be completed at time itow
+        if self.newest is None or itowDiff(itow, self.newest) > 0:
+            self.newest = itow
+        while self.pending:
+            oldest = next(iter(self.pending))
+            if itowDiff(self.newest, oldest) < self.maxWait and len(self.pending) <= self.maxPending:
+                break
+            self.emit(self.pending.popitem(last=False)[1])
+
+    def emitUntil(self, itow):
+        # Emit the epochs up to and including itow
+        while self.pending:
+            oldest = next(iter(self.pending))
+            if itowDiff(oldest, itow) > 0:
+                break
+            self.emit(self.pending.popitem(last=False)[1])
+
+    def flush(self):
+        # Emit all the buffered epochs, e.g. at the end of a file
+        while self.pending:
+            self.emit(self.pending.popitem(last=False)[1])
+
+    def emit(self, epoch):
+        epoch.complete = epoch.mask == self.fullMask
+        self.epochs += 1
+        if epoch.complete:
+            self.completeEpochs += 1
+        self.lastEmitted = epoch.itow
+        self.callback(epoch)
+
+if __name__ == '__main__':
+    import argparse
+    from ubloxFile import UbloxFile
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', help='UBX file to assemble the epochs of')
+    parser.add_argument('--maxWait', type=int, default=DEFAULT_MAX_WAIT, help='Time in ms to wait for the messages of an epoch')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Print every epoch')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    missing = collections.Counter()
+    def callback(epoch):
+        for ty in assembler.types:
+            if epoch[ty] is None:
+                missing[ty] += 1
+        if args.verbose:
+            print(epoch)
+
+    assembler = EpochAssembler(callback, maxWait=args.maxWait)
+    with UbloxFile(args.file) as f:
+        for ty, packet in f.messages(assembler.types, lazy=True):
+            assembler.add(ty, packet)
+    assembler.flush()
+
+    print('{} epochs, {} complete, {} late messages'.format(assembler.epochs, assembler.completeEpochs, assembler.lateMessages))
+    for ty in assembler.types:
+        if missing[ty]:
+            print('{} missing in {} epochs'.format(ty, missing[ty]))
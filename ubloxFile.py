@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# Memory mapped UBX file reader with a frame index
+#
+# The index holds the offset, class, id and payload length of every valid
+# frame in the file. It is built in a single pass when the file is first
+# opened and saved next to the file (<file>.idx), so that reopening the file
+# and selecting frames by message type does not need another scan.
+#
+# Compressed files written by ubloxCompressed are indexed the same way, with
+# offsets into the uncompressed data. Their blocks are decompressed when a
+# frame in them is read, and the last few are cached, so that reading part of
+# a file only decompresses that part. The index is built one block at a time.
+# When the file is opened for a time window (startItow, endItow) and there is
+# no index of the whole file yet, only the blocks of the window are indexed,
+# and partial is set.
+
+import os
+import mmap
+import array
+import struct
+import logging
+
+from ubloxMessage import UbloxMessage, CLIDPAIR_INV, SYNC1, SYNC2
+
+import ubloxCompressed
+
+try:
+    import ubloxArrays
+except ImportError:
+    ubloxArrays = None
+
+INDEX_EXTENSION = '.idx'
+INDEX_MAGIC = b'UBXIDX01'
+# Magic, file size, file modification time (ns), number of frames
+INDEX_HEADER = struct.Struct('<8sQQQ')
+
+SYNC = bytes(bytearray([SYNC1, SYNC2]))
+MAX_FRAME_SIZE = 0xffff + 8
+
+def scanFrames(buf):
+    # Pure Python equivalent of ubloxArrays.findFrames, used without numpy
+    offsets = array.array('Q')
+    classes = array.array('B')
+    ids = array.array('B')
+    lengths = array.array('H')
+    view = memoryview(buf)
+    offset = 0
+    while True:
+        start = buf.find(SYNC, offset)
+        if start == -1 or start + 8 > len(buf):
+            break
+        (cl, id, length) = struct.unpack_from("<BBH", buf, start+2)
+        if start + length + 8 > len(buf) or \
+                UbloxMessage.checksum(view[start+2:start+length+6]) != struct.unpack_from("<BB", buf, start+length+6):
+            offset = start + 2
+            continue
+        offsets.append(start)
+        classes.append(cl)
+        ids.append(id)
+        lengths.append(length)
+        offset = start + length + 8
+    view.release()
+    return offsets, classes, ids, lengths
+
+def findFrames(buf):
+    # (offsets, classes, ids, lengths) arrays of the frames in buf
+    if ubloxArrays is None:
+        return scanFrames(buf)
+    starts, classes, ids, lengths = ubloxArrays.findFrames(buf)
+    return (array.array('Q', starts.astype('=u8').tobytes()), array.array('B', classes.tobytes()),
+            array.array('B', ids.tobytes()), array.array('H', lengths.astype('=u2').tobytes()))
+
+class UbloxFile(object):
+    def __init__(self, filename, useIndexFile=True, startItow=None, endItow=None):
+        self.filename = filename
+        self.indexFilename = filename + INDEX_EXTENSION if useIndexFile else None
+        self.file = open(filename, 'rb')
+        stat = os.fstat(self.file.fileno())
+        # size is that of the file, dataSize that of the uncompressed data
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.compressed = None
+        self.buffer = None
+        self.view = None
+        if self.size > 0 and ubloxCompressed.isCompressed(filename):
+            self.compressed = ubloxCompressed.CompressedFile(filename)
+            self.dataSize = self.compressed.size
+        else:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else b''
+            self.view = memoryview(self.buffer)
+            self.dataSize = self.size
+        self.typeIndex = None
+        self.partial = False
+
+        if not self.loadIndex():
+            blocks = None
+            if self.compressed is not None and (startItow is not None or endItow is not None):
+                blocks = self.compressed.blocksForTime(startItow, endItow)
+                self.partial = len(blocks) < len(self.compressed)
+            self.buildIndex(blocks)
+            if not self.partial:
+                self.saveIndex()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        if self.compressed is not None:
+            self.compressed.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def buildIndex(self, blocks=None):
+        # Index the whole file, or only some blocks of a compressed file
+        logging.info('Indexing {}...'.format(self.filename))
+        if self.compressed is None:
+            self.offsets, self.classes, self.ids, self.lengths = findFrames(self.buffer)
+        else:
+            self.indexBlocks(range(len(self.compressed)) if blocks is None else blocks)
+
+    def indexBlocks(self, blocks):
+        # Index consecutive blocks of a compressed file, one at a time. The
+        # end of each block that may hold the start of a frame is kept and
+        # scanned again with the next block, for frames that straddle blocks.
+        self.offsets = array.array('Q')
+        self.classes = array.array('B')
+        self.ids = array.array('B')
+        self.lengths = array.array('H')
+        carry = b''
+        for i in blocks:
+            data = carry + self.compressed.block(i) if carry else self.compressed.block(i)
+            base = self.compressed.offsets[i] - len(carry)
+            offsets, classes, ids, lengths = findFrames(data)
+            self.offsets.extend(offset + base for offset in offsets)
+            self.classes.extend(classes)
+            self.ids.extend(ids)
+            self.lengths.extend(lengths)
+            end = offsets[-1] + lengths[-1] + 8 if offsets else 0
+            carry = data[max(end, len(data) - MAX_FRAME_SIZE + 1):]
+
+    def loadIndex(self):
+        if self.indexFilename is None or not os.path.exists(self.indexFilename):
+            return False
+        with open(self.indexFilename, 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) != INDEX_HEADER.size:
+                return False
+            magic, size, mtime, count = INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC or size != self.size or mtime != self.mtime:
+                logging.info('Index {} is out of date'.format(self.indexFilename))
+                return False
+            self.offsets = array.array('Q')
+            self.classes = array.array('B')
+            self.ids = array.array('B')
+            self.lengths = array.array('H')
+            try:
+                for a in [self.offsets, self.classes, self.ids, self.lengths]:
+                    a.fromfile(f, count)
+            except EOFError:
+                return False
+        return True
+
+    def saveIndex(self):
+        if self.indexFilename is None:
+            return
+        try:
+            with open(self.indexFilename, 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, self.size, self.mtime, len(self.offsets)))
+                for a in [self.offsets, self.classes, self.ids, self.lengths]:
+                    a.tofile(f)
+        except (IOError, OSError) as e:
+            logging.warning('Could not save index {}: {}'.format(self.indexFilename, e))
+
+    def indices(self, types=None):
+        # Frame numbers of the given message types (names such as 'HNR-PVT'),
+        # or of all frames, in file order
+        if types is None:
+            return range(len(self.offsets))
+
+        if self.typeIndex is None:
+            # Frame numbers by (class, id, length), since messages that share
+            # a class and id are told apart by their length
+            self.typeIndex = {}
+            for i, key in enumerate(zip(self.classes, self.ids, self.lengths)):
+                if key not in self.typeIndex:
+                    self.typeIndex[key] = array.array('L')
+                self.typeIndex[key].append(i)
+
+        types = set(types)
+        selected = [frames for key, frames in self.typeIndex.items() if UbloxMessage.messageName(*key) in types]
+        if len(selected) == 1:
+            return selected[0]
+        return sorted(i for frames in selected for i in frames)
+
+    def read(self, offset, size):
+        # size bytes of uncompressed data from offset, as a memoryview unless
+        # they straddle blocks of a compressed file
+        if self.compressed is None:
+            return self.view[offset:offset+size]
+        if not len(self.compressed) or offset >= self.dataSize:
+            return b''
+        i = self.compressed.blockAt(offset)
+        data = self.compressed.block(i)
+        begin = offset - self.compressed.offsets[i]
+        if begin + size <= len(data):
+            return memoryview(data)[begin:begin+size]
+        return self.compressed.read(offset, size)
+
+    def frame(self, i):
+        # Memoryview of the complete frame, including sync bytes and checksum
+        return self.read(self.offsets[i], self.lengths[i] + 8)
+
+    def decode(self, i, lazy=False):
+        payload = self.read(self.offsets[i] + 6, self.lengths[i])
+        if lazy:
+            return UbloxMessage.decodeLazy(self.classes[i], self.ids[i], self.lengths[i], bytes(payload))
+        return UbloxMessage.decode(self.classes[i], self.ids[i], self.lengths[i], payload)
+
+    def messages(self, types=None, lazy=False):
+        # Generator of (message type, packet) for the given message types.
+        # Packets are LazyMessage objects if lazy is set.
+        for i in self.indices(types):
+            if self.lengths[i] == 0:
+                continue
+            try:
+                yield self.decode(i, lazy)
+            except ValueError:
+                continue
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', help='UBX file to index')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the index even if it is up to date')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.rebuild and os.path.exists(args.file + INDEX_EXTENSION):
+        os.remove(args.file + INDEX_EXTENSION)
+
+    with UbloxFile(args.file) as f:
+        counts = {}
+        for cl, id in zip(f.classes, f.ids):
+            counts[(cl, id)] = counts.get((cl, id), 0) + 1
+        for clid in sorted(counts.keys()):
+            print('{}: {}'.format(CLIDPAIR_INV.get(clid, '0x{:02x} 0x{:02x}'.format(*clid)), counts[clid]))
+        print('\nTotal: {} frames'.format(len(f)))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# Buffered, rotating writer for raw receiver data
+#
+# write() appends to an in-memory buffer and returns immediately. Full
+# buffers are handed to a background thread, which writes them in large
+# chunks, rotates the output file by size and/or age, and calls fsync at most
+# every fsyncInterval seconds. Partially filled buffers are also written
+# every flushInterval seconds, which bounds the data lost on power failure.
+#
+# If the storage stalls, up to maxPending bytes are queued. Beyond that, new
+# data is dropped and counted in droppedBytes, so that the reader of the
+# serial port is never blocked.
+#
+# Files are named <prefix>_YYYYMMDDTHHMMSSZ.ubx from the UTC time at which
+# they are opened, like the capture script. With frameAligned, a file is only
+# cut before a valid UBX frame, so that every file can be parsed on its own.
+#
+# With a codec, files are written compressed with ubloxCompressed and named
+# .ubz. Compression happens in the writer thread. Sizes for rotation are
+# uncompressed sizes. Blocks are only cut before a frame, so the fsync does
+# not force one out, and up to a block of data can be lost on power failure.
+
+import os
+import time
+import struct
+import logging
+import threading
+import collections
+
+from ubloxMessage import UbloxMessage, SYNC1, SYNC2
+import ubloxCompressed
+
+DEFAULT_BUFFER_SIZE = 1 << 18
+DEFAULT_MAX_PENDING = 1 << 24
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_FSYNC_INTERVAL = 5.0
+
+SYNC = bytes(bytearray([SYNC1, SYNC2]))
+
+def findFrameStart(data, offset=0):
+    # Offset of the first complete UBX frame with a valid checksum in data at
+    # or after offset, or -1
+    view = memoryview(data)
+    try:
+        while True:
+            start = data.find(SYNC, offset)
+            if start == -1 or start + 8 > len(data):
+                return -1
+            (length,) = struct.unpack_from('<H', data, start+4)
+            if start + length + 8 <= len(data) and \
+                    UbloxMessage.checksum(view[start+2:start+length+6]) == struct.unpack_from('<BB', data, start+length+6):
+                return start
+            offset = start + 2
+    finally:
+        view.release()
+
+class UbloxLogger(object):
+    def __init__(self, directory='.', prefix='ublox', filename=None, maxFileSize=None, maxFileAge=None,
+                 frameAligned=False, bufferSize=DEFAULT_BUFFER_SIZE, maxPending=DEFAULT_MAX_PENDING,
+                 flushInterval=DEFAULT_FLUSH_INTERVAL, fsyncInterval=DEFAULT_FSYNC_INTERVAL, codec=None):
+        # If filename is given, it is used for the first file instead of a
+        # timestamped name
+        self.directory = directory
+        self.prefix = prefix
+        self.maxFileSize = maxFileSize
+        self.maxFileAge = maxFileAge
+        self.frameAligned = frameAligned
+        self.bufferSize = bufferSize
+        self.maxPending = maxPending
+        self.flushInterval = flushInterval
+        self.fsyncInterval = fsyncInterval
+        self.codec = codec
+
+        self.buffer = bytearray()
+        self.chunks = collections.deque()
+        self.pendingBytes = 0
+        self.droppedBytes = 0
+        self.bytesWritten = 0
+        self.files = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+
+        self.file = None
+        self.compressor = None
+        self.fileSize = 0
+        self.fileOpened = None
+        self.lastFsync = None
+        self.rotatePending = False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.open(filename)
+
+        self.thread = threading.Thread(target=self.run, name='UbloxLogger')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        with self.lock:
+            if self.pendingBytes + len(self.buffer) + len(data) > self.maxPending:
+                if self.droppedBytes == 0:
+                    logging.warning('Output is not keeping up, dropping data')
+                self.droppedBytes += len(data)
+                return
+            self.buffer += data
+            if len(self.buffer) >= self.bufferSize:
+                self._queueBuffer()
+
+    def _queueBuffer(self):
+        # Called with the lock held
+        if self.buffer:
+            self.chunks.append(self.buffer)
+            self.pendingBytes += len(self.buffer)
+            self.buffer = bytearray()
+            self.wakeup.notify()
+
+    def flush(self):
+        # Queue the buffered data without waiting for it to be written
+        with self.lock:
+            self._queueBuffer()
+
+    def close(self):
+        with self.lock:
+            self._queueBuffer()
+            self.closed = True
+            self.wakeup.notify()
+        self.thread.join()
+        self._closeFile()
+        if self.droppedBytes:
+            logging.warning('Dropped {} bytes'.format(self.droppedBytes))
+
+    def filenameFor(self, t):
+        name = '{}_{}'.format(self.prefix, time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(t)))
+        extension = '.ubx' if self.codec is None else ubloxCompressed.EXTENSION
+        filename = os.path.join(self.directory, name + extension)
+        i = 1
+        while os.path.exists(filename):
+            filename = os.path.join(self.directory, '{}_{}{}'.format(name, i, extension))
+            i += 1
+        return filename
+
+    def open(self, filename=None):
+        now = time.time()
+        if filename is None:
+            filename = self.filenameFor(now)
+        logging.info('Logging to {}'.format(filename))
+        self.file = open(filename, 'wb', buffering=0)
+        if self.codec is not None:
+            self.compressor = ubloxCompressed.CompressedWriter(self.file, self.codec)
+        self.files.append(filename)
+        self.fileSize = 0
+        self.fileOpened = now
+        self.lastFsync = now
+        self.rotatePending = False
+
+    def _closeFile(self):
+        if self.file is not None:
+            if self.compressor is not None:
+                self.compressor.finish()
+                self.compressor = None
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    def rotate(self):
+        self._closeFile()
+        self.open()
+
+    def rotationDue(self, size):
+        if self.maxFileSize is not None and self.fileSize + size > self.maxFileSize:
+            return True
+        if self.maxFileAge is not None and time.time() - self.fileOpened >= self.maxFileAge:
+            return True
+        return False
+
+    def _write(self, data):
+        if self.compressor is not None:
+            self.compressor.write(data)
+            self.fileSize += len(data)
+            self.bytesWritten += len(data)
+            return
+        view = memoryview(data)
+        while len(view):
+            written = self.file.write(view)
+            view = view[written:]
+        self.fileSize += len(data)
+        self.bytesWritten += len(data)
+
+    def writeChunk(self, chunk):
+        # Write a chunk to the current file, rotating before it if needed
+        if self.fileSize > 0 and (self.rotatePending or self.rotationDue(len(chunk))):
+            if not self.frameAligned:
+                self.rotate()
+            else:
+                # Cut before the first frame that starts in this chunk,
+                # or keep writing to the current file until one does
+                start = findFrameStart(chunk)
+                if start == -1:
+                    self.rotatePending = True
+                else:
+                    self._write(memoryview(chunk)[:start])
+                    chunk = memoryview(chunk)[start:]
+                    self.rotate()
+        self._write(chunk)
+
+        now = time.time()
+        if now - self.lastFsync >= self.fsyncInterval:
+            # Syncs the complete blocks, without cutting one at an arbitrary
+            # byte
+            if self.compressor is not None:
+                self.compressor.flush()
+            os.fsync(self.file.fileno())
+            self.lastFsync = now
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.chunks and not self.closed:
+                    self.wakeup.wait(self.flushInterval)
+                if not self.chunks:
+                    # Nothing filled a buffer within the flush interval
+                    self._queueBuffer()
+                if not self.chunks:
+                    if self.closed:
+                        return
+                    chunk = None
+                else:
+                    chunk = self.chunks.popleft()
+            if chunk is None:
+                # Let time based rotation happen while no data is coming in
+                if self.maxFileAge is not None and self.rotationDue(0) and not self.frameAligned and self.fileSize > 0:
+                    self.rotate()
+                continue
+            try:
+                self.writeChunk(chunk)
+            except (IOError, OSError) as e:
+                logging.error('Could not write {} bytes: {}'.format(len(chunk), e))
+                with self.lock:
+                    self.droppedBytes += len(chunk)
+            with self.lock:
+                self.pendingBytes -= len(chunk)
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help='Directory to write the files to')
+    parser.add_argument('--prefix', default='ublox')
+    parser.add_argument('--rotateSize', type=float, default=None, help='Start a new file after this many MB')
+    parser.add_argument('--rotateTime', type=float, default=None, help='Start a new file after this many seconds')
+    parser.add_argument('--frameAligned', action='store_true', help='Only start new files at the beginning of a UBX frame')
+    parser.add_argument('--compress', '-z', choices=sorted(ubloxCompressed.CODECS.keys()), default=None, help='Write compressed .ubz files')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Log stdin, e.g. cat /dev/ttyACM0 | ./ubloxLogger.py logs
+    maxFileSize = int(args.rotateSize * 1e6) if args.rotateSize is not None else None
+    with UbloxLogger(args.directory, args.prefix, maxFileSize=maxFileSize, maxFileAge=args.rotateTime, frameAligned=args.frameAligned, codec=args.compress) as logger:
+        try:
+            while True:
+                data = os.read(sys.stdin.fileno(), 1 << 16)
+                if not data:
+                    break
+                logger.write(data)
+        except KeyboardInterrupt:
+            pass
@@ -1,9 +1,21 @@
 import struct
 import logging
+from itertools import accumulate
+from operator import itemgetter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 SYNC1=0xb5
 SYNC2=0x62
 
+# Payloads at least this long are checksummed with numpy, if it is available
+NUMPY_CHECKSUM_THRESHOLD = 256
+# checksumFrames works on frames starting within this many bytes at a time
+CHECKSUM_WINDOW = 1 << 16
+
 CLASS = {
     "NAV" : 0x01,
     "RXM" : 0x02,
@@ -385,6 +397,158 @@ MSGFMT = {
 
 MSGFMT_INV = dict( [ [(CLIDPAIR[clid], le),v + [clid]] for (clid, le),v in MSGFMT.items() ] )
 
+# MSGSTRUCT_INV - Precompiled decoders for each entry of MSGFMT, keyed by
+# (class, id, size). The value is a tuple of the message name, the
+# struct.Struct and field names for the header section, and the struct.Struct
+# and field names for the repeated section (None and () for fixed length
+# messages).
+def _compileMsgFmt(clid, le, fmt):
+    cl, id = CLIDPAIR[clid]
+    if le is not None:
+        return (cl, id, le), (clid, struct.Struct(fmt[0]), tuple(fmt[1]), None, ())
+    return (cl, id, None), (clid, struct.Struct(fmt[1]), tuple(fmt[2]), struct.Struct(fmt[4]), tuple(fmt[5]))
+
+MSGSTRUCT_INV = dict( [ _compileMsgFmt(clid, le, v) for (clid, le),v in MSGFMT.items() ] )
+
+# ITOW_MESSAGES - (class, id) of the NAV and HNR messages whose payload
+# starts with the ITOW of their navigation epoch. Others, such as
+# NAV-EKFSTATUS, do not carry an ITOW there.
+ITOW_MESSAGES = frozenset(CLIDPAIR[clid] for (clid, le), v in MSGFMT.items()
+                          if clid.split('-')[0] in ('NAV', 'HNR') and (v[1] if le is not None else v[2])[0] == 'ITOW')
+
+# MSGENCODE - Precompiled encoders for each entry of MSGFMT, keyed like
+# MSGFMT by (message name, size). The value is a tuple of the class, id,
+# header size, header struct.Struct and field getter, and repeated section
+# size, struct.Struct and field getter (0, None and None for fixed length
+# messages). A field getter returns the tuple of the values of the fields
+# of a dict.
+def _fieldGetter(fields):
+    if len(fields) == 0:
+        return lambda values: ()
+    if len(fields) == 1:
+        name = fields[0]
+        return lambda values: (values[name],)
+    return itemgetter(*fields)
+
+def _compileMsgEncoder(clid, le, fmt):
+    cl, id = CLIDPAIR[clid]
+    if le is not None:
+        return (clid, le), (cl, id, le, struct.Struct(fmt[0]), _fieldGetter(fmt[1]), 0, None, None)
+    return (clid, None), (cl, id, fmt[0], struct.Struct(fmt[1]), _fieldGetter(fmt[2]), fmt[3], struct.Struct(fmt[4]), _fieldGetter(fmt[5]))
+
+MSGENCODE = dict( [ _compileMsgEncoder(clid, le, v) for (clid, le),v in MSGFMT.items() ] )
+
+HEADER_STRUCT = struct.Struct("<BBBBH")
+CHECKSUM_STRUCT = struct.Struct("<BB")
+
+# Frames of zero length messages (polls), by message name
+POLL_FRAMES = {}
+
+# Lazily decoded messages
+#
+# A LazyMessage keeps the payload of a message and unpacks it the first time
+# a field is read. Header fields are attributes (packet.ITOW) and the repeated
+# sections are packet.blocks, with their fields as attributes too. Indexing,
+# iteration, len() and repr() behave like the list of dicts returned by
+# UbloxMessage.decode, which is only built if they are used. Pickled messages
+# are restored as that list.
+
+def _headerField(i):
+    return property(lambda self: (self._header or self._unpack())[i])
+
+def _blockField(i):
+    return property(lambda self: self._values[i])
+
+class LazyBlock(object):
+    __slots__ = ('_values',)
+    _fields = ()
+    _index = {}
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, name):
+        return self._values[self._index[name]]
+
+    def asDict(self):
+        return dict(zip(self._fields, self._values))
+
+    def __repr__(self):
+        return repr(self.asDict())
+
+class LazyMessage(object):
+    __slots__ = ('payload', '_header', '_blocks', '_list')
+    name = None
+    _struct = None
+    _fields = ()
+    _repStruct = None
+    _blockClass = None
+
+    def __init__(self, payload):
+        self.payload = payload
+        self._header = None
+        self._blocks = None
+        self._list = None
+
+    def _unpack(self):
+        self._header = self._struct.unpack_from(self.payload)
+        return self._header
+
+    @property
+    def blocks(self):
+        if self._blocks is None:
+            if self._repStruct is None:
+                self._blocks = ()
+            else:
+                blockClass = self._blockClass
+                self._blocks = tuple(blockClass(values) for values in
+                                     self._repStruct.iter_unpack(memoryview(self.payload)[self._struct.size:]))
+        return self._blocks
+
+    def asList(self):
+        if self._list is None:
+            self._list = [dict(zip(self._fields, self._header or self._unpack()))]
+            self._list.extend(block.asDict() for block in self.blocks)
+        return self._list
+
+    def __getitem__(self, i):
+        return self.asList()[i]
+
+    def __len__(self):
+        if self._repStruct is None:
+            return 1
+        return 1 + (len(self.payload) - self._struct.size) // self._repStruct.size
+
+    def __iter__(self):
+        return iter(self.asList())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyMessage):
+            other = other.asList()
+        return self.asList() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.asList())
+
+    def __reduce__(self):
+        return (list, (self.asList(),))
+
+def _messageClass(msgStruct):
+    clid, baseStruct, baseFields, repStruct, repFields = msgStruct
+    className = clid.replace('-', '_')
+    attrs = dict((field, _headerField(i)) for i, field in enumerate(baseFields))
+    attrs.update({'__slots__': (), 'name': clid, '_struct': baseStruct, '_fields': baseFields, '_repStruct': repStruct})
+    if repStruct is not None:
+        blockAttrs = dict((field, _blockField(i)) for i, field in enumerate(repFields))
+        blockAttrs.update({'__slots__': (), '_fields': repFields, '_index': dict((field, i) for i, field in enumerate(repFields))})
+        attrs['_blockClass'] = type(className + '_Block', (LazyBlock,), blockAttrs)
+    return type(className, (LazyMessage,), attrs)
+
+# MSGCLASS - LazyMessage subclass for each entry of MSGSTRUCT_INV
+MSGCLASS = dict( [ (key, _messageClass(msgStruct)) for key, msgStruct in MSGSTRUCT_INV.items() ] )
+
 GNSSID = {'GPS': 0,
           'SBAS': 1,
           'Galileo': 2,
@@ -530,108 +694,162 @@ class UbloxMessage(object):
 
         return result
 
+    @staticmethod
+    def messageName(cl, id, length):
+        # Name of a message, or None if its class and id are unknown.
+        # Messages that share a class and id, such as MGA-GPS-EPH and
+        # MGA-GPS-ALM, are told apart by their length.
+        msgStruct = MSGSTRUCT_INV.get((cl, id, length)) or MSGSTRUCT_INV.get((cl, id, None))
+        return msgStruct[0] if msgStruct is not None else CLIDPAIR_INV.get((cl, id))
+
     @staticmethod
     def decode(cl, id, length, payload):
-        data = []
-        try:
-            msgFormat = MSGFMT_INV[((cl, id), length)]
-            data.append(dict(zip(msgFormat[1], struct.unpack(msgFormat[0], payload))))
-        except KeyError:
-            try:
-                # Try if this is one of the variable field messages
-                msgFormat = MSGFMT_INV[((cl, id), None)]
-                fmt_base = msgFormat[:3]
-                fmt_rep = msgFormat[3:]
-                # Check if the length matches
-                if (length - fmt_base[0])%fmt_rep[0] != 0:
-                    logging.error( "Variable length message class 0x%x, id 0x%x \
-                        has wrong length %i" % ( cl, id, length ) )
-                    raise ValueError( "Variable length message class 0x%x, id 0x%x \
-                        has wrong length %i" % ( cl, id, length ) )
-                data.append(dict(zip(fmt_base[2], struct.unpack(fmt_base[1], payload[:fmt_base[0]]))))
-                for i in range(0, (length - fmt_base[0])//fmt_rep[0]):
-                    offset = fmt_base[0] + fmt_rep[0] * i
-                    data.append(dict(zip(fmt_rep[2], struct.unpack(fmt_rep[1], payload[offset:offset+fmt_rep[0]]))))
-
-            except KeyError:
-                logging.info( "Unknown message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
-                raise ValueError( "Unknown message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
-
-        return msgFormat[-1], data
+        msgStruct = MSGSTRUCT_INV.get((cl, id, length))
+        if msgStruct is not None:
+            return msgStruct[0], [dict(zip(msgStruct[2], msgStruct[1].unpack(payload)))]
+
+        # Try if this is one of the variable field messages
+        msgStruct = MSGSTRUCT_INV.get((cl, id, None))
+        if msgStruct is None:
+            logging.info( "Unknown message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
+            raise ValueError( "Unknown message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
+
+        msgFormat, baseStruct, baseFields, repStruct, repFields = msgStruct
+        # Check if the length matches
+        if length < baseStruct.size or (length - baseStruct.size)%repStruct.size != 0:
+            logging.error( "Variable length message class 0x%x, id 0x%x \
+                has wrong length %i" % ( cl, id, length ) )
+            raise ValueError( "Variable length message class 0x%x, id 0x%x \
+                has wrong length %i" % ( cl, id, length ) )
+        data = [dict(zip(baseFields, baseStruct.unpack_from(payload)))]
+        data.extend([dict(zip(repFields, values)) for values in repStruct.iter_unpack(payload[baseStruct.size:length])])
+
+        return msgFormat, data
+
+    @staticmethod
+    def decodeLazy(cl, id, length, payload):
+        # Like decode, but returns a LazyMessage. The payload is kept by the
+        # message, so it must not be a view of a buffer that is reused.
+        msgClass = MSGCLASS.get((cl, id, length))
+        if msgClass is not None:
+            return msgClass.name, msgClass(payload)
+
+        msgClass = MSGCLASS.get((cl, id, None))
+        if msgClass is None:
+            logging.info( "Unknown message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
+            raise ValueError( "Unknown message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
+        if length < msgClass._struct.size or (length - msgClass._struct.size)%msgClass._repStruct.size != 0:
+            logging.error( "Variable length message class 0x%x, id 0x%x \
+                has wrong length %i" % ( cl, id, length ) )
+            raise ValueError( "Variable length message class 0x%x, id 0x%x \
+                has wrong length %i" % ( cl, id, length ) )
+        return msgClass.name, msgClass(payload)
 
     @staticmethod
     def buildMessage(clid, length, payload):
-        stream = struct.pack("<BBBBH", SYNC1, SYNC2, CLIDPAIR[clid][0], CLIDPAIR[clid][1], length)
-        if length > 0:
-            try:
-                fmt_base = [length] + MSGFMT[(clid,length)]
-                fmt_rep = [0, "", []]
-                payload_base = payload
-            except KeyError:
-                format = MSGFMT[(clid, None)]
-                fmt_base = format[:3]
-                fmt_rep = format[3:]
-                payload_base = payload[0]
-                payload_rep = payload[1:]
-                if (length - fmt_base[0])%fmt_rep[0] != 0:
-                    logging.error( "Cannot send: Variable length message class \
-                        0x%x, id 0x%x has wrong length %i" % ( cl, id, length ) )
-                    return
-            stream = stream + struct.pack(fmt_base[1], *[payload_base[i] for i in fmt_base[2]])
-            if fmt_rep[0] != 0:
-                for i in range(0, (length - fmt_base[0])//fmt_rep[0]):
-                    stream = stream + struct.pack(fmt_rep[1], *[payload_rep[i][j] for j in fmt_rep[2]])
-        stream = stream + struct.pack("<BB", *UbloxMessage.checksum( stream[2:] ))
-        return stream
+        # The frame is sized once and the header, payload sections and
+        # checksum are packed into it in place. Polls are built once and
+        # cached.
+        if length == 0:
+            frame = POLL_FRAMES.get(clid)
+            if frame is None:
+                frame = bytearray(8)
+                UbloxMessage.buildMessageInto(frame, 0, clid, 0, None)
+                frame = POLL_FRAMES[clid] = bytes(frame)
+            return frame
+        frame = bytearray(length + 8)
+        if UbloxMessage.buildMessageInto(frame, 0, clid, length, payload) is None:
+            return
+        return bytes(frame)
 
     @staticmethod
-    def decodeNmeaBuffer(buf):
-        # This assumes the data buffer is NMEA data and looks for messages
-        messages = buf.split('\r\n')
-
-        order = ['sync', 'class', 'id', 'length', 'lengthMatch', 'checksum']
-
-        if len(messages):
-            start = messages[0].find('$')
-            if start > 0:
-                unknown = messages[0][:start]
-                messages[0] = messages[0][start:]
-                logging.debug('Unknown data ({} bytes): {}'.format(len(unknown), repr(unknown)))
-                result = UbloxMessage.validate(unknown)
-                logging.debug(', '.join('{}: {}'.format(key, result[key]) for key in order))
-
-        output = []
-        for message in messages:
-            if len(message) == 0:
-                continue
-
-            start = message.find(',')
-            
-            if message[0] != '$' or start < 0 or not message[1:start].isalpha():
-                logging.debug('Unknown data ({} bytes): {}'.format(len(message), repr(message)))
-                result = UbloxMessage.validate(message)
-                logging.debug(', '.join('{}: {}'.format(key, result[key]) for key in order))
-                continue    
-
-            if len(message) < 3 or message[-3] != '*':
-                logging.debug('Possible truncated NMEA string: ({} bytes): {}'.format(len(message), repr(message)))
-                continue
-
-            output.append(message)
-            
-        return output
+    def buildMessageInto(buf, offset, clid, length, payload):
+        # Build a frame into buf at offset, which must have room for
+        # length + 8 bytes, e.g. to pack many messages into one buffer.
+        # Returns the offset after the frame.
+        encoder = MSGENCODE.get((clid, length))
+        if encoder is not None:
+            payloadBase = payload
+            numBlocks = 0
+        elif length > 0:
+            encoder = MSGENCODE[(clid, None)]
+            payloadBase = payload[0]
+            numBlocks, remainder = divmod(length - encoder[2], encoder[5])
+            if remainder != 0 or numBlocks < 0:
+                logging.error( "Cannot send: Variable length message class \
+                    0x%x, id 0x%x has wrong length %i" % ( encoder[0], encoder[1], length ) )
+                return
+        else:
+            encoder = CLIDPAIR[clid] + (0, None, None, 0, None, None)
+            numBlocks = 0
+
+        cl, id, baseSize, baseStruct, baseGetter, repSize, repStruct, repGetter = encoder
+        HEADER_STRUCT.pack_into(buf, offset, SYNC1, SYNC2, cl, id, length)
+        pos = offset + 6
+        if baseStruct is not None:
+            baseStruct.pack_into(buf, pos, *baseGetter(payloadBase))
+            pos += baseSize
+        for i in range(1, numBlocks + 1):
+            repStruct.pack_into(buf, pos, *repGetter(payload[i]))
+            pos += repSize
+        # Checksum the frame in place instead of a copy of it
+        with memoryview(buf) as view:
+            ck = UbloxMessage.checksum(view[offset+2:pos])
+        CHECKSUM_STRUCT.pack_into(buf, pos, *ck)
+        return pos + 2
 
     @staticmethod
     def checksum(msg):
-        msg = bytearray(msg)
-        ck_a = 0
-        ck_b = 0
-        for i in msg:
-            ck_a = ck_a + i
-            ck_b = ck_b + ck_a
-        ck_a = ck_a % 256
-        ck_b = ck_b % 256
-        return (ck_a, ck_b)
+        # 8-bit Fletcher checksum: ck_a is the sum of the bytes and ck_b is
+        # the sum of the running values of ck_a
+        if np is not None and len(msg) >= NUMPY_CHECKSUM_THRESHOLD:
+            ck = np.cumsum(np.frombuffer(msg, dtype=np.uint8), dtype=np.uint64)
+            return (int(ck[-1]) % 256, int(ck.sum(dtype=np.uint64)) % 256)
+        ck_b = sum(accumulate(msg))
+        ck_a = sum(msg)
+        return (ck_a % 256, ck_b % 256)
+
+    @staticmethod
+    def checksumFrames(buf, starts, lengths):
+        # Validate the checksums of many frames in one buffer. starts are the
+        # offsets of the sync bytes and lengths are the payload lengths. 
+        # Returns a list (or numpy array) of booleans, one per frame.
+        if np is None:
+            valid = []
+            for start, length in zip(starts, lengths):
+                expected = struct.unpack_from("<BB", buf, start+length+6)
+                valid.append(UbloxMessage.checksum(memoryview(buf)[start+2:start+length+6]) == expected)
+            return valid
+
+        # With prefix sums S1 (of the bytes) and S2 (of S1), the checksum of
+        # bytes [s, e) is
+        #     ck_a = S1[e] - S1[s]
+        #     ck_b = S2[e] - S2[s] - (e - s) * S1[s]
+        # Arithmetic wraps modulo 2**64, which preserves the result mod 256.
+        # The sums take 16 bytes per byte, so they are computed for the
+        # frames starting in one window of CHECKSUM_WINDOW bytes at a time,
+        # over that window and the end of its last frame.
+        a = np.frombuffer(buf, dtype=np.uint8)
+        starts = np.asarray(starts, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        valid = np.zeros(len(starts), dtype=bool)
+        order = np.argsort(starts, kind='stable')
+        sortedStarts = starts[order]
+        first = 0
+        while first < len(order):
+            last = np.searchsorted(sortedStarts, sortedStarts[first] + CHECKSUM_WINDOW)
+            frames = order[first:last]
+            base = sortedStarts[first] + 2
+            s = starts[frames] + 2 - base
+            e = starts[frames] + lengths[frames] + 6 - base
+            s1 = np.zeros(e.max() + 1, dtype=np.uint64)
+            np.cumsum(a[base:base + e.max()], dtype=np.uint64, out=s1[1:])
+            s2 = np.cumsum(s1, dtype=np.uint64)
+            ck_a = (s1[e] - s1[s]) % 256
+            ck_b = (s2[e] - s2[s] - (e - s).astype(np.uint64) * s1[s]) % 256
+            valid[frames] = (ck_a == a[base + e]) & (ck_b == a[base + e + 1])
+            first = last
+        return valid
 
     @staticmethod
     def buildMask(enabledBits, shiftDict):
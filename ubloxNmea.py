@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# NMEA sentence validation and decoding
+#
+# A sentence is '$<talker><type>,<fields>*<checksum>', where the checksum is
+# the XOR of the characters between '$' and '*' as two hex digits. Sentences
+# are handled without the trailing CR LF.
+#
+# decode() converts the fields of the sentence types in NMEAFMT to the same
+# form as decoded UBX messages: a list of dicts, where the first dict has the
+# fields of the sentence and the following ones the repeated satellite
+# sections (GSV, GSA). Latitudes and longitudes are converted to signed
+# degrees, other numeric fields to int or float, and empty fields to None.
+
+import logging
+import operator
+from functools import reduce
+
+# The NMEA standard limits sentences to 82 characters, but u-blox receivers
+# send longer proprietary sentences
+MAX_SENTENCE_LENGTH = 128
+
+# NMEAFMT - Sentence type -> (fields, repeated fields, number of repeated
+# sections, trailing fields). If the number of repeated sections is None, it
+# is the number of complete sections present.
+NMEAFMT = {
+    'GGA': (['Time', 'LAT', 'NS', 'LON', 'EW', 'Quality', 'NumSV', 'HDOP', 'Alt', 'AltUnit', 'Sep', 'SepUnit', 'DiffAge', 'DiffStation'], [], 0, []),
+    'RMC': (['Time', 'Status', 'LAT', 'NS', 'LON', 'EW', 'Speed', 'COG', 'Date', 'MagVar', 'MagVarEW', 'PosMode', 'NavStatus'], [], 0, []),
+    'GSV': (['NumMsg', 'MsgNum', 'NumSV'], ['SVID', 'Elev', 'Azim', 'CNO'], None, ['SignalID']),
+    'GSA': (['OpMode', 'NavMode'], ['SVID'], 12, ['PDOP', 'HDOP', 'VDOP', 'SystemID']),
+}
+
+STRING_FIELDS = set(['Time', 'Date', 'NS', 'EW', 'Status', 'AltUnit', 'SepUnit', 'DiffStation',
+                     'MagVarEW', 'PosMode', 'NavStatus', 'OpMode', 'SignalID'])
+
+def checksum(body):
+    # XOR of the characters between '$' and '*'
+    if isinstance(body, str):
+        body = body.encode('latin-1')
+    return reduce(operator.xor, bytearray(body), 0)
+
+def validate(sentence):
+    # True if sentence starts with '$' and has a correct checksum
+    if isinstance(sentence, str):
+        sentence = sentence.encode('latin-1')
+    if len(sentence) < 4 or sentence[:1] != b'$' or sentence[-3:-2] != b'*':
+        return False
+    try:
+        expected = int(sentence[-2:], 16)
+    except ValueError:
+        return False
+    return checksum(sentence[1:-3]) == expected
+
+def _degrees(value):
+    # ddmm.mmmm or dddmm.mmmm to degrees
+    value = float(value)
+    degrees = int(value / 100)
+    return degrees + (value - degrees * 100) / 60
+
+def _convert(name, value):
+    if value == '':
+        return None
+    if name in STRING_FIELDS:
+        return value
+    if name in ('LAT', 'LON'):
+        return _degrees(value)
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+def decode(sentence):
+    # Returns (message type, packet) for a validated sentence, e.g.
+    # ('$GPGGA', [{...}]). The packet is None for sentence types not in
+    # NMEAFMT.
+    if not isinstance(sentence, str):
+        sentence = bytes(sentence).decode('latin-1')
+    fields = sentence[:-3].split(',')
+    ty = fields[0]
+    fmt = NMEAFMT.get(ty[3:]) if not ty.startswith('$P') else None
+    if fmt is None:
+        return ty, None
+
+    baseFields, repFields, numRep, trailFields = fmt
+    values = fields[1:]
+    base = values[:len(baseFields)]
+    rest = values[len(baseFields):]
+    if repFields:
+        if numRep is None:
+            numRep = len(rest) // len(repFields)
+        else:
+            numRep = min(numRep, len(rest) // len(repFields))
+    reps = rest[:numRep * len(repFields)]
+    trail = rest[numRep * len(repFields):]
+
+    header = dict((name, _convert(name, value)) for name, value in zip(baseFields + trailFields, base + trail))
+    if header.get('NS') == 'S' and header.get('LAT') is not None:
+        header['LAT'] = -header['LAT']
+    if header.get('EW') == 'W' and header.get('LON') is not None:
+        header['LON'] = -header['LON']
+
+    packet = [header]
+    for i in range(0, len(reps), len(repFields) or 1):
+        block = dict((name, _convert(name, value)) for name, value in zip(repFields, reps[i:i+len(repFields)]))
+        if any(value is not None for value in block.values()):
+            packet.append(block)
+    return ty, packet
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', nargs='?', default=None, help='File of NMEA sentences, one per line. Defaults to stdin.')
+    args = parser.parse_args()
+
+    f = open(args.file, 'r') if args.file else sys.stdin
+    for line in f:
+        sentence = line.strip()
+        if not validate(sentence):
+            logging.warning('Invalid sentence: {}'.format(sentence))
+            continue
+        ty, packet = decode(sentence)
+        print('{}: {}'.format(ty, packet if packet is not None else sentence))
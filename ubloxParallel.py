@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Parallel parsing of large UBX files
+#
+# The file is split into shards of shardSize bytes, which are parsed in a pool
+# of processes. Each worker resynchronizes on the first valid frame at or after
+# the start of its shard, decodes the frames that start before the end of the
+# shard (reading past the end to complete the last one), and reports where the
+# frame following its shard starts.
+#
+# A frame that straddles a shard boundary can contain a sync pair that passes
+# the checksum, in which case the next worker synchronizes inside that frame.
+# When merging, the frames of each shard are aligned to the frame position
+# reported by the previous shard, and the shard is parsed again in this
+# process if no frame matches.
+#
+# Compressed files (ubloxCompressed) are split on uncompressed offsets, and
+# each worker only decompresses the blocks of its shard.
+
+import os
+import mmap
+import struct
+import logging
+import bisect
+import multiprocessing
+
+from ubloxMessage import UbloxMessage, SYNC1, SYNC2
+import ubloxCompressed
+
+DEFAULT_SHARD_SIZE = 1 << 24
+MAX_FRAME_SIZE = 0xffff + 8
+
+SYNC = bytes(bytearray([SYNC1, SYNC2]))
+
+def parseRange(buf, begin, end, types=None):
+    # Parse the frames of buf that start in [begin, end), synchronizing on the
+    # first valid frame at or after begin. Returns the frame offsets, the
+    # decoded messages as (offset, message type, packet), and the offset of
+    # the first valid frame at or after end (None at the end of the buffer).
+    view = memoryview(buf)
+    starts = []
+    messages = []
+    offset = begin
+    nextStart = None
+    while True:
+        start = buf.find(SYNC, offset)
+        if start == -1 or start + 8 > len(buf):
+            break
+        (cl, id, length) = struct.unpack_from("<BBH", buf, start+2)
+        if start + length + 8 > len(buf) or \
+                UbloxMessage.checksum(view[start+2:start+length+6]) != struct.unpack_from("<BB", buf, start+length+6):
+            offset = start + 2
+            continue
+        if start >= end:
+            nextStart = start
+            break
+
+        starts.append(start)
+        offset = start + length + 8
+        if length == 0:
+            continue
+        try:
+            msgFormat, data = UbloxMessage.decode(cl, id, length, view[start+6:start+length+6])
+        except ValueError:
+            continue
+        if types is None or msgFormat in types:
+            messages.append((start, msgFormat, data))
+
+    view.release()
+    return starts, messages, nextStart
+
+def _parseShard(args):
+    filename, begin, end, types = args
+    if ubloxCompressed.isCompressed(filename):
+        return _parseCompressedShard(filename, begin, end, types)
+    with open(filename, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return parseRange(buf, begin, end, types)
+        finally:
+            buf.close()
+
+def _parseCompressedShard(filename, begin, end, types):
+    # Only the blocks covering the shard are decompressed. The window is
+    # extended until it holds the frame following the shard, as parseRange
+    # does on an mmap of the whole file.
+    with ubloxCompressed.CompressedFile(filename) as f:
+        windowSize = end - begin + MAX_FRAME_SIZE
+        while True:
+            buf = f.read(begin, windowSize)
+            starts, messages, nextStart = parseRange(buf, 0, end - begin, types)
+            if nextStart is not None or begin + len(buf) >= f.size:
+                break
+            windowSize *= 2
+    starts = [start + begin for start in starts]
+    messages = [(start + begin, ty, packet) for start, ty, packet in messages]
+    return starts, messages, nextStart + begin if nextStart is not None else None
+
+def fileSize(filename):
+    # Uncompressed size of a file
+    if ubloxCompressed.isCompressed(filename):
+        with ubloxCompressed.CompressedFile(filename) as f:
+            return f.size
+    return os.path.getsize(filename)
+
+def parseFile(filename, processes=None, shardSize=DEFAULT_SHARD_SIZE, types=None):
+    # Generator of (offset, message type, packet) for all messages of the
+    # file, in file order
+    size = fileSize(filename)
+    if size == 0:
+        return
+    bounds = list(range(0, size, shardSize)) + [size]
+    shards = [(filename, bounds[i], bounds[i+1], types) for i in range(len(bounds) - 1)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        expectedStart = 0
+        for i, (starts, messages, nextStart) in enumerate(pool.imap(_parseShard, shards)):
+            if i > 0:
+                if expectedStart is None:
+                    # No frames after the end of the previous shard
+                    break
+                index = bisect.bisect_left(starts, expectedStart)
+                if index == len(starts) or starts[index] != expectedStart:
+                    # The worker synchronized inside a frame, and its frames
+                    # never line up with those of the previous shard
+                    logging.debug('Reparsing shard {} from offset {}'.format(i, expectedStart))
+                    starts, messages, nextStart = _parseShard((filename, expectedStart, shards[i][2], types))
+                else:
+                    messages = messages[bisect.bisect_left(messages, (expectedStart,)):]
+
+            for message in messages:
+                yield message
+            expectedStart = nextStart
+    finally:
+        pool.terminate()
+        pool.join()
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', help='UBX file to parse')
+    parser.add_argument('--processes', '-p', type=int, default=None, help='Number of worker processes. Defaults to the number of CPUs.')
+    parser.add_argument('--shardSize', type=int, default=DEFAULT_SHARD_SIZE, help='Size of each shard in bytes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    startTime = time.time()
+    counts = {}
+    for offset, ty, packet in parseFile(args.file, args.processes, args.shardSize):
+        counts[ty] = counts.get(ty, 0) + 1
+    elapsed = time.time() - startTime
+
+    for ty in sorted(counts.keys()):
+        print('{}: {}'.format(ty, counts[ty]))
+    size = fileSize(args.file)
+    print('Parsed {:.1f} MB in {:.3f} s ({:.2f} MB/s)'.format(size / 1e6, elapsed, size / 1e6 / elapsed))
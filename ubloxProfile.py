@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Receiver configuration profiles
+#
+# A profile is a JSON file describing the desired configuration, keyed by
+# config message type:
+#
+#   {
+#       "CFG-MSG": {"NAV-PVT": {"UART1": 1, "USB": 1}, "NAV-SVINFO": {"UART1": 5}},
+#       "CFG-PRT": {"UART1": {"Baudrate": 115200, "Out_proto_mask": 1}},
+#       "CFG-RATE": {"Meas": 500, "Nav": 1, "Time": "utc"},
+#       "CFG-GNSS": {"enabled": ["GPS", "GLONASS", "Galileo"]},
+#       "CFG-HNR": {"HighNavRate": 20}
+#   }
+#
+# Ports are given by name (see PORTID) or number, or as "PORT" for the port
+# given to loadProfile, i.e. the one the host is connected to. A CFG-PRT
+# field may also be {"set": bits, "clear": bits}, which only changes those
+# bits of its current value, e.g. {"clear": 2} to turn NMEA off. Only the
+# settings in the profile are compared; everything else is left as it is on
+# the receiver.
+#
+# applyProfile() polls the current state of all the settings at once, computes
+# the config messages whose settings differ from the profile, and sends only
+# those, again pipelined. CFG-PRT is sent last since changing the baud rate of
+# the port we are connected to breaks the link.
+
+import json
+import logging
+import asyncio
+import copy
+
+from ubloxMessage import CLIDPAIR, CLIDPAIR_INV, PORTID, PORTID_INV, GNSSID, timeRefDict
+import ubloxAsync
+
+NUM_PORTS = 6
+PORT_PLACEHOLDER = 'PORT'
+DEFAULT_PORT = 'UART1'
+
+def loadProfile(filename, port=DEFAULT_PORT):
+    # Load a profile, with "PORT" replaced by port
+    with open(filename) as f:
+        profile = json.load(f)
+    return setPort(profile, port)
+
+def setPort(profile, port):
+    # Copy of a profile with the ports named "PORT" replaced by port
+    def replace(settings):
+        return dict((port if key == PORT_PLACEHOLDER else key, value) for key, value in settings.items())
+    profile = dict(profile)
+    if 'CFG-MSG' in profile:
+        profile['CFG-MSG'] = dict((name, replace(rates)) for name, rates in profile['CFG-MSG'].items())
+    if 'CFG-PRT' in profile:
+        profile['CFG-PRT'] = replace(profile['CFG-PRT'])
+    return profile
+
+def devicePort(device):
+    # Port a device is most likely connected to, as guessed by ./configure
+    return 'USB' if 'usbmodem' in device else DEFAULT_PORT
+
+def portNumber(port):
+    if isinstance(port, int):
+        return port
+    if port in PORTID:
+        return PORTID[port]
+    return int(port)
+
+def pollRequests(profile):
+    # Poll messages for the current state of the settings of a profile, as
+    # (messageType, length, payload)
+    requests = []
+    for name in sorted(profile.get('CFG-MSG', {})):
+        msgClass, msgId = CLIDPAIR[name]
+        requests.append(('CFG-MSG', 2, {'msgClass': msgClass, 'msgId': msgId}))
+    for port in sorted(portNumber(p) for p in profile.get('CFG-PRT', {})):
+        requests.append(('CFG-PRT', 1, {'PortID': port}))
+    for messageType in ['CFG-RATE', 'CFG-GNSS', 'CFG-HNR']:
+        if messageType in profile:
+            requests.append((messageType, 0, []))
+    return requests
+
+def _updated(fields, settings):
+    # Copy of fields with settings applied, or None if nothing changes
+    changed = dict(fields)
+    changed.update(settings)
+    return changed if changed != fields else None
+
+def _applyBits(fields, settings):
+    # settings with {"set": bits, "clear": bits} values applied to fields
+    resolved = {}
+    for key, value in settings.items():
+        if isinstance(value, dict):
+            value = (fields[key] | value.get('set', 0)) & ~value.get('clear', 0)
+        resolved[key] = value
+    return resolved
+
+def diffProfile(profile, requests, responses):
+    # Config messages needed to go from the polled state to the profile, as
+    # (messageType, length, payload). Settings that could not be polled are
+    # skipped.
+    changes = []
+    prtChanges = []
+    for (messageType, length, payload), packet in zip(requests, responses):
+        if packet is None:
+            logging.warning('No response to {} poll {}, skipping'.format(messageType, payload))
+            continue
+
+        if messageType == 'CFG-MSG':
+            name = [n for n in profile['CFG-MSG'] if CLIDPAIR[n] == (payload['msgClass'], payload['msgId'])][0]
+            rates = [block['rate'] for block in packet[1:]]
+            rates += [0] * (NUM_PORTS - len(rates))
+            desired = list(rates)
+            for port, rate in profile['CFG-MSG'][name].items():
+                desired[portNumber(port)] = rate
+            if desired != rates:
+                changes.append(('CFG-MSG', 2 + NUM_PORTS, [packet[0]] + [{'rate': rate} for rate in desired]))
+
+        elif messageType == 'CFG-PRT':
+            settings = [s for p, s in profile['CFG-PRT'].items() if portNumber(p) == payload['PortID']][0]
+            block = _updated(packet[1], _applyBits(packet[1], settings))
+            if block is not None:
+                prtChanges.append(('CFG-PRT', 20, [{}, block]))
+
+        elif messageType == 'CFG-RATE':
+            settings = dict(profile['CFG-RATE'])
+            if settings.get('Time') in timeRefDict:
+                settings['Time'] = timeRefDict[settings['Time']]
+            fields = _updated(packet[0], settings)
+            if fields is not None:
+                changes.append(('CFG-RATE', 6, fields))
+
+        elif messageType == 'CFG-GNSS':
+            enabled = set(GNSSID[name] for name in profile['CFG-GNSS']['enabled'])
+            packet = copy.deepcopy(packet)
+            changed = False
+            for block in packet[1:]:
+                flags = (block['flags'] | 0x01) if block['gnssId'] in enabled else (block['flags'] & ~0x01)
+                if flags != block['flags']:
+                    block['flags'] = flags
+                    changed = True
+            if changed:
+                changes.append(('CFG-GNSS', 4 + 8 * (len(packet) - 1), packet))
+
+        elif messageType == 'CFG-HNR':
+            fields = _updated(packet[0], profile['CFG-HNR'])
+            if fields is not None:
+                changes.append(('CFG-HNR', 4, fields))
+
+    return changes + prtChanges
+
+async def readState(protocol, profile, **kwargs):
+    # Poll the current state of the settings of a profile in one sweep.
+    # Returns the poll requests and the responses, in the same order.
+    requests = pollRequests(profile)
+    responses = await protocol.pollMany(requests, **kwargs)
+    return requests, responses
+
+async def applyProfile(protocol, profile, dryRun=False, **kwargs):
+    # Bring the receiver to the profile, sending only the config messages
+    # that change something. Returns the config messages.
+    requests, responses = await readState(protocol, profile, **kwargs)
+    changes = diffProfile(profile, requests, responses)
+    if dryRun or not changes:
+        return changes
+
+    prtChanges = [change for change in changes if change[0] == 'CFG-PRT']
+    otherChanges = [change for change in changes if change[0] != 'CFG-PRT']
+    acks = await protocol.sendConfigMany(otherChanges, **kwargs)
+    for change in prtChanges:
+        acks.append(await protocol.sendConfig(*change, **kwargs))
+    for change, ack in zip(otherChanges + prtChanges, acks):
+        if ack is None:
+            raise Exception('{} not acknowledged!'.format(describeChange(*change)))
+    return changes
+
+def describeChange(messageType, length, payload):
+    if messageType == 'CFG-MSG':
+        name = CLIDPAIR_INV.get((payload[0]['msgClass'], payload[0]['msgId']), 'Unknown')
+        rates = ', '.join('{}: {}'.format(PORTID_INV.get(i, i), block['rate']) for i, block in enumerate(payload[1:]))
+        return 'CFG-MSG {} -> {}'.format(name, rates)
+    if messageType == 'CFG-PRT':
+        return 'CFG-PRT {} -> {}'.format(PORTID_INV.get(payload[1]['PortID'], payload[1]['PortID']), payload[1])
+    if messageType == 'CFG-GNSS':
+        return 'CFG-GNSS -> {}'.format(payload[1:])
+    return '{} -> {}'.format(messageType, payload)
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser()
+    parser.add_argument('profile', help='JSON profile to apply')
+    parser.add_argument('--device', '-d', required=True, help='Specify the serial port device to communicate with. e.g. /dev/ttyO5')
+    parser.add_argument('--baudRate', '-r', type=int, default=None)
+    parser.add_argument('--port', '-p', default=None, help='Port the device is connected to, used for "PORT" in the profile. Defaults to USB for usbmodem devices and UART1 otherwise, like ./configure.')
+    parser.add_argument('--dryRun', '-n', action='store_true', help='Only print the config messages that would be sent')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    profile = loadProfile(args.profile, args.port if args.port is not None else devicePort(args.device))
+
+    async def main():
+        protocol = await ubloxAsync.openDevice(args.device, args.baudRate)
+        try:
+            return await applyProfile(protocol, profile, dryRun=args.dryRun)
+        finally:
+            ubloxAsync.closeDevice(protocol)
+
+    startTime = time.time()
+    changes = asyncio.run(main())
+    for change in changes:
+        print(describeChange(*change))
+    print('{} {} config messages in {:.3f} s'.format('Would send' if args.dryRun else 'Sent', len(changes), time.time() - startTime))
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+# Paced replay of UBX logs to a pty, TCP clients and UDP targets
+#
+# Replayer sends a log epoch by epoch, at the GPS time of each epoch scaled
+# by speed (1 for real time, 0 for as fast as possible). Epochs are those of
+# the time index of the log (ubloxTimeIndex): all the bytes from the first
+# frame of an epoch to the first frame of the next, NMEA and anything else
+# included, are sent together, as the receiver sent them. The logs written
+# by capture and ubloxLogger have no host timestamps, so GPS time is the only
+# clock. The log is read once, from its memory map or a block at a time if
+# it is compressed, and each epoch is written to all the sinks, so several
+# consumers are driven at once.
+#
+# The replayer sleeps until spinTime before an epoch is due and spins for
+# the rest, which keeps the jitter well under a millisecond at 50 Hz at the
+# cost of some CPU. A longer spinTime rides out coarse timers and busy
+# machines, up to spinning all the time. Gaps longer than maxGap seconds are
+# shortened to maxGap. With loop, the replay starts over at the end of the
+# window with the clock rebased, and seek() jumps to another time while
+# replaying.
+#
+# Sinks never block a paced replay. A sink that cannot take all of an epoch
+# keeps the rest and drops the following epochs until it has been sent, so
+# consumers only ever see whole frames. Dropped data is counted in the
+# droppedBytes of the sink. With speed 0 the replayer waits for the sinks to
+# take everything instead, and nothing is dropped.
+
+import os
+import pty
+import time
+import errno
+import bisect
+import select
+import socket
+import logging
+
+import ubx
+from ubloxTimeIndex import loadTimeIndex
+
+# Seconds spent spinning before each epoch is due
+SPIN_TIME = 0.002
+# Epochs sent later than this many seconds are counted as late
+LATE_THRESHOLD = 0.001
+# Seconds between checks for stop() while waiting for the sinks
+DRAIN_POLL = 0.1
+
+class PtySink(object):
+    # Pseudo-terminal that consumers open like a serial device
+    def __init__(self, link=None):
+        self.master, self.slave = pty.openpty()
+        ubx.configureTty(self.slave)
+        os.set_blocking(self.master, False)
+        self.device = os.ttyname(self.slave)
+        self.link = link
+        if link is not None:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.device, link)
+        # Bytes of the last epoch not written yet
+        self.pending = b''
+        self.droppedBytes = 0
+
+    def _write(self, data):
+        # Returns the bytes of data not written
+        try:
+            written = os.write(self.master, data)
+        except BlockingIOError:
+            written = 0
+        return data[written:]
+
+    def blocked(self):
+        # Files waiting to be writable to send pending data
+        return [self.master] if self.pending else []
+
+    def resume(self, fd):
+        self.pending = self._write(self.pending)
+
+    def write(self, data, cuts):
+        if self.pending:
+            self.resume(self.master)
+            if self.pending:
+                self.droppedBytes += len(data)
+                return
+        self.pending = bytes(self._write(data))
+
+    def close(self):
+        self.droppedBytes += len(self.pending)
+        os.close(self.master)
+        os.close(self.slave)
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+
+class TcpSink(object):
+    # TCP listener sending the replay to every connected client. Each client
+    # has its own pending data, like PtySink.
+    def __init__(self, port, host=''):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(8)
+        self.server.setblocking(False)
+        self.port = self.server.getsockname()[1]
+        # Client socket -> bytes of the last epoch not sent yet
+        self.clients = {}
+        self.droppedBytes = 0
+
+    def fileno(self):
+        return self.server.fileno()
+
+    def accept(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except BlockingIOError:
+                return
+            logging.info('Replay client {}:{} connected'.format(*address[:2]))
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.clients[client] = b''
+
+    def _send(self, client, data):
+        # Returns the bytes of data not sent, or None if the client is gone
+        try:
+            sent = client.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError as e:
+            logging.info('Replay client disconnected: {}'.format(e))
+            client.close()
+            del self.clients[client]
+            return None
+        return data[sent:]
+
+    def blocked(self):
+        return [client for client, pending in self.clients.items() if pending]
+
+    def resume(self, client):
+        pending = self._send(client, self.clients[client])
+        if pending is not None:
+            self.clients[client] = pending
+
+    def write(self, data, cuts):
+        for client in list(self.clients):
+            if self.clients[client]:
+                self.resume(client)
+                if client not in self.clients:
+                    continue
+                if self.clients[client]:
+                    self.droppedBytes += len(data)
+                    continue
+            pending = self._send(client, data)
+            if pending is not None:
+                self.clients[client] = bytes(pending)
+
+    def close(self):
+        for client, pending in self.clients.items():
+            self.droppedBytes += len(pending)
+            client.close()
+        self.server.close()
+
+class UdpSink(object):
+    # UDP target. Epochs are split into datagrams of at most maxDatagram
+    # bytes at frame boundaries, so each datagram can be parsed on its own.
+    # Datagrams the socket buffer has no room for are kept, like the pending
+    # data of PtySink.
+    framed = True
+
+    def __init__(self, host, port, maxDatagram=ubx.MAX_DATAGRAM):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.address = (host, port)
+        self.maxDatagram = maxDatagram
+        # Datagrams of the last epoch not sent yet
+        self.pending = []
+        self.droppedBytes = 0
+
+    def _send(self, data):
+        # Returns False if the socket buffer is full
+        try:
+            self.socket.sendto(data, self.address)
+        except BlockingIOError:
+            return False
+        except OSError as e:
+            # Nobody listening on a local port
+            if e.errno != errno.ECONNREFUSED:
+                logging.warning('Could not send to {}:{}: {}'.format(self.address[0], self.address[1], e))
+            self.droppedBytes += len(data)
+        return True
+
+    def blocked(self):
+        return [self.socket] if self.pending else []
+
+    def resume(self, sock):
+        while self.pending and self._send(self.pending[0]):
+            self.pending.pop(0)
+
+    def write(self, data, cuts):
+        if self.pending:
+            self.resume(self.socket)
+            if self.pending:
+                self.droppedBytes += len(data)
+                return
+        # cuts are the offsets in data where frames end
+        datagrams = []
+        start = 0
+        last = 0
+        for cut in cuts:
+            if cut - start > self.maxDatagram and last > start:
+                datagrams.append(data[start:last])
+                start = last
+            last = cut
+        if start < len(data):
+            datagrams.append(data[start:])
+        for i, datagram in enumerate(datagrams):
+            if not self._send(datagram):
+                self.pending = [bytes(d) for d in datagrams[i:]]
+                break
+
+    def close(self):
+        self.droppedBytes += sum(len(datagram) for datagram in self.pending)
+        self.socket.close()
+
+class Replayer(object):
+    def __init__(self, ubloxFile, sinks, speed=1.0, loop=False, startItow=None, endItow=None, week=None, maxGap=None, spinTime=SPIN_TIME):
+        self.file = ubloxFile
+        self.sinks = list(sinks)
+        self.speed = speed
+        self.spinTime = spinTime
+        self.loop = loop
+        self.maxGap = maxGap
+        self.index = loadTimeIndex(ubloxFile)
+        self.framed = any(getattr(sink, 'framed', False) for sink in self.sinks)
+        self.listeners = [sink for sink in self.sinks if hasattr(sink, 'accept')]
+        self.setWindow(startItow, endItow, week)
+        self.pendingSeek = None
+        self.stopped = False
+        self.epochs = 0
+        self.bytesSent = 0
+        self.lateEpochs = 0
+        self.maxLateness = 0.0
+        self.totalLateness = 0.0
+
+    def setWindow(self, startItow=None, endItow=None, week=None):
+        # Replay the epochs with startItow <= ITOW < endItow
+        start, end = self.index.window(startItow, endItow, week)
+        self.start = start
+        self.end = self.file.dataSize if end is None else end
+        self.firstEpoch = bisect.bisect_left(self.index.offsets, start)
+        self.lastEpoch = bisect.bisect_left(self.index.offsets, self.end)
+
+    def seek(self, itow, week=None):
+        # Continue the replay from the first epoch at or after itow. May be
+        # called from another thread.
+        self.pendingSeek = (itow, week)
+
+    def stop(self):
+        self.stopped = True
+
+    def wait(self, timeout):
+        # Sleep, accepting TCP clients and sending pending data meanwhile
+        blocked = {}
+        for sink in self.sinks:
+            for f in sink.blocked():
+                blocked[f] = sink
+        if self.listeners or blocked:
+            readable, writable = select.select(self.listeners, list(blocked), [], timeout)[:2]
+            for sink in readable:
+                sink.accept()
+            for f in writable:
+                blocked[f].resume(f)
+        elif timeout > 0:
+            time.sleep(timeout)
+
+    def drain(self):
+        # Wait until the sinks have sent all pending data
+        self.wait(0)
+        while not self.stopped and any(sink.blocked() for sink in self.sinks):
+            self.wait(DRAIN_POLL)
+
+    def waitUntil(self, due):
+        while True:
+            remaining = due - time.perf_counter()
+            if remaining <= 0:
+                return
+            if remaining > self.spinTime:
+                self.wait(remaining - self.spinTime)
+
+    def cuts(self, start, end):
+        # Offsets relative to start where the frames in [start, end) end
+        offsets = self.file.offsets
+        lengths = self.file.lengths
+        first = bisect.bisect_left(offsets, start)
+        last = bisect.bisect_left(offsets, end)
+        return [offsets[i] + lengths[i] + 8 - start for i in range(first, last)]
+
+    def send(self, start, end):
+        data = self.file.read(start, end - start)
+        cuts = self.cuts(start, end) if self.framed else None
+        for sink in self.sinks:
+            sink.write(data, cuts)
+        self.bytesSent += end - start
+
+    def run(self):
+        if self.firstEpoch >= self.lastEpoch:
+            logging.warning('{} has no epochs in the window, sending it at once'.format(self.file.filename))
+            self.send(self.start, self.end)
+        else:
+            while not self.stopped:
+                self.replay()
+                if not self.loop:
+                    break
+        if self.speed == 0:
+            self.drain()
+
+    def replay(self):
+        # Replay the window once
+        times = self.index.times
+        offsets = self.index.offsets
+        i = self.firstEpoch
+        segmentStart = self.start
+        clock = time.perf_counter()
+        schedule = 0.0
+        previous = times[i]
+        while i < self.lastEpoch and not self.stopped:
+            if self.pendingSeek is not None:
+                itow, week = self.pendingSeek
+                self.pendingSeek = None
+                i = max(bisect.bisect_left(times, self.index.gpsTime(itow, week)), self.firstEpoch)
+                if i >= self.lastEpoch:
+                    break
+                segmentStart = offsets[i]
+                clock = time.perf_counter()
+                schedule = 0.0
+                previous = times[i]
+
+            gap = (times[i] - previous) / 1000.0
+            if self.maxGap is not None and gap > self.maxGap:
+                gap = self.maxGap
+            schedule += gap
+            previous = times[i]
+            if self.speed > 0:
+                due = clock + schedule / self.speed
+                self.waitUntil(due)
+                lateness = time.perf_counter() - due
+                self.totalLateness += lateness
+                self.maxLateness = max(self.maxLateness, lateness)
+                if lateness > LATE_THRESHOLD:
+                    self.lateEpochs += 1
+            else:
+                # As fast as the sinks take the data, without dropping any
+                self.drain()
+
+            end = offsets[i + 1] if i + 1 < self.lastEpoch else self.end
+            self.send(segmentStart, end)
+            self.epochs += 1
+            segmentStart = end
+            i += 1
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+if __name__ == '__main__':
+    import argparse
+    from ubloxFile import UbloxFile
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', help='UBX or .ubz file to replay')
+    parser.add_argument('--speed', '-s', type=float, default=1.0, help='Replay speed, 1 for real time')
+    parser.add_argument('--fast', action='store_true', help='Replay as fast as possible')
+    parser.add_argument('--loop', action='store_true', help='Start over at the end')
+    parser.add_argument('--start', type=float, default=None, help='Start at this ITOW in seconds')
+    parser.add_argument('--end', type=float, default=None, help='Stop at this ITOW in seconds')
+    parser.add_argument('--week', type=int, default=None, help='GPS week of --start and --end')
+    parser.add_argument('--spin', type=float, default=SPIN_TIME * 1e3, help='Time in ms spent spinning before each epoch')
+    parser.add_argument('--maxGap', type=float, default=None, help='Shorten gaps in the log to this many seconds')
+    parser.add_argument('--pty', action='store_true', help='Replay to a pseudo-terminal')
+    parser.add_argument('--link', default=None, help='Create a symlink to the pty here, e.g. /tmp/ttyREPLAY')
+    parser.add_argument('--tcp', type=int, default=None, metavar='PORT', help='Replay to the clients of a TCP listener on this port')
+    parser.add_argument('--udp', action='append', default=[], metavar='HOST:PORT', help='Replay to a UDP target. May be given several times.')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    sinks = []
+    if args.pty or args.link:
+        sinks.append(PtySink(args.link))
+        print('Replaying to {}{}'.format(sinks[-1].device, ' ({})'.format(args.link) if args.link else ''))
+    if args.tcp is not None:
+        sinks.append(TcpSink(args.tcp))
+        print('Replaying to TCP clients on port {}'.format(sinks[-1].port))
+    for target in args.udp:
+        host, port = target.rsplit(':', 1)
+        sinks.append(UdpSink(host, int(port)))
+        print('Replaying to UDP {}'.format(target))
+    if not sinks:
+        parser.error('No output, use --pty, --link, --tcp or --udp')
+
+    startItow = int(args.start * 1000) if args.start is not None else None
+    endItow = int(args.end * 1000) if args.end is not None else None
+    # Without a week, only the blocks of the window of a compressed file need
+    # to be indexed
+    with UbloxFile(args.file, startItow=startItow if args.week is None else None,
+                   endItow=endItow if args.week is None else None) as f:
+        replayer = Replayer(f, sinks, 0 if args.fast else args.speed, args.loop, startItow, endItow, args.week, args.maxGap, args.spin / 1e3)
+        startTime = time.time()
+        try:
+            replayer.run()
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.time() - startTime
+        replayer.close()
+
+    print('{} epochs, {:.1f} MB in {:.3f} s'.format(replayer.epochs, replayer.bytesSent / 1e6, elapsed))
+    if replayer.epochs and not args.fast:
+        print('Lateness: mean {:.3f} ms, max {:.3f} ms, {} epochs over {:.0f} ms'.format(
+              replayer.totalLateness / replayer.epochs * 1e3, replayer.maxLateness * 1e3, replayer.lateEpochs, LATE_THRESHOLD * 1e3))
+    for sink in sinks:
+        if sink.droppedBytes:
+            print('{}: {} bytes dropped'.format(type(sink).__name__, sink.droppedBytes))
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+# Fan-out of a receiver stream to TCP clients and UDP targets
+#
+# StreamServer reads a source (device, file or socket) once, and splits it
+# into UBX frames and NMEA sentences. Each one is queued for every client
+# whose message types it matches, and written to the clients by a
+# background thread with non-blocking sends, so a slow client never blocks
+# the reader or the other clients.
+#
+# Each client has a queue of at most maxQueueBytes. When a new frame does
+# not fit, the oldest queued frames are dropped and counted, so a client
+# that falls behind gets the most recent data. Frames are never cut: a frame
+# that was partly sent is always finished.
+#
+# Clients get all the data by default, or only some message types: message
+# names (NAV-PVT), class names (NAV), NMEA sentence types ($GPGGA) or NMEA
+# for all sentences. Listeners and UDP targets have default types, and a TCP
+# client can send a line of types, separated by spaces or commas, to change
+# its own ('*' for all). UDP targets may be multicast groups; frames are
+# packed into datagrams of at most ubx.MAX_DATAGRAM bytes.
+#
+# Throughput, queued bytes, lag (age of the oldest data not sent yet) and
+# drops are counted per client, and logged every statsInterval seconds.
+
+import os
+import time
+import errno
+import select
+import socket
+import logging
+import threading
+import ipaddress
+import collections
+
+import ubx
+
+DEFAULT_QUEUE_BYTES = 1 << 20
+DEFAULT_TTL = 1
+# Most bytes handed to send() at once
+SEND_SIZE = 1 << 16
+# Chunks sent to a client before moving on to the others
+MAX_CHUNKS_PER_PASS = 16
+# Longest line of message types a TCP client can send
+MAX_LINE_LENGTH = 1024
+
+def parseTypes(text):
+    # Set of message types from 'NAV-PVT,HNR-PVT' or 'NAV NMEA', or None
+    # for all
+    types = set(text.replace(',', ' ').split())
+    return None if not types or '*' in types else types
+
+def matchesTypes(ty, types):
+    # True if a frame of type ty (message name, (class, id) if it has no
+    # name, or '$' and the NMEA sentence type) is selected by types
+    if types is None:
+        return True
+    if isinstance(ty, tuple):
+        return ty in types
+    if ty.startswith('$'):
+        return 'NMEA' in types or ty in types
+    return ty in types or ty.split('-')[0] in types
+
+class FrameParser(ubx.Parser):
+    # Parser passing UBX frames and NMEA sentences to callback(ty, frame) as
+    # bytes, without decoding them
+    def __init__(self, callback):
+        ubx.Parser.__init__(self, None, device=False)
+        self.frameCallback = callback
+        self.subscribe(callback, raw=True)
+
+    def handleNmea(self, sentence):
+        self.frameCallback(sentence[:sentence.find(',')], (sentence + '\r\n').encode('latin-1'))
+
+class Client(object):
+    # A TCP client or UDP target and its queue of (time, frame). current
+    # is the chunk being sent; it is not part of the queue and is never
+    # dropped.
+    def __init__(self, sock, address, types=None, maxQueueBytes=DEFAULT_QUEUE_BYTES, datagram=False):
+        self.socket = sock
+        self.address = address
+        self.name = '{}{}:{}'.format('udp://' if datagram else '', address[0], address[1])
+        self.datagram = datagram
+        self.maxQueueBytes = maxQueueBytes
+        self.setTypes(types)
+        self.queue = collections.deque()
+        self.queuedBytes = 0
+        self.current = None
+        self.currentTime = None
+        self.currentFrames = 0
+        self.line = b''
+        self.connectTime = time.monotonic()
+        self.framesSent = 0
+        self.bytesSent = 0
+        self.droppedFrames = 0
+        self.droppedBytes = 0
+        self.maxLag = 0.0
+
+    def setTypes(self, types):
+        self.types = types
+        self.matches = {}
+
+    def wants(self, ty):
+        match = self.matches.get(ty)
+        if match is None:
+            match = self.matches[ty] = matchesTypes(ty, self.types)
+        return match
+
+    def put(self, now, frame):
+        # Queue a frame, dropping the oldest ones beyond maxQueueBytes.
+        # Called with the server lock held.
+        self.queue.append((now, frame))
+        self.queuedBytes += len(frame)
+        while self.queuedBytes > self.maxQueueBytes:
+            dropped = self.queue.popleft()[1]
+            self.queuedBytes -= len(dropped)
+            self.droppedFrames += 1
+            self.droppedBytes += len(dropped)
+
+    def pending(self):
+        return self.current is not None or bool(self.queue)
+
+    def lag(self, now):
+        # Age in seconds of the oldest data not sent yet
+        if self.current is not None:
+            lag = now - self.currentTime
+        elif self.queue:
+            lag = now - self.queue[0][0]
+        else:
+            lag = 0.0
+        self.maxLag = max(self.maxLag, lag)
+        return lag
+
+    def take(self):
+        # Move queued frames to current: up to SEND_SIZE bytes for TCP, one
+        # datagram for UDP, and at least one frame. Called with the server
+        # lock held.
+        size = ubx.MAX_DATAGRAM if self.datagram else SEND_SIZE
+        self.currentTime = self.queue[0][0]
+        frames = []
+        total = 0
+        while self.queue and (not frames or total + len(self.queue[0][1]) <= size):
+            frame = self.queue.popleft()[1]
+            frames.append(frame)
+            total += len(frame)
+        self.queuedBytes -= total
+        self.currentFrames = len(frames)
+        self.current = memoryview(b''.join(frames))
+
+    def sendCurrent(self):
+        # Send as much of current as possible without blocking. Returns
+        # False if the client is gone.
+        try:
+            if self.datagram:
+                sent = self.socket.sendto(self.current, self.address)
+            else:
+                sent = self.socket.send(self.current)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            if self.datagram and e.errno == errno.ECONNREFUSED:
+                # Nobody listening on a local port yet
+                self.droppedFrames += self.currentFrames
+                self.droppedBytes += len(self.current)
+                self.current = None
+                return True
+            logging.info('Client {} disconnected: {}'.format(self.name, e))
+            return False
+        self.bytesSent += sent
+        if sent < len(self.current):
+            self.current = self.current[sent:]
+        else:
+            self.framesSent += self.currentFrames
+            self.maxLag = max(self.maxLag, time.monotonic() - self.currentTime)
+            self.current = None
+        return True
+
+    def stats(self, now):
+        return {'name': self.name, 'types': None if self.types is None else sorted(self.types),
+                'framesSent': self.framesSent, 'bytesSent': self.bytesSent,
+                'droppedFrames': self.droppedFrames, 'droppedBytes': self.droppedBytes,
+                'queuedBytes': self.queuedBytes, 'lag': self.lag(now), 'maxLag': self.maxLag,
+                'connected': now - self.connectTime}
+
+class StreamServer(object):
+    def __init__(self, tcpPorts=(), udpTargets=(), host='', maxQueueBytes=DEFAULT_QUEUE_BYTES, ttl=DEFAULT_TTL, statsInterval=None):
+        # tcpPorts is a list of (port, types) and udpTargets a list of
+        # (host, port, types), where types is None for all the data
+        self.maxQueueBytes = maxQueueBytes
+        self.statsInterval = statsInterval
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.listeners = {}
+        for port, types in tcpPorts:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((host, port))
+            listener.listen(16)
+            listener.setblocking(False)
+            self.listeners[listener] = types
+        for targetHost, port, types in udpTargets:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            address = (socket.gethostbyname(targetHost), port)
+            if ipaddress.ip_address(address[0]).is_multicast:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+            self.clients[sock] = Client(sock, address, types, maxQueueBytes, datagram=True)
+
+        self.parser = FrameParser(self.onFrame)
+        self.incoming = []
+        self.bytesIn = 0
+        self.framesIn = 0
+        self.startTime = time.monotonic()
+        self.lastStats = (self.startTime, 0, {})
+
+        # Wakes the thread up when frames are queued
+        self.wakeupRead, self.wakeupWrite = socket.socketpair()
+        self.wakeupRead.setblocking(False)
+        self.wakeupWrite.setblocking(False)
+        self.signaled = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='StreamServer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def ports(self):
+        return [listener.getsockname()[1] for listener in self.listeners]
+
+    def onFrame(self, ty, frame):
+        self.incoming.append((ty, frame))
+
+    def feed(self, data):
+        # Queue the frames of a chunk of data for the clients that want them
+        self.bytesIn += len(data)
+        self.parser.parse(data)
+        if not self.incoming:
+            return
+        frames = self.incoming
+        self.incoming = []
+        now = time.monotonic()
+        with self.lock:
+            self.framesIn += len(frames)
+            queued = False
+            for client in self.clients.values():
+                for ty, frame in frames:
+                    if client.wants(ty):
+                        client.put(now, frame)
+                        queued = True
+            if queued and not self.signaled:
+                self.signaled = True
+                try:
+                    self.wakeupWrite.send(b'\0')
+                except BlockingIOError:
+                    pass
+
+    def serve(self, source):
+        # Read and fan out a source until it ends: anything ubx.readChunks
+        # reads
+        for data in ubx.readChunks(source):
+            self.feed(data)
+
+    def accept(self, listener):
+        while True:
+            try:
+                sock, address = listener.accept()
+            except BlockingIOError:
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = Client(sock, address, self.listeners[listener], self.maxQueueBytes)
+            with self.lock:
+                self.clients[sock] = client
+            logging.info('Client {} connected'.format(client.name))
+
+    def remove(self, client):
+        with self.lock:
+            del self.clients[client.socket]
+        client.socket.close()
+
+    def receive(self, client):
+        # Lines of message types from a TCP client. Returns False when the
+        # client has closed the connection.
+        try:
+            data = client.socket.recv(MAX_LINE_LENGTH)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        if not data:
+            logging.info('Client {} disconnected'.format(client.name))
+            return False
+        lines = (client.line + data).split(b'\n')
+        client.line = lines.pop()[-MAX_LINE_LENGTH:]
+        for line in lines:
+            types = parseTypes(line.decode('latin-1'))
+            with self.lock:
+                client.setTypes(types)
+            logging.info('Client {} types: {}'.format(client.name, 'all' if types is None else ' '.join(sorted(types))))
+        return True
+
+    def flush(self, client):
+        # Send queued data to a client until its socket is full
+        for i in range(MAX_CHUNKS_PER_PASS):
+            if client.current is None:
+                with self.lock:
+                    if not client.queue:
+                        return True
+                    client.take()
+            if not client.sendCurrent():
+                return False
+            if client.current is not None:
+                return True
+        return True
+
+    def run(self):
+        nextStats = None if not self.statsInterval else time.monotonic() + self.statsInterval
+        while not self.closed:
+            with self.lock:
+                self.signaled = False
+                clients = list(self.clients.values())
+            readers = [self.wakeupRead] + list(self.listeners) + [client.socket for client in clients if not client.datagram]
+            writers = [client.socket for client in clients if client.pending()]
+            timeout = None if nextStats is None else max(0, nextStats - time.monotonic())
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+
+            for sock in readable:
+                if sock is self.wakeupRead:
+                    try:
+                        self.wakeupRead.recv(4096)
+                    except BlockingIOError:
+                        pass
+                elif sock in self.listeners:
+                    self.accept(sock)
+                elif sock in self.clients and not self.receive(self.clients[sock]):
+                    self.remove(self.clients[sock])
+            for sock in writable:
+                client = self.clients.get(sock)
+                if client is not None and not self.flush(client):
+                    self.remove(client)
+
+            if nextStats is not None and time.monotonic() >= nextStats:
+                self.logStats()
+                nextStats += self.statsInterval
+
+    def stats(self):
+        # Counters of the server and of each client
+        now = time.monotonic()
+        with self.lock:
+            clients = [client.stats(now) for client in self.clients.values()]
+        return {'bytesIn': self.bytesIn, 'framesIn': self.framesIn, 'droppedBytes': self.parser.droppedBytes,
+                'elapsed': now - self.startTime, 'clients': clients}
+
+    def logStats(self):
+        # Log the throughput since the last call and the state of each client
+        stats = self.stats()
+        lastTime, lastBytesIn, lastSent = self.lastStats
+        elapsed = max(stats['elapsed'] + self.startTime - lastTime, 1e-9)
+        logging.info('In: {:.1f} kB/s, {} frames, {} clients'.format(
+                     (stats['bytesIn'] - lastBytesIn) / elapsed / 1e3, stats['framesIn'], len(stats['clients'])))
+        for client in stats['clients']:
+            rate = (client['bytesSent'] - lastSent.get(client['name'], 0)) / elapsed
+            logging.info('  {}: {:.1f} kB/s, {:.1f} kB queued, lag {:.1f} ms (max {:.1f}), {} frames dropped'.format(
+                         client['name'], rate / 1e3, client['queuedBytes'] / 1e3, client['lag'] * 1e3,
+                         client['maxLag'] * 1e3, client['droppedFrames']))
+        self.lastStats = (self.startTime + stats['elapsed'], stats['bytesIn'],
+                          dict((client['name'], client['bytesSent']) for client in stats['clients']))
+
+    def close(self, timeout=1.0):
+        # Give the clients timeout seconds to get their queued data, then
+        # disconnect them
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(client.pending() for client in list(self.clients.values())):
+            time.sleep(0.01)
+        self.closed = True
+        try:
+            self.wakeupWrite.send(b'\0')
+        except BlockingIOError:
+            # The wakeup socket is full, so the thread is woken up anyway
+            pass
+        self.thread.join()
+        for sock in list(self.clients) + list(self.listeners):
+            sock.close()
+        self.wakeupRead.close()
+        self.wakeupWrite.close()
+
+def parseTarget(text):
+    # 'HOST:PORT[=TYPES]' or 'PORT[=TYPES]' -> (host, port, types)
+    address, _, types = text.partition('=')
+    host, _, port = address.rpartition(':')
+    return host, int(port), parseTypes(types)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', help='Device, UBX file or HOST:PORT to read from')
+    parser.add_argument('--tcp', action='append', default=[], metavar='PORT[=TYPES]',
+                        help='Listen for TCP clients on this port, optionally sending only some message types, e.g. 2000=NAV-PVT,HNR-PVT. May be given several times.')
+    parser.add_argument('--udp', action='append', default=[], metavar='HOST:PORT[=TYPES]',
+                        help='Send to a UDP target or multicast group. May be given several times.')
+    parser.add_argument('--host', default='', help='Address to listen on')
+    parser.add_argument('--queue', type=float, default=DEFAULT_QUEUE_BYTES / 1e3, help='Queue size of each client in kB')
+    parser.add_argument('--ttl', type=int, default=DEFAULT_TTL, help='Time to live of multicast datagrams')
+    parser.add_argument('--stats', type=float, default=10.0, help='Log the counters every this many seconds, 0 for never')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if not args.tcp and not args.udp:
+        parser.error('No output, use --tcp or --udp')
+    tcpPorts = [parseTarget(text)[1:] for text in args.tcp]
+    udpTargets = [parseTarget(text) for text in args.udp]
+    server = StreamServer(tcpPorts, udpTargets, args.host, int(args.queue * 1e3), args.ttl, args.stats or None)
+
+    source = args.source
+    if not os.path.exists(source) and ':' in source:
+        host, _, port = source.rpartition(':')
+        source = socket.create_connection((host, int(port)))
+    try:
+        server.serve(source)
+    except KeyboardInterrupt:
+        pass
+    server.logStats()
+    server.close()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# Chunked columnar storage of UBX messages
+#
+# A store is a directory with one series of .npz chunk files per message type,
+# e.g. HNR-PVT_00000.npz, HNR-PVT_00001.npz, ... Each chunk holds one array
+# per field. For variable length messages, the fields of the repeated
+# sections are stored as 'blocks.<field>', and 'offsets' indexes the blocks
+# of each message, as in ubloxArrays.
+#
+# Fields are only read from disk when they are requested, so a tool that needs
+# LAT and LON of HNR-PVT does not load anything else.
+
+import os
+import re
+import logging
+
+import numpy as np
+
+from ubloxMessage import MSGFMT, MSGSTRUCT_INV
+from ubloxArrays import MSGDTYPE
+
+DEFAULT_CHUNK_SIZE = 100000
+BLOCK_PREFIX = 'blocks.'
+
+# Message names with more than one entry in MSGFMT
+_multipleFormats = set(name for name, size in MSGFMT if sum(1 for n, s in MSGFMT if n == name) > 1)
+
+def storeKey(name, size):
+    # Name used for the chunk files of a message type
+    if name in _multipleFormats and size is not None:
+        return '{}-{}'.format(name, size)
+    return name
+
+class StoreWriter(object):
+    def __init__(self, path, chunkSize=DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.chunkSize = chunkSize
+        self.pending = {}
+        self.chunkCount = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, cl, id, length, payload):
+        # Add the payload of one message. Unknown messages are ignored.
+        msgStruct = MSGSTRUCT_INV.get((cl, id, length))
+        if msgStruct is not None:
+            key = (msgStruct[0], length)
+            headerSize = length
+        else:
+            msgStruct = MSGSTRUCT_INV.get((cl, id, None))
+            if msgStruct is None or length < msgStruct[1].size or (length - msgStruct[1].size) % msgStruct[3].size != 0:
+                return False
+            key = (msgStruct[0], None)
+            headerSize = msgStruct[1].size
+
+        if key not in self.pending:
+            self.pending[key] = [bytearray(), bytearray(), []]
+        pending = self.pending[key]
+        pending[0] += payload[:headerSize]
+        if key[1] is None:
+            pending[1] += payload[headerSize:length]
+            pending[2].append((length - headerSize) // msgStruct[3].size)
+            count = len(pending[2])
+        else:
+            count = len(pending[0]) // headerSize
+
+        if count >= self.chunkSize:
+            self.flush(key)
+        return True
+
+    def flush(self, key=None):
+        if key is None:
+            for key in list(self.pending.keys()):
+                self.flush(key)
+            return
+
+        header, blocks, counts = self.pending.pop(key)
+        name, size = key
+        columns = {}
+        if size is None:
+            headerDtype, blockDtype = MSGDTYPE[key]
+            if headerDtype.itemsize == 0:
+                headerArray = np.zeros(len(counts), dtype=headerDtype)
+            else:
+                headerArray = np.frombuffer(header, dtype=headerDtype)
+            blockArray = np.frombuffer(blocks, dtype=blockDtype)
+            for field in blockDtype.names:
+                columns[BLOCK_PREFIX + field] = blockArray[field]
+            offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            columns['offsets'] = offsets
+        else:
+            headerDtype = MSGDTYPE[key]
+            headerArray = np.frombuffer(header, dtype=headerDtype)
+        for field in headerDtype.names:
+            columns[field] = headerArray[field]
+
+        key = storeKey(name, size)
+        chunk = self.chunkCount.get(key, 0)
+        self.chunkCount[key] = chunk + 1
+        filename = os.path.join(self.path, '{}_{:05d}.npz'.format(key, chunk))
+        logging.debug('Writing {} ({} messages)'.format(filename, len(headerArray)))
+        np.savez(filename, **columns)
+
+    def close(self):
+        self.flush()
+
+class Store(object):
+    def __init__(self, path):
+        self.path = path
+        self.chunks = {}
+        for filename in sorted(os.listdir(path)):
+            match = re.match(r'(.+)_(\d+)\.npz$', filename)
+            if match is None:
+                continue
+            self.chunks.setdefault(match.group(1), []).append(os.path.join(path, filename))
+
+    def types(self):
+        return sorted(self.chunks.keys())
+
+    def fields(self, key):
+        with np.load(self.chunks[key][0]) as chunk:
+            return list(chunk.keys())
+
+    def count(self, key):
+        # Number of messages of a message type
+        count = 0
+        for filename in self.chunks.get(key, []):
+            with np.load(filename) as chunk:
+                if 'offsets' in chunk:
+                    count += len(chunk['offsets']) - 1
+                else:
+                    count += len(chunk[chunk.files[0]])
+        return count
+
+    def iterChunks(self, key, fields=None):
+        # Generator of {field: array} for each chunk of a message type
+        for filename in self.chunks.get(key, []):
+            with np.load(filename) as chunk:
+                names = chunk.keys() if fields is None else fields
+                yield dict((name, chunk[name]) for name in names)
+
+    def load(self, key, fields=None):
+        # Concatenate the given fields of all chunks of a message type.
+        # Block offsets are adjusted to index the concatenated blocks.
+        if fields is not None and any(f.startswith(BLOCK_PREFIX) for f in fields) and 'offsets' not in fields:
+            fields = list(fields) + ['offsets']
+        columns = {}
+        numBlocks = 0
+        for chunk in self.iterChunks(key, fields):
+            for name, values in chunk.items():
+                if name == 'offsets':
+                    if 'offsets' in columns:
+                        values = values[1:]
+                    values = values + numBlocks
+                columns.setdefault(name, []).append(values)
+            if 'offsets' in chunk:
+                numBlocks += int(chunk['offsets'][-1])
+        return dict((name, np.concatenate(values)) for name, values in columns.items())
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='Store directory')
+    args = parser.parse_args()
+
+    store = Store(args.path)
+    for key in store.types():
+        count = store.count(key)
+        print('{}: {} messages in {} chunks'.format(key, count, len(store.chunks[key])))
+        print('    {}'.format(', '.join(store.fields(key))))
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# Time index of UBX logs: GPS time to byte offset
+#
+# The index has one entry per navigation epoch: the GPS time of the epoch in
+# milliseconds (week * WEEK_MS + ITOW) and the offset of the first frame of
+# the epoch. An epoch starts at the first NAV or HNR message with a later
+# time than all the previous ones, so the times are strictly increasing and
+# can be binary searched. Only the messages that start with an ITOW count
+# (ITOW_MESSAGES), not e.g. NAV-EKFSTATUS. HNR messages interleaved with slower NAV messages
+# do not start new epochs for the NAV ITOWs they have already passed.
+#
+# The GPS week is taken from NAV-TIMEGPS, RXM-RAW and the date of HNR-PVT.
+# Between those, an ITOW going back by more than half a week is a week
+# rollover. Epochs before the first known week are corrected once it is
+# known. If the log has no week at all, weeks are counted from 0 and
+# weekKnown is False.
+#
+# The index is built from the frame index of ubloxFile and saved next to the
+# file (<file>.tidx), unless the UbloxFile only indexed part of a compressed
+# file.
+
+import os
+import array
+import struct
+import bisect
+import logging
+import calendar
+
+from ubloxMessage import CLIDPAIR, ITOW_MESSAGES
+
+TIME_INDEX_EXTENSION = '.tidx'
+TIME_INDEX_MAGIC = b'UBXTIDX2'
+# Magic, file size, file modification time (ns), number of epochs, week known
+TIME_INDEX_HEADER = struct.Struct('<8sQQQ?')
+
+WEEK_MS = 7 * 24 * 3600 * 1000
+# Seconds from the POSIX epoch to the GPS epoch (1980-01-06)
+GPS_EPOCH = 315964800
+
+NAV_TIMEGPS = CLIDPAIR['NAV-TIMEGPS']
+RXM_RAW = CLIDPAIR['RXM-RAW']
+HNR_PVT = CLIDPAIR['HNR-PVT']
+
+def hnrWeek(buf, payload, itow):
+    # GPS week of an HNR-PVT message from its UTC date, or None if the date
+    # is not valid. Rounding absorbs the leap seconds.
+    year, month, day, hour, minute, second, valid = struct.unpack_from('<HBBBBBB', buf, payload+4)
+    if not valid & 0x01:
+        return None
+    seconds = calendar.timegm((year, month, day, hour, minute, second)) - GPS_EPOCH
+    return int(round((seconds * 1000 - itow) / float(WEEK_MS)))
+
+def frameWeek(cl, id, length, buf, payload, itow):
+    # GPS week carried by a frame whose payload starts at buf[payload], or
+    # None
+    if (cl, id) == NAV_TIMEGPS and length == 16:
+        week, leapS, valid = struct.unpack_from('<hbB', buf, payload+8)
+        return week if valid & 0x02 else None
+    if (cl, id) == RXM_RAW and length >= 8:
+        week, = struct.unpack_from('<h', buf, payload+4)
+        return week
+    if (cl, id) == HNR_PVT and length == 72:
+        return hnrWeek(buf, payload, itow)
+    return None
+
+class TimeIndex(object):
+    def __init__(self, times=None, offsets=None, weekKnown=False):
+        self.times = times if times is not None else array.array('q')
+        self.offsets = offsets if offsets is not None else array.array('Q')
+        self.weekKnown = weekKnown
+
+    def __len__(self):
+        return len(self.times)
+
+    @staticmethod
+    def build(ubloxFile):
+        # Index the epochs of an open ubloxFile.UbloxFile
+        logging.info('Building time index of {}...'.format(ubloxFile.filename))
+        times = array.array('q')
+        offsets = array.array('Q')
+        week = 0
+        weekKnown = False
+        lastItow = None
+        lastTime = None
+        for i, (offset, cl, id, length) in enumerate(zip(ubloxFile.offsets, ubloxFile.classes, ubloxFile.ids, ubloxFile.lengths)):
+            if ((cl, id) not in ITOW_MESSAGES and (cl, id) != RXM_RAW) or length < 4:
+                continue
+            frame = ubloxFile.frame(i)
+            itow, = struct.unpack_from('<i', frame, 6)
+            if not 0 <= itow < WEEK_MS:
+                continue
+            if lastItow is not None and itow < lastItow - WEEK_MS // 2:
+                week += 1
+            lastItow = itow
+
+            knownWeek = frameWeek(cl, id, length, frame, 6, itow)
+            if knownWeek is not None and knownWeek != week:
+                if not weekKnown:
+                    # Move the epochs counted from week 0 to the actual week
+                    shift = (knownWeek - week) * WEEK_MS
+                    times = array.array('q', (t + shift for t in times))
+                    if lastTime is not None:
+                        lastTime += shift
+                week = knownWeek
+            weekKnown = weekKnown or knownWeek is not None
+
+            if (cl, id) == RXM_RAW:
+                continue
+            t = week * WEEK_MS + itow
+            if lastTime is None or t > lastTime:
+                times.append(t)
+                offsets.append(offset)
+                lastTime = t
+        return TimeIndex(times, offsets, weekKnown)
+
+    def load(self, filename, size, mtime):
+        if not os.path.exists(filename):
+            return False
+        with open(filename, 'rb') as f:
+            header = f.read(TIME_INDEX_HEADER.size)
+            if len(header) != TIME_INDEX_HEADER.size:
+                return False
+            magic, indexSize, indexMtime, count, weekKnown = TIME_INDEX_HEADER.unpack(header)
+            if magic != TIME_INDEX_MAGIC or indexSize != size or indexMtime != mtime:
+                logging.info('Time index {} is out of date'.format(filename))
+                return False
+            self.times = array.array('q')
+            self.offsets = array.array('Q')
+            try:
+                self.times.fromfile(f, count)
+                self.offsets.fromfile(f, count)
+            except EOFError:
+                return False
+            self.weekKnown = weekKnown
+        return True
+
+    def save(self, filename, size, mtime):
+        try:
+            with open(filename, 'wb') as f:
+                f.write(TIME_INDEX_HEADER.pack(TIME_INDEX_MAGIC, size, mtime, len(self.times), self.weekKnown))
+                self.times.tofile(f)
+                self.offsets.tofile(f)
+        except (IOError, OSError) as e:
+            logging.warning('Could not save time index {}: {}'.format(filename, e))
+
+    def gpsTime(self, itow, week=None):
+        # GPS time in ms of an ITOW in ms. Without a week, the ITOW is taken
+        # in the week of the first epoch, or the next one if it is earlier
+        # in the week than the first epoch, so that logs across a rollover
+        # can be searched by ITOW alone.
+        if week is not None:
+            return week * WEEK_MS + itow
+        if not self.times:
+            return itow
+        firstWeek, firstItow = divmod(self.times[0], WEEK_MS)
+        return (firstWeek + (1 if itow < firstItow else 0)) * WEEK_MS + itow
+
+    def offsetAt(self, itow, week=None):
+        # Offset of the first epoch at or after a time, or None if there is
+        # none
+        i = bisect.bisect_left(self.times, self.gpsTime(itow, week))
+        return self.offsets[i] if i < len(self.offsets) else None
+
+    def window(self, startItow=None, endItow=None, week=None):
+        # (start, end) offsets of the epochs with startItow <= ITOW < endItow.
+        # end is None if the window reaches the end of the file. A window that
+        # ends before it starts is empty.
+        start = 0 if startItow is None else self.offsetAt(startItow, week)
+        end = None if endItow is None else self.offsetAt(endItow, week)
+        if start is None:
+            start = end = 0 if not self.offsets else self.offsets[-1] + 1
+        elif end is not None and end < start:
+            end = start
+        return start, end
+
+def loadTimeIndex(ubloxFile, useIndexFile=True):
+    # Time index of an open UbloxFile, loaded from <file>.tidx if it is up to
+    # date, or built and saved
+    filename = ubloxFile.filename + TIME_INDEX_EXTENSION
+    index = TimeIndex()
+    if useIndexFile and index.load(filename, ubloxFile.size, ubloxFile.mtime):
+        return index
+    index = TimeIndex.build(ubloxFile)
+    if useIndexFile and not ubloxFile.partial:
+        index.save(filename, ubloxFile.size, ubloxFile.mtime)
+    return index
+
+def frameRange(ubloxFile, index, startItow=None, endItow=None, week=None):
+    # (first, last) frame numbers of the frames in a time window
+    start, end = index.window(startItow, endItow, week)
+    first = bisect.bisect_left(ubloxFile.offsets, start)
+    last = len(ubloxFile.offsets) if end is None else bisect.bisect_left(ubloxFile.offsets, end)
+    return first, last
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from ubloxFile import UbloxFile
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', help='UBX file to index')
+    parser.add_argument('--start', type=float, default=None, help='Start of a window to look up, as ITOW in seconds')
+    parser.add_argument('--end', type=float, default=None, help='End of a window to look up, as ITOW in seconds')
+    parser.add_argument('--week', type=int, default=None, help='GPS week of --start and --end')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the index even if it is up to date')
+    args = parser.parse_args()
+    if args.start is not None and args.end is not None and args.end <= args.start:
+        parser.error('--end must be after --start')
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.rebuild and os.path.exists(args.file + TIME_INDEX_EXTENSION):
+        os.remove(args.file + TIME_INDEX_EXTENSION)
+
+    with UbloxFile(args.file) as f:
+        startTime = time.time()
+        index = loadTimeIndex(f)
+        print('{} epochs, loaded in {:.3f} s'.format(len(index), time.time() - startTime))
+        if len(index):
+            for name, t in [('First', index.times[0]), ('Last', index.times[-1])]:
+                week, itow = divmod(t, WEEK_MS)
+                print('{}: week {}{}, ITOW {:.3f} s'.format(name, week, '' if index.weekKnown else ' (relative)', itow / 1e3))
+
+        if args.start is not None or args.end is not None:
+            startTime = time.time()
+            startItow = int(args.start * 1000) if args.start is not None else None
+            endItow = int(args.end * 1000) if args.end is not None else None
+            first, last = frameRange(f, index, startItow, endItow, args.week)
+            elapsed = time.time() - startTime
+            start = f.offsets[first] if first < len(f) else f.dataSize
+            end = f.offsets[last] if last < len(f) else f.dataSize
+            print('Frames {} to {}, bytes {} to {} ({:.3f} ms)'.format(first, last, start, end, elapsed * 1e3))
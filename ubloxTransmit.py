@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# Prioritized, paced transmission to a receiver
+#
+# TransmitQueue owns the write side of a non-blocking fd. send() queues a
+# frame and returns without blocking. Frames are written whole and in order:
+# after a short write or EAGAIN, the rest of the frame is written by a
+# background thread once the fd is writable again, so frames are never
+# truncated or interleaved.
+#
+# Control frames (polls, CFG and everything else that is not bulk) are
+# written before any queued bulk frame, but never in the middle of a frame
+# that has already been started. Bulk frames (MGA and UPD messages, RTCM3
+# corrections) are paced so that all the data written, control frames
+# included, stays below pacing times the baud rate, which keeps the
+# receiver's RX buffer from overflowing during large uploads. Without a baud
+# rate (USB, pipes, sockets), bulk frames are not paced.
+
+import os
+import re
+import time
+import errno
+import select
+import atexit
+import termios
+import logging
+import threading
+import collections
+
+from ubloxMessage import SYNC1, SYNC2
+
+DEFAULT_PACING = 0.5
+# Bytes of bulk data that may be written at once after an idle period
+DEFAULT_BURST = 256
+# Seconds to wait for queued frames to be written when the program exits
+EXIT_DRAIN_TIMEOUT = 2.0
+# Longest wait for the fd to become writable, so that setFd() and close()
+# are noticed
+WRITABLE_TIMEOUT = 0.1
+
+# MGA and UPD
+BULK_CLASSES = frozenset([0x13, 0x09])
+RTCM3_PREAMBLE = 0xd3
+# Start, 8 data and 1 stop bits per byte
+BITS_PER_BYTE = 10
+
+# termios speed constant -> baud rate
+BAUD_RATES = dict((getattr(termios, name), int(name[1:])) for name in dir(termios)
+                  if re.match(r'B\d+$', name) and int(name[1:]) > 0)
+
+def ttyBaudRate(fd):
+    # Output baud rate of a tty, or None if fd is not a tty
+    try:
+        return BAUD_RATES.get(termios.tcgetattr(fd)[5])
+    except termios.error:
+        return None
+
+def isBulk(data):
+    # True for MGA and UPD frames and RTCM3 messages
+    if len(data) >= 3 and data[0] == SYNC1 and data[1] == SYNC2:
+        return data[2] in BULK_CLASSES
+    return len(data) > 0 and data[0] == RTCM3_PREAMBLE
+
+class TransmitQueue(object):
+    def __init__(self, fd, baudRate=None, pacing=DEFAULT_PACING, burst=DEFAULT_BURST):
+        self.fd = fd
+        self.pacing = pacing
+        self.burst = burst
+        self.control = collections.deque()
+        # The rest of the frame being written, as a memoryview
+        self.current = None
+        self.bulk = collections.deque()
+        self.pendingBytes = 0
+        self.bytesWritten = 0
+        self.framesWritten = 0
+        self.shortWrites = 0
+        self.droppedFrames = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.drained = threading.Condition(self.lock)
+        self.closed = False
+        self.setBaudRate(baudRate)
+
+        self.thread = threading.Thread(target=self.run, name='TransmitQueue')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self._drainAtExit)
+
+    def setBaudRate(self, baudRate):
+        # Pace bulk frames for a new baud rate, or not at all if None
+        with self.lock:
+            self.rate = self.pacing * baudRate / BITS_PER_BYTE if baudRate else None
+            self.tokens = self.burst
+            self.lastRefill = time.monotonic()
+
+    def setFd(self, fd, baudRate=None):
+        # Switch to a reopened fd, or stop writing until one is set if fd is
+        # None. Call setFd(None) before closing the old fd, so that nothing
+        # is written to another file that reuses its number. The rest of a
+        # frame started on the old fd is dropped, since the receiver will
+        # not see its beginning.
+        with self.lock:
+            if self.current is not None:
+                self._dropCurrent()
+            self.fd = fd
+            self.wakeup.notify()
+        self.setBaudRate(baudRate)
+
+    def send(self, data, bulk=None):
+        # Queue a frame, as a control frame or a bulk one. By default, MGA,
+        # UPD and RTCM3 frames are bulk.
+        if bulk is None:
+            bulk = isBulk(data)
+        with self.lock:
+            if self.closed:
+                raise ValueError('Transmit queue is closed')
+            (self.bulk if bulk else self.control).append(bytes(data))
+            self.pendingBytes += len(data)
+            # Write right away if the fd and the pacing allow it, and leave
+            # the rest to the thread
+            if self.fd is not None and self._writeReady() is not None:
+                self.wakeup.notify()
+
+    def drain(self, timeout=None):
+        # Wait until all the queued frames are written. Returns False on
+        # timeout.
+        with self.lock:
+            return self.drained.wait_for(lambda: self.pendingBytes == 0, timeout)
+
+    def close(self, timeout=EXIT_DRAIN_TIMEOUT):
+        # Write the queued frames for at most timeout seconds, drop the
+        # others and stop the thread
+        self.drain(timeout)
+        with self.lock:
+            if self.pendingBytes:
+                logging.warning('Dropping {} bytes that could not be sent'.format(self.pendingBytes))
+                if self.current is not None:
+                    self._dropCurrent()
+                self.droppedFrames += len(self.control) + len(self.bulk)
+                self.control.clear()
+                self.bulk.clear()
+                self.pendingBytes = 0
+            self.closed = True
+            self.wakeup.notify()
+        self.thread.join()
+        atexit.unregister(self._drainAtExit)
+
+    def _drainAtExit(self):
+        # Scripts often send a message and exit; give the thread time to
+        # finish writing it
+        if not self.closed and not self.drain(EXIT_DRAIN_TIMEOUT):
+            logging.warning('Exiting with {} bytes not sent'.format(self.pendingBytes))
+
+    def _dropCurrent(self):
+        # Called with the lock held
+        self.pendingBytes -= len(self.current)
+        self.droppedFrames += 1
+        self.current = None
+
+    def _spend(self, size):
+        # Count written bytes against the pacing. Control frames can make
+        # the tokens negative, which delays the next bulk frame.
+        if self.rate is None:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.rate) - size
+        self.lastRefill = now
+
+    def _bulkDelay(self, size):
+        # Seconds until a bulk frame of size bytes may be started
+        if self.rate is None:
+            return 0
+        self._spend(0)
+        need = min(size, self.burst)
+        return 0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def _writeReady(self):
+        # Called with the lock held. Writes as much as possible without
+        # blocking. Returns None if everything was written, 0 if the fd is
+        # not writable, or the seconds until the next bulk frame is due.
+        while True:
+            if self.current is None:
+                if self.control:
+                    self.current = memoryview(self.control.popleft())
+                elif self.bulk:
+                    delay = self._bulkDelay(len(self.bulk[0]))
+                    if delay > 0:
+                        return delay
+                    self.current = memoryview(self.bulk.popleft())
+                else:
+                    self.drained.notify_all()
+                    return None
+            try:
+                written = os.write(self.fd, self.current)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return 0
+                logging.error('Could not write {} bytes: {}'.format(len(self.current), e))
+                self._dropCurrent()
+                continue
+            self.pendingBytes -= written
+            self.bytesWritten += written
+            self._spend(written)
+            if written < len(self.current):
+                self.shortWrites += 1
+                self.current = self.current[written:]
+                return 0
+            self.current = None
+            self.framesWritten += 1
+
+    def run(self):
+        with self.lock:
+            while True:
+                if self.fd is None:
+                    # Stopped by setFd(None)
+                    if self.closed:
+                        return
+                    self.wakeup.wait()
+                    continue
+                delay = self._writeReady()
+                if delay is None:
+                    if self.closed:
+                        return
+                    self.wakeup.wait()
+                elif delay > 0:
+                    # Control frames queued meanwhile wake the thread up
+                    self.wakeup.wait(delay)
+                else:
+                    fd = self.fd
+                    self.lock.release()
+                    try:
+                        select.select([], [fd], [], WRITABLE_TIMEOUT)
+                    except (OSError, ValueError):
+                        # The fd was closed after setFd
+                        time.sleep(WRITABLE_TIMEOUT)
+                    finally:
+                        self.lock.acquire()
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import ubx
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', help='File of UBX frames to upload, e.g. MGA assistance data')
+    parser.add_argument('--device', '-d', required=True)
+    parser.add_argument('--baudRate', '-r', type=int, default=None)
+    parser.add_argument('--pacing', '-p', type=float, default=DEFAULT_PACING, help='Fraction of the baud rate used for bulk frames')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    fd = os.open(args.device, os.O_NONBLOCK | os.O_RDWR | os.O_NOCTTY)
+    ubx.configureTty(fd, args.baudRate)
+    queue = TransmitQueue(fd, ttyBaudRate(fd), args.pacing)
+    frames = 0
+    startTime = time.time()
+    for ty, frame in ubx.iterMessages(args.file, raw=True):
+        queue.send(frame)
+        frames += 1
+    queue.drain()
+    elapsed = time.time() - startTime
+    print('Sent {} frames, {} bytes in {:.3f} s ({:.0f} B/s), {} short writes'.format(
+          frames, queue.bytesWritten, elapsed, queue.bytesWritten / max(elapsed, 1e-9), queue.shortWrites))
+    queue.close()
+    sys.exit(0 if not queue.droppedFrames else 1)
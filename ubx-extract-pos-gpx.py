@@ -1,10 +1,9 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 import ubx
 import struct
 import calendar
 import os
-import gobject
 import logging
 import sys
 import time
@@ -23,7 +22,7 @@ if __name__ == "__main__":
   xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
   xmlns="http://www.topografix.com/GPX/1/0"
   xsi:schemaLocation="http://www.topografix.com/GPX/1/0 http://www.topografix.com/GPX/1/0/gpx.xsd">""")
-    t = ubx.Parser(callback, device=False)
-    data = sys.stdin.read()
-    t.parse(data)
+    source = sys.argv[1] if len(sys.argv) > 1 else sys.stdin.buffer
+    for ty, packet in ubx.iterMessages(source, ['NAV-POSLLH']):
+        callback(ty, packet)
     print("</gpx>")
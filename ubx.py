@@ -16,19 +16,95 @@ import logging
 import sys
 import socket
 import time
+import termios
+import errno
+import re
+import stat
+import collections
 from ubloxMessage import UbloxMessage, SYNC1, SYNC2
+import ubloxNmea
+import ubloxCompressed
+import ubloxTransmit
+
+SYNC = bytearray([SYNC1, SYNC2])
+
+# Start of a UBX frame or of an NMEA sentence
+FRAME_START = re.compile(b'\xb5\x62|\\$')
+NMEA_START = ord('$')
+
+# Number of consumed bytes to accumulate before the parse buffer is compacted
+COMPACT_THRESHOLD = 1 << 20
+
+# Size of the reads of iterMessages
+READ_SIZE = 1 << 16
+
+# Largest UDP payload without IP fragmentation on Ethernet, for the frames
+# sent over UDP by ubloxReplay and ubloxServer
+MAX_DATAGRAM = 1472
+
+# Default maximum number of unparsed bytes kept by the parser. This is larger
+# than the largest UBX frame, so only data that cannot be UBX is dropped.
+MAX_BUFFER_SIZE = 1 << 17
+
+# Seconds setBaudRate waits for queued messages to be sent
+SET_BAUD_RATE_DRAIN_TIMEOUT = 1.0
+
+def configureTty(fd, baudRate=None):
+    # Equivalent of "stty raw [baudRate] cs8 -cstopb -parenb" on an open fd
+    try:
+        attrs = termios.tcgetattr(fd)
+    except termios.error:
+        logging.warning('fd {} is not a tty, not configuring it'.format(fd))
+        return
+    attrs[0] &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP |
+                  termios.INLCR | termios.IGNCR | termios.ICRNL | termios.IXON)
+    attrs[1] &= ~termios.OPOST
+    attrs[2] &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB)
+    attrs[2] |= termios.CS8 | termios.CREAD | termios.CLOCAL
+    attrs[3] &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+    attrs[6][termios.VMIN] = 1
+    attrs[6][termios.VTIME] = 0
+    if baudRate is not None:
+        speed = getattr(termios, 'B{}'.format(baudRate))
+        attrs[4] = speed
+        attrs[5] = speed
+    termios.tcsetattr(fd, termios.TCSANOW, attrs)
 
 class Parser():
-    def __init__(self, callback, rawCallback=None, device="/dev/ttyO5"):
+    def __init__(self, callback, rawCallback=None, device="/dev/ttyO5", maxBufferSize=MAX_BUFFER_SIZE, decodeNmea=False, lazy=False,
+                 txPacing=ubloxTransmit.DEFAULT_PACING):
         self.callback = callback
         self.rawCallback = rawCallback
         self.device = device
+        # Writes go through a TransmitQueue, which resumes short writes and
+        # sends control messages ahead of paced bulk uploads
+        self.transmitter = None
         if device:
-            os.system("stty -F %s raw" % device)
             self.fd = os.open(device, os.O_NONBLOCK | os.O_RDWR)
+            configureTty(self.fd)
             self.flush()
+            self.transmitter = ubloxTransmit.TransmitQueue(self.fd, ubloxTransmit.ttyBaudRate(self.fd), txPacing)
             #gobject.io_add_watch(self.fd, gobject.IO_IN, self.cbDeviceReadable)
-        self.buffer = ""
+        # Unparsed data is buffer[pos:]. Sync bytes are searched from scan,
+        # since data between pos and scan has already been searched. At most
+        # maxBufferSize unparsed bytes are kept (None for no limit), older
+        # ones are dropped and counted in droppedBytes.
+        self.buffer = bytearray()
+        self.pos = 0
+        self.scan = 0
+        self.maxBufferSize = maxBufferSize
+        self.droppedBytes = 0
+        # NMEA sentences are passed to the callback as strings, or decoded
+        # with ubloxNmea.decode if decodeNmea is set
+        self.decodeNmea = decodeNmea
+        # UBX messages are passed to the callback as LazyMessage objects if
+        # lazy is set, otherwise as lists of dicts
+        self.lazy = lazy
+        # Subscriptions as (callback, types, raw). routes caches the
+        # callbacks of each (class, id, length), so that frames nobody has
+        # subscribed to are skipped without decoding.
+        self.subscriptions = []
+        self.routes = {}
         self.ack = {"CFG-PRT" : 0}
         self.ubx = {}
 
@@ -40,12 +116,27 @@ class Parser():
         return True
 
     def setBaudRate(self, baudRate):
+        # Let queued messages go out at the old baud rate first
+        if not self.transmitter.drain(SET_BAUD_RATE_DRAIN_TIMEOUT):
+            logging.warning('Changing baud rate with {} bytes not sent'.format(self.transmitter.pendingBytes))
+        # Stop the transmit thread from writing to the old fd number, which
+        # the reopened device may get
+        self.transmitter.setFd(None)
         os.close(self.fd)
-        os.system('stty -F {} {} cs8 -cstopb -parenb'.format(self.device, baudRate))
         self.fd = os.open(self.device, os.O_NONBLOCK | os.O_RDWR)
+        configureTty(self.fd, baudRate)
+        self.transmitter.setFd(self.fd, baudRate)
         self.flush()
         # time.sleep(0.1)
 
+    def close(self):
+        # Send the queued messages, stop the transmit thread and close the
+        # device
+        if self.transmitter is not None:
+            self.transmitter.close()
+            self.transmitter = None
+            os.close(self.fd)
+
     def flush(self, quiet=True):
         try:
             buf = os.read(self.fd, 512) # flush input
@@ -55,96 +146,276 @@ class Parser():
             pass
 
     def parse(self, data, useRawCallback=False):
+        # Append to the buffer and advance a read cursor instead of slicing
+        # off each packet, so that consumed data is only copied when the
+        # buffer is compacted. UBX frames and NMEA sentences are found in a
+        # single pass over the data.
         self.buffer += data
-        buffer_offset = 0
-        # Minimum packet length is 8
-        while len(self.buffer) >= buffer_offset + 8:
-            # Find the beginning of a UBX message
-            start = self.buffer.find( chr( SYNC1 ) + chr( SYNC2 ), buffer_offset )
-
-            # Could not find message - keep data because there may be a whole or partial NMEA message
-            # Consider limiting max buffer size
-            if start == -1:
-                return True
-
-            # Message shorter than minimum length - return and wait for additional data
-            # Consider limiting max buffer size
-            if start + 8 > len(self.buffer):
-                return True
-
-            # Decode header - message class, id, and length
-            (cl, id, length) = struct.unpack("<BBH", self.buffer[start+2:start+6])
-
-            # Check that there is enough data in the buffer to match the length
-            # If not, return and wait for additional data
-            if len(self.buffer) < start + length + 8:
-                return True
-
-            # Validate checksum  - if fail, skip past the sync
-            if self.checksum(self.buffer[start+2:start+length+6]) != struct.unpack("<BB", self.buffer[start+length+6:start+length+8]):
-                buffer_offset = start + 2
-                continue
-
-            # At this point, we should have a valid message at the start position
-
-            # Handle data prior to UBX message
-            if start > 0:
-                logging.debug("Discarded data not UBX %s" % repr(self.buffer[:start]) )
-                # Attempt to decode NMEA on discarded data
-                self.decodeNmeaBuffer(self.buffer[:start])
-
-            if length == 0:
-                logging.warning('Zero length packet of class {}, id {}!'.format(hex(cl), hex(id)))
-            else:
-                # Decode UBX message
-                try:
-                    msgFormat, data = UbloxMessage.decode(cl, id, length, self.buffer[start+6:start+length+6])
-                except ValueError:
-                    data = None
-                    pass
-
-                if data is not None:
-                    logging.debug("Got UBX packet of type %s: %s" % (msgFormat, data))
-                    self.callback(msgFormat, data)
-                
-            if useRawCallback and (self.rawCallback is not None):
-                self.rawCallback(self.buffer[:start+length+8])
-
-            # Discard packet
-            self.buffer = self.buffer[start+length+8:]
-            buffer_offset = 0
+        buf = self.buffer
+        view = memoryview(buf)
+        pos = self.pos
+        offset = max(pos, self.scan)
+        maxBufferSize = self.maxBufferSize
+        checksum = UbloxMessage.checksum
+        # Formatting every packet for the log is expensive, even if the
+        # message is then filtered out
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        try:
+            # Minimum packet length is 8
+            while len(buf) >= offset + 8:
+                # Find the beginning of a UBX message or NMEA sentence
+                match = FRAME_START.search(buf, offset)
+
+                # Could not find message
+                # Only the last byte can still be the start of a sync
+                if match is None:
+                    offset = len(buf) - 1
+                    return True
+                start = match.start()
+                offset = start
+
+                if buf[start] == NMEA_START:
+                    end = buf.find(b'\r\n', start, start + ubloxNmea.MAX_SENTENCE_LENGTH)
+                    if end == -1:
+                        # Wait for the rest of the sentence, unless it is too long
+                        if len(buf) < start + ubloxNmea.MAX_SENTENCE_LENGTH:
+                            return True
+                        offset = start + 1
+                        continue
+
+                    sentence = bytes(buf[start:end])
+                    if not ubloxNmea.validate(sentence):
+                        offset = start + 1
+                        continue
+
+                    if start > pos:
+                        logging.debug("Discarded data %r", bytes(buf[pos:start]))
+                    self.handleNmea(sentence.decode('latin-1'))
+
+                    if useRawCallback and (self.rawCallback is not None):
+                        self.rawCallback(bytes(buf[pos:end+2]))
+
+                    pos = end + 2
+                    offset = pos
+                    continue
+
+                # Message shorter than minimum length - return and wait for additional data
+                if start + 8 > len(buf):
+                    return True
+
+                # Decode header - message class, id, and length
+                (cl, id, length) = struct.unpack_from("<BBH", buf, start+2)
+
+                # A frame that can never fit in the buffer is garbage
+                if maxBufferSize is not None and length + 8 > maxBufferSize:
+                    offset = start + 2
+                    continue
+
+                # Check that there is enough data in the buffer to match the length
+                # If not, return and wait for additional data
+                if len(buf) < start + length + 8:
+                    return True
+
+                # Validate checksum  - if fail, skip past the sync
+                if checksum(view[start+2:start+length+6]) != struct.unpack_from("<BB", buf, start+length+6):
+                    offset = start + 2
+                    continue
+
+                # At this point, we should have a valid message at the start position
+
+                # Handle data prior to UBX message
+                if start > pos:
+                    logging.debug("Discarded data %r", bytes(buf[pos:start]))
+
+                route = self.routes.get((cl, id, length))
+                if route is None:
+                    route = self.route(cl, id, length)
+
+                if length == 0:
+                    # Polls; only unexpected if someone wants them decoded
+                    if route[0]:
+                        logging.warning('Zero length packet of class {}, id {}!'.format(hex(cl), hex(id)))
+                elif route[0]:
+                    # Decode UBX message
+                    try:
+                        if self.lazy:
+                            msgFormat, data = UbloxMessage.decodeLazy(cl, id, length, bytes(view[start+6:start+length+6]))
+                        else:
+                            msgFormat, data = UbloxMessage.decode(cl, id, length, view[start+6:start+length+6])
+                    except ValueError:
+                        data = None
+                        pass
+
+                    if data is not None:
+                        if debug:
+                            logging.debug("Got UBX packet of type %s: %s", msgFormat, data)
+                        for callback in route[0]:
+                            callback(msgFormat, data)
+
+                if route[1]:
+                    frame = bytes(buf[start:start+length+8])
+                    for callback in route[1]:
+                        callback(route[2], frame)
+
+                if useRawCallback and (self.rawCallback is not None):
+                    self.rawCallback(bytes(buf[pos:start+length+8]))
+
+                # Discard packet
+                pos = start + length + 8
+                offset = pos
+        finally:
+            view.release()
+            self.pos = pos
+            self.scan = offset
+            self.limit()
+            self.compact()
+
+    def subscribe(self, callback, types=None, raw=False):
+        # Call callback(ty, packet) for messages of the given types, which
+        # can be message names ('RXM-RAW'), class names ('NAV'), (class, id)
+        # pairs or class numbers. All UBX messages if types is None. Raw
+        # subscribers get the complete frame as bytes instead of a decoded
+        # packet, and the message name, or (class, id) if it is unknown.
+        # The callback passed to the constructor gets all messages,
+        # including NMEA sentences.
+        if isinstance(types, str):
+            types = [types]
+        self.subscriptions.append((callback, None if types is None else set(types), raw))
+        self.routes = {}
+
+    def unsubscribe(self, callback):
+        self.subscriptions = [s for s in self.subscriptions if s[0] != callback]
+        self.routes = {}
+
+    def route(self, cl, id, length):
+        # (decoded callbacks, raw callbacks, message name) of a message. The
+        # length tells apart messages that share a class and id.
+        name = UbloxMessage.messageName(cl, id, length)
+        className = name.split('-')[0] if name is not None else None
+        decoded = [] if self.callback is None else [self.callback]
+        raw = []
+        for callback, types, isRaw in self.subscriptions:
+            if types is None or name in types or className in types or (cl, id) in types or cl in types:
+                (raw if isRaw else decoded).append(callback)
+        route = self.routes[(cl, id, length)] = (decoded, raw, name if name is not None else (cl, id))
+        return route
+
+    def limit(self):
+        # Drop the oldest unparsed data beyond maxBufferSize
+        if self.maxBufferSize is None:
+            return
+        excess = len(self.buffer) - self.pos - self.maxBufferSize
+        if excess > 0:
+            logging.debug('Parse buffer full, dropping {} bytes'.format(excess))
+            self.droppedBytes += excess
+            self.pos += excess
+            self.scan = max(self.scan, self.pos)
+
+    def compact(self, force=False):
+        # Drop consumed data from the front of the buffer. This is done only
+        # once the consumed region is large, so that the cost is amortized
+        # over many packets.
+        if self.pos == 0:
+            return
+        threshold = COMPACT_THRESHOLD if self.maxBufferSize is None else min(COMPACT_THRESHOLD, self.maxBufferSize)
+        if force or self.pos >= threshold or self.pos == len(self.buffer):
+            del self.buffer[:self.pos]
+            self.scan -= self.pos
+            self.pos = 0
 
     def send( self, clid, length, payload ):
         logging.debug("Sending UBX packet of type %s: %s" % ( clid, payload ) )
         stream = UbloxMessage.buildMessage(clid, length, payload)
         self.sendraw(stream)
 
-    def sendraw(self, data):
-        #print("write %s" % repr(data))
-        #print("echo -en \"%s\" > /dev/ttySAC1" % "".join(["\\x%02x" % ord(x) for x in data]))
-        os.write(self.fd, data)
+    def sendraw(self, data, bulk=None):
+        # Queue data for the device without blocking. MGA, UPD and RTCM3
+        # frames are bulk unless bulk says otherwise, see ubloxTransmit.py.
+        self.transmitter.send(data, bulk)
 
     def checksum( self, msg ):
-        ck_a = 0
-        ck_b = 0
-        for i in msg:
-            ck_a = ck_a + ord(i)
-            ck_b = ck_b + ck_a
-        ck_a = ck_a % 256
-        ck_b = ck_b % 256
-        return (ck_a, ck_b)
+        return UbloxMessage.checksum(msg)
 
     def seekToNextUbxMessage(self, buf):
-        start = buf.find(chr( SYNC1 ) + chr( SYNC2 ))
+        start = buf.find(bytes(SYNC))
         return buf[start:]
 
-    def decodeNmeaBuffer(self, buf):
-        # This assumes the data buffer is NMEA data and looks for messages
-        messages = UbloxMessage.decodeNmeaBuffer(buf)
+    def handleNmea(self, sentence):
+        if self.callback is None:
+            return
+        if self.decodeNmea:
+            ty, packet = ubloxNmea.decode(sentence)
+            self.callback(ty, packet if packet is not None else sentence)
+        else:
+            self.callback(sentence[:sentence.find(',')], sentence)
+
+def readChunks(source, chunkSize=READ_SIZE):
+    # Generator of the data of a source, in chunks of at most chunkSize
+    # bytes: a file name, a serial device, a .ubz file, a socket, a file
+    # object, a file descriptor or a bytes-like object. Files and devices
+    # opened here are closed when the generator is closed.
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for offset in range(0, len(view), chunkSize):
+            yield view[offset:offset+chunkSize]
+        return
 
-        for message in messages:
-            if len(message) == 0:
-                continue
+    if isinstance(source, str):
+        if stat.S_ISCHR(os.stat(source).st_mode):
+            # Blocking reads, which return as soon as there is data
+            fd = os.open(source, os.O_RDWR | os.O_NOCTTY)
+            configureTty(fd)
+            try:
+                for chunk in readChunks(fd, chunkSize):
+                    yield chunk
+            except OSError as e:
+                # The device went away: a USB receiver was unplugged or the
+                # other end of a pty was closed
+                if e.errno != errno.EIO:
+                    raise
+            finally:
+                os.close(fd)
+        elif ubloxCompressed.isCompressed(source):
+            with ubloxCompressed.CompressedFile(source) as f:
+                for offset, data in f.iterBlocks():
+                    for chunk in readChunks(data, chunkSize):
+                        yield chunk
+        else:
+            with open(source, 'rb') as f:
+                for chunk in readChunks(f, chunkSize):
+                    yield chunk
+        return
 
-            self.callback(message[:start], message)
+    if isinstance(source, int):
+        read = lambda: os.read(source, chunkSize)
+    elif hasattr(source, 'recv'):
+        read = lambda: source.recv(chunkSize)
+    elif hasattr(source, 'read1'):
+        # Return what a pipe has instead of waiting for a full chunk
+        read = lambda: source.read1(chunkSize)
+    else:
+        read = lambda: source.read(chunkSize)
+    while True:
+        data = read()
+        if not data:
+            return
+        yield data
 
+def iterMessages(source, types=None, lazy=False, raw=False, chunkSize=READ_SIZE, maxBufferSize=MAX_BUFFER_SIZE):
+    # Generator of (message type, packet) for the UBX messages of a source
+    # (see readChunks), as they are parsed. types selects messages like
+    # Parser.subscribe. With raw, the packets are the frames as bytes. Only
+    # the messages of one chunk are held at a time, so memory does not grow
+    # with the size of the source, and the source is only read as far as
+    # the consumer iterates.
+    messages = collections.deque()
+    parser = Parser(None, device=False, maxBufferSize=maxBufferSize, lazy=lazy)
+    parser.subscribe(lambda ty, packet: messages.append((ty, packet)), types, raw)
+    chunks = readChunks(source, chunkSize)
+    try:
+        for chunk in chunks:
+            parser.parse(chunk)
+            while messages:
+                yield messages.popleft()
+    finally:
+        chunks.close()
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+# Measure UBX parse throughput on synthetic logs
+#
+# With --suite, each parser in PARSERS is run on each synthetic corpus in
+# CORPORA, in a separate process so that the peak RSS of one run does not
+# hide that of the next. The corpora are deterministic, so the numbers of
+# different versions of the code can be compared. Allocations are measured
+# with tracemalloc in a second, shorter run, since tracing slows parsing
+# down.
+
+import os
+import struct
+import sys
+import time
+import json
+import random
+import logging
+import resource
+import collections
+import tracemalloc
+import multiprocessing
+
+import ubx
+import ubloxNmea
+from ubloxMessage import UbloxMessage, MSGFMT
+
+try:
+    import ublox2
+except ImportError:
+    # ublox2 needs pyserial
+    ublox2 = None
+
+def syntheticPacket(clid, length, numBlocks=0, itow=0):
+    # Build a packet with all fields zeroed, except for the time of week and date
+    if length is not None:
+        msgFormat = MSGFMT[(clid, length)]
+        fmt_base = [length] + msgFormat
+        fmt_rep = None
+    else:
+        msgFormat = MSGFMT[(clid, None)]
+        fmt_base = msgFormat[:3]
+        fmt_rep = msgFormat[3:]
+
+    values = struct.unpack(fmt_base[1], b'\x00' * struct.calcsize(fmt_base[1]))
+    base = dict(zip(fmt_base[2], values))
+    if 'ITOW' in base:
+        base['ITOW'] = itow
+    if 'Year' in base:
+        # Keep the date valid for consumers that convert it
+        seconds = itow // 1000
+        base.update({'Year': 2018, 'Month': 9, 'Day': 1 + (seconds // 86400) % 28,
+                     'Hour': (seconds // 3600) % 24, 'Min': (seconds // 60) % 60, 'Sec': seconds % 60})
+
+    if fmt_rep is None:
+        return length, base
+
+    values = struct.unpack(fmt_rep[1], b'\x00' * struct.calcsize(fmt_rep[1]))
+    packet = [base] + [dict(zip(fmt_rep[2], values)) for i in range(numBlocks)]
+    return fmt_base[0] + fmt_rep[0] * numBlocks, packet
+
+def syntheticMessage(clid, length=None, numBlocks=0, itow=0):
+    length, packet = syntheticPacket(clid, length, numBlocks, itow)
+    return UbloxMessage.buildMessage(clid, length, packet)
+
+def syntheticEpoch(itow):
+    # One navigation epoch of a typical M8U logging configuration
+    messages = []
+    for i in range(10):
+        messages.append(syntheticMessage('HNR-PVT', 72, itow=itow + i * 100))
+        messages.append(syntheticMessage('ESF-MEAS', numBlocks=4))
+    messages.append(syntheticMessage('NAV-PVT', 92, itow=itow))
+    messages.append(syntheticMessage('NAV-ATT', 32, itow=itow))
+    messages.append(syntheticMessage('NAV-DOP', 18, itow=itow))
+    messages.append(syntheticMessage('NAV-STATUS', 16, itow=itow))
+    messages.append(syntheticMessage('NAV-SVINFO', numBlocks=16, itow=itow))
+    return b''.join(messages)
+
+def syntheticLog(size, unitSize=1 << 20):
+    # Build a unit of roughly unitSize bytes and tile it up to size bytes
+    epochs = []
+    unitLength = 0
+    itow = 0
+    while unitLength < unitSize:
+        epoch = syntheticEpoch(itow)
+        epochs.append(epoch)
+        unitLength += len(epoch)
+        itow += 1000
+    unit = b''.join(epochs)
+    repeats, remainder = divmod(size, len(unit))
+    return unit * repeats + unit[:remainder]
+
+def benchmarkParse(data, chunkSize=None):
+    count = [0]
+    def callback(ty, packet):
+        count[0] += 1
+
+    parser = ubx.Parser(callback, device=False)
+    startTime = time.time()
+    if chunkSize is None:
+        parser.parse(data)
+    else:
+        for i in range(0, len(data), chunkSize):
+            parser.parse(data[i:i+chunkSize])
+    elapsed = time.time() - startTime
+    return count[0], elapsed
+
+def checksumLoop(msg):
+    # Reference per-byte implementation, for comparison
+    ck_a = 0
+    ck_b = 0
+    for i in bytearray(msg):
+        ck_a = ck_a + i
+        ck_b = ck_b + ck_a
+    return (ck_a % 256, ck_b % 256)
+
+def benchmarkChecksum(sizes=(16, 72, 256, 1024, 4096, 65535), duration=0.5):
+    for size in sizes:
+        msg = bytes(bytearray(i % 256 for i in range(size)))
+        assert UbloxMessage.checksum(msg) == checksumLoop(msg)
+        for name, function in [('loop', checksumLoop), ('UbloxMessage.checksum', UbloxMessage.checksum)]:
+            count = 0
+            startTime = time.time()
+            while time.time() - startTime < duration:
+                for i in range(100):
+                    function(msg)
+                count += 100
+            elapsed = time.time() - startTime
+            print('checksum {:>5} bytes, {}: {:.2f} us/call ({:.1f} MB/s)'.format(
+                size, name, elapsed / count * 1e6, size * count / 1e6 / elapsed))
+
+    data = syntheticLog(16 << 20)
+    starts = []
+    lengths = []
+    offset = 0
+    while offset + 8 <= len(data):
+        length = struct.unpack_from('<H', data, offset+4)[0]
+        if offset + length + 8 > len(data):
+            break
+        starts.append(offset)
+        lengths.append(length)
+        offset += length + 8
+    startTime = time.time()
+    for start, length in zip(starts, lengths):
+        checksumLoop(data[start+2:start+length+6])
+    elapsed = time.time() - startTime
+    printResult('checksum loop', offset, len(starts), elapsed)
+    startTime = time.time()
+    UbloxMessage.checksumFrames(data, starts, lengths)
+    elapsed = time.time() - startTime
+    printResult('UbloxMessage.checksumFrames', offset, len(starts), elapsed)
+
+def syntheticCorpus(messages, size):
+    # Tile the output of messages(itow) for successive epochs up to about
+    # size bytes. Returns the data and the number of valid UBX frames.
+    parts = []
+    length = 0
+    frames = 0
+    itow = 0
+    while length < size:
+        for data, isFrame in messages(itow):
+            parts.append(data)
+            length += len(data)
+            frames += isFrame
+        itow += 1000
+    return b''.join(parts), frames
+
+def navPvtCorpus(size, rng):
+    return syntheticCorpus(lambda itow: [(syntheticMessage('NAV-PVT', 92, itow=itow), True)], size)
+
+def hnrEsfCorpus(size, rng):
+    def messages(itow):
+        for i in range(20):
+            yield syntheticMessage('HNR-PVT', 72, itow=itow + i * 50), True
+            yield syntheticMessage('ESF-MEAS', numBlocks=4), True
+        for i in range(10):
+            yield syntheticMessage('ESF-RAW', numBlocks=7), True
+    return syntheticCorpus(messages, size)
+
+def rxmRawCorpus(size, rng):
+    def messages(itow):
+        yield syntheticMessage('RXM-RAW', numBlocks=rng.randint(8, 24), itow=itow), True
+        yield syntheticMessage('NAV-CLOCK', 20, itow=itow), True
+    return syntheticCorpus(messages, size)
+
+def mixedCorpus(size, rng):
+    return syntheticCorpus(lambda itow: [(syntheticEpoch(itow), 25)], size)
+
+def noisyCorpus(size, rng):
+    # Mixed epochs with random bytes, stray sync bytes, corrupted checksums
+    # and truncated frames in between. A stray sync with a large length
+    # makes a streaming parser wait for that much data, so frames in the
+    # last 64 KB may not be parsed by the end of the corpus.
+    epoch = syntheticEpoch(0)
+    def messages(itow):
+        for i in range(4):
+            frame = syntheticMessage('NAV-PVT', 92, itow=itow + i)
+            kind = rng.randint(0, 3)
+            if kind == 0:
+                yield bytes(bytearray(rng.randint(0, 255) for i in range(rng.randint(1, 64)))), False
+            elif kind == 1:
+                yield b'\xb5\x62' + bytes(bytearray(rng.randint(0, 255) for i in range(6))), False
+            elif kind == 2:
+                yield frame[:-1] + bytes(bytearray([frame[-1] ^ 0xff])), False
+            else:
+                yield frame[:rng.randint(8, len(frame) - 1)], False
+            yield frame, True
+        yield epoch, 25
+    return syntheticCorpus(messages, size)
+
+def nmeaSentence(body):
+    return '${}*{:02X}\r\n'.format(body, ubloxNmea.checksum(body)).encode('latin-1')
+
+def nmeaCorpus(size, rng):
+    # Mixed epochs with the NMEA sentences of the same epoch interleaved
+    def messages(itow):
+        yield syntheticEpoch(itow), 25
+        seconds = itow // 1000
+        time = '{:02d}{:02d}{:02d}.00'.format((seconds // 3600) % 24, (seconds // 60) % 60, seconds % 60)
+        yield nmeaSentence('GPGGA,{},3723.2475,N,12158.3416,W,1,08,0.9,545.4,M,46.9,M,,'.format(time)), False
+        yield nmeaSentence('GPRMC,{},A,3723.2475,N,12158.3416,W,0.02,31.66,010918,,,A'.format(time)), False
+        for i in range(3):
+            yield nmeaSentence('GPGSV,3,{},12,{:02d},45,090,40,{:02d},30,180,35,{:02d},15,270,30,{:02d},60,000,45'.format(i + 1, 4 * i + 1, 4 * i + 2, 4 * i + 3, 4 * i + 4)), False
+    return syntheticCorpus(messages, size)
+
+# Name -> function(size, rng) returning (data, number of valid UBX frames)
+CORPORA = {
+    'nav-pvt': navPvtCorpus,
+    'hnr-esf': hnrEsfCorpus,
+    'rxm-raw': rxmRawCorpus,
+    'mixed': mixedCorpus,
+    'noisy': noisyCorpus,
+    'nmea': nmeaCorpus,
+}
+
+def parseUbx(data, chunkSize):
+    count = [0]
+    def callback(ty, packet):
+        if not isinstance(packet, str):
+            count[0] += 1
+    parser = ubx.Parser(callback, device=False)
+    for i in range(0, len(data), chunkSize):
+        parser.parse(data[i:i+chunkSize])
+    return count[0]
+
+def parseUbloxMessage(data, chunkSize):
+    # UbloxMessage.parse decodes the frame at the start of a buffer and
+    # returns the rest, so the data is fed in chunks with the remainder
+    # carried over
+    count = 0
+    buf = b''
+    for i in range(0, len(data), chunkSize):
+        buf = buf + data[i:i+chunkSize]
+        while True:
+            start = buf.find(b'\xb5\x62')
+            if start == -1:
+                buf = buf[-1:]
+                break
+            if start + 6 > len(buf) or start + struct.unpack_from('<H', buf, start+4)[0] + 8 > len(buf):
+                buf = buf[start:]
+                break
+            try:
+                msgFormat, msgData, remainder = UbloxMessage.parse(buf[start:])
+            except ValueError:
+                buf = buf[start+2:]
+                continue
+            count += 1
+            buf = bytes(remainder) if remainder is not None else b''
+    return count
+
+def parseUbloxReader(data, chunkSize):
+    # Fed through the serial protocol interface of ublox2.UbloxReader.
+    # data_received parses at most one frame per call, so after each chunk
+    # it is called again with no data once per sync in the chunk. The reader
+    # cannot get past a frame it fails to decode, or a sync it has lost track
+    # of in a noisy stream (IndexError), so parsing ends there and the
+    # shortfall shows in the frame count.
+    count = [0]
+    class Reader(ublox2.UbloxReader):
+        def handle_message(self, msgFormat, msgData):
+            count[0] += 1
+    reader = Reader()
+    try:
+        for i in range(0, len(data), chunkSize):
+            chunk = bytes(data[i:i+chunkSize])
+            reader.data_received(chunk)
+            for j in range(chunk.count(b'\xb5\x62')):
+                reader.data_received(b'')
+    except (ValueError, IndexError):
+        pass
+    return count[0]
+
+# Name -> function(data, chunkSize) returning the number of UBX messages
+PARSERS = {
+    'ubx.Parser.parse': parseUbx,
+    'UbloxMessage.parse': parseUbloxMessage,
+}
+if ublox2 is not None:
+    PARSERS['ublox2.UbloxReader.parse'] = parseUbloxReader
+
+def maxRss():
+    # Peak RSS of this process in MB
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1e6 if sys.platform == 'darwin' else rss / 1e3
+
+def runCase(parser, data, chunkSize, allocationSize, results):
+    # Run in a child process, see runSuite
+    startRss = maxRss()
+    startTime = time.time()
+    count = PARSERS[parser](data, chunkSize)
+    elapsed = time.time() - startTime
+    rss = maxRss()
+
+    data = data[:allocationSize]
+    tracemalloc.start()
+    PARSERS[parser](data, chunkSize)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results.put((count, elapsed, rss, rss - startRss, peak))
+
+def runSuite(corpora, parsers, size, chunkSize, allocationSize, seed=0):
+    # Returns a list of result dictionaries, one per corpus and parser
+    results = []
+    queue = multiprocessing.Queue()
+    for corpus in corpora:
+        data, frames = CORPORA[corpus](size, random.Random(seed))
+        for parser in parsers:
+            process = multiprocessing.Process(target=runCase, args=(parser, data, chunkSize, allocationSize, queue))
+            process.start()
+            count, elapsed, rss, rssIncrease, allocationPeak = queue.get()
+            process.join()
+            result = {'corpus': corpus, 'parser': parser, 'bytes': len(data), 'frames': frames, 'parsed': count,
+                      'seconds': elapsed, 'framesPerSecond': count / elapsed, 'mbPerSecond': len(data) / 1e6 / elapsed,
+                      'maxRssMb': rss, 'rssIncreaseMb': rssIncrease,
+                      'allocationPeakKb': allocationPeak / 1e3}
+            results.append(result)
+            print('{corpus:>8} {parser:<26} {framesPerSecond:>10.0f} frames/s {mbPerSecond:>7.2f} MB/s '
+                  'RSS {maxRssMb:>6.1f} MB (+{rssIncreaseMb:.1f}) alloc peak {allocationPeakKb:>8.1f} KB'.format(**result) +
+                  ('' if count == frames else ' ({} of {} frames)'.format(count, frames)))
+            sys.stdout.flush()
+    return results
+
+def benchmarkEncode(duration=0.5):
+    # Time UbloxMessage.buildMessage for typical commands, polls and a large
+    # variable length message
+    cases = [('poll MON-VER', 'MON-VER', 0, [])]
+    for clid, length, numBlocks in [('CFG-MSG', None, 6), ('CFG-GNSS', None, 7), ('CFG-RATE', 6, 0),
+                                    ('MGA-GPS-EPH', 68, 0), ('RXM-RAW', None, 32), ('RXM-RAW', None, 2000)]:
+        size, packet = syntheticPacket(clid, length, numBlocks)
+        cases.append(('{} ({} bytes)'.format(clid, size), clid, size, packet))
+    for name, clid, size, packet in cases:
+        count = 0
+        startTime = time.time()
+        while time.time() - startTime < duration:
+            for i in range(10):
+                UbloxMessage.buildMessage(clid, size, packet)
+            count += 10
+        elapsed = time.time() - startTime
+        print('buildMessage {}: {:.2f} us/message'.format(name, elapsed / count * 1e6))
+
+AUTOBAUD_RATES = [9600, 19200, 38400, 57600, 115200, 230400, 460800]
+AUTOBAUD_TIMEOUT = 0.2
+DEFAULT_PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'default-profile.json')
+
+def benchmarkEmulator(baudRate=115200, latency=0.0, duration=3.0, profileFile=DEFAULT_PROFILE):
+    # Time command round trips, applying a profile, baud rate detection and
+    # streaming against ubloxEmulator, so that no receiver is needed
+    import asyncio
+    import select
+    import ubloxAsync
+    import ubloxProfile
+    import ubloxEmulator
+
+    profile = ubloxProfile.loadProfile(profileFile)
+
+    async def configure(device):
+        protocol = await ubloxAsync.openDevice(device)
+        try:
+            startTime = time.time()
+            for i in range(20):
+                await protocol.poll('MON-VER')
+            print('poll MON-VER: {:.2f} ms round trip'.format((time.time() - startTime) / 20 * 1e3))
+            requests = ubloxProfile.pollRequests(profile)
+            startTime = time.time()
+            await protocol.pollMany(requests)
+            print('pollMany of {} settings: {:.2f} ms'.format(len(requests), (time.time() - startTime) * 1e3))
+            startTime = time.time()
+            try:
+                changes = await ubloxProfile.applyProfile(protocol, profile)
+                print('applyProfile: {} config messages in {:.2f} ms'.format(len(changes), (time.time() - startTime) * 1e3))
+            except Exception as e:
+                # e.g. ACKs dropped by a full TX buffer once output is enabled
+                print('applyProfile failed after {:.2f} ms: {}'.format((time.time() - startTime) * 1e3, e))
+        finally:
+            ubloxAsync.closeDevice(protocol)
+
+    async def detect(device):
+        # Baud rate at which the receiver answers a CFG-PRT poll
+        for candidate in AUTOBAUD_RATES:
+            protocol = await ubloxAsync.openDevice(device, candidate)
+            try:
+                packet = await protocol.poll('CFG-PRT', maxRetries=1, timeout=AUTOBAUD_TIMEOUT)
+            finally:
+                ubloxAsync.closeDevice(protocol)
+            if packet is not None:
+                return candidate
+        return None
+
+    print('Emulated receiver at {} baud, {:.1f} ms latency'.format(baudRate, latency * 1e3))
+    with ubloxEmulator.ReceiverEmulator(baudRate, latency) as emulator:
+        startTime = time.time()
+        detected = asyncio.run(detect(emulator.device))
+        print('Baud rate detection: {} in {:.3f} s'.format(detected, time.time() - startTime))
+
+    with ubloxEmulator.ReceiverEmulator(baudRate, latency) as emulator:
+        asyncio.run(configure(emulator.device))
+
+        # Stream the output configured by the profile
+        counts = collections.Counter()
+        parser = ubx.Parser(None, device=False)
+        parser.subscribe(lambda ty, frame: counts.update([ty]), raw=True)
+        fd = os.open(emulator.device, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+        size = 0
+        startTime = time.time()
+        try:
+            while time.time() - startTime < duration:
+                if select.select([fd], [], [], 0.1)[0]:
+                    data = os.read(fd, ubx.READ_SIZE)
+                    size += len(data)
+                    parser.parse(data)
+        finally:
+            os.close(fd)
+        elapsed = time.time() - startTime
+        print('Streaming: {} messages/s, {:.1f} kB/s ({:.0f}% of the link), {} messages dropped by the receiver'.format(
+              int(sum(counts.values()) / elapsed), size / elapsed / 1e3, 100.0 * size / elapsed / (baudRate / 10.0),
+              emulator.stats['txDropped']))
+        for ty in sorted(counts):
+            print('  {}: {:.1f} Hz'.format(ty, counts[ty] / elapsed))
+
+def printResult(name, size, count, elapsed):
+    print('{}: {:.1f} MB, {} packets in {:.3f} s ({:.2f} MB/s, {:.0f} packets/s)'.format(
+        name, size / 1e6, count, elapsed, size / 1e6 / elapsed, count / elapsed))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', '-s', type=int, default=1024, help='Size of the largest synthetic log in MB')
+    parser.add_argument('--steps', type=int, default=3, help='Number of log sizes, halving from --size')
+    parser.add_argument('--checksum', action='store_true', help='Run the checksum micro-benchmark instead')
+    parser.add_argument('--chunkSize', '-c', type=int, default=None, help='Feed the parser in chunks of this many bytes instead of one call')
+    parser.add_argument('--encode', action='store_true', help='Run the message encoding micro-benchmark instead')
+    parser.add_argument('--suite', action='store_true', help='Run every parser on every synthetic corpus instead')
+    parser.add_argument('--corpus', action='append', choices=sorted(CORPORA.keys()), help='Corpus for --suite. May be given several times. Defaults to all.')
+    parser.add_argument('--parser', action='append', choices=sorted(PARSERS.keys()), help='Parser for --suite. May be given several times. Defaults to all.')
+    parser.add_argument('--suiteSize', type=float, default=4, help='Size of each corpus of --suite in MB')
+    parser.add_argument('--json', default=None, help='Save the --suite results to this JSON file')
+    parser.add_argument('--emulator', action='store_true', help='Benchmark configuration and streaming against an emulated receiver instead')
+    parser.add_argument('--baudRate', '-r', type=int, default=115200, help='Baud rate of the emulated receiver')
+    parser.add_argument('--latency', type=float, default=0.0, help='Response latency of the emulated receiver in ms')
+    parser.add_argument('--duration', type=float, default=3.0, help='Seconds of streaming from the emulated receiver')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.checksum:
+        benchmarkChecksum()
+        sys.exit(0)
+
+    if args.encode:
+        benchmarkEncode()
+        sys.exit(0)
+
+    if args.emulator:
+        benchmarkEmulator(args.baudRate, args.latency / 1000.0, args.duration)
+        sys.exit(0)
+
+    if args.suite:
+        if ublox2 is None:
+            print('ublox2 is not available (pyserial is not installed), skipping ublox2.UbloxReader.parse')
+        size = int(args.suiteSize * 1e6)
+        print('Allocation peaks are for the first {:.1f} MB of each corpus'.format(min(size, 1 << 20) / 1e6))
+        results = runSuite(args.corpus or sorted(CORPORA.keys()), args.parser or sorted(PARSERS.keys()), size,
+                           args.chunkSize or 4096, min(size, 1 << 20))
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+        sys.exit(0)
+
+    data = syntheticLog(args.size << 20)
+    for step in reversed(range(args.steps)):
+        size = len(data) >> step
+        count, elapsed = benchmarkParse(memoryview(data)[:size], args.chunkSize)
+        printResult('ubx.Parser.parse', size, count, elapsed)